@@ -1,22 +1,40 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
 import os
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
 import time
 import subprocess
 import shutil
 import datetime
+import signal
+import stat
+import hashlib
 import threading
+import sqlite3
+import multiprocessing
+from collections import OrderedDict
 from queue import Queue
 import json
+import re
+import html
 import logging
-import requests.exceptions
+from urllib.parse import urljoin, urlsplit, quote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import requests
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import send_file as werkzeug_send_file
 from logging import Formatter
 from flask.logging import default_handler
 import logging.config
 
+# 运行方式: dev 为 Flask 自带的单进程服务器；gunicorn 为多进程生产模式，
+# 各工作进程通过 job_store 中的 SQLite 共享任务状态
+server_mode = os.getenv('SERVER_MODE', 'dev')
+if __name__ == '__main__' and server_mode == 'gunicorn':
+    # 交给 gunicorn 按 gunicorn.conf.py 启动工作进程，本进程不做任何初始化
+    os.execvp('gunicorn', ['gunicorn', '--config', 'gunicorn.conf.py', 'app:app'])
+
 app = Flask(__name__)
 
 # 配置 Flask 的日志格式
@@ -50,252 +68,354 @@ formatter = RequestFormatter('%(request_log)s %(message)s')
 default_handler.setFormatter(formatter)
 
 # 获取download_m3u8.py中定义的output_dir
-from download_m3u8 import output_dir, setup_logger
+from download_m3u8 import output_dir, download_mode, download_workers, setup_logger
+from http_client import probe
 
 # 使用相同的日志配置
 logger = setup_logger()
 
-# 修改全局变量来存储下载状态
-download_status = {
-    'progress': 0,
-    'current_segments': 0,
-    'total_segments': 0,
-    'status': 'idle',  # idle, downloading, completed, failed
-    'error': None,
-    'process': None
-}
+from browser_pool import browser_pool
+from resolve_cache import resolve_cache, check_manifest_alive
+from metrics import PrometheusWriter, add_totals
+from job_store import job_store, is_downloader_process, owner_timeout
+from postprocess import postprocess_file
+from tracing import (Tracer, save_spans, load_spans, job_trace_path, resolve_trace_path, summarize,
+                     to_chrome_trace, prune_traces)
+
+# 同时运行的下载任务数
+max_concurrent_jobs = int(os.getenv('MAX_CONCURRENT_JOBS', '2'))
+# 所有任务合计同时下载中的分片数上限
+max_segments_in_flight = int(os.getenv('MAX_SEGMENTS_IN_FLIGHT', '16'))
+# 所有任务合计的下载带宽上限（字节/秒），0 表示不限速，由运行中的任务平分
+max_bandwidth = int(os.getenv('MAX_BANDWIDTH', '0'))
+# 保留的已结束任务数
+max_job_history = int(os.getenv('MAX_JOB_HISTORY', '100'))
+
+# SSE 连接无进度更新时发送心跳的间隔（秒）
+sse_keepalive = float(os.getenv('SSE_KEEPALIVE', '15'))
+
+# 文件列表每页默认条目数和上限
+list_page_size = int(os.getenv('LIST_PAGE_SIZE', '100'))
+LIST_MAX_PAGE_SIZE = 1000
+# 目录列表缓存的最长有效期（秒），目录修改时间变化时立即失效
+list_cache_ttl = float(os.getenv('LIST_CACHE_TTL', '10'))
+# 最多缓存多少个目录的列表
+LIST_CACHE_SIZE = 64
+LIST_SORT_KEYS = ('mtime', 'ctime', 'name', 'size')
+# 目录绝对路径 -> 扫描结果
+listing_cache = OrderedDict()
+listing_lock = threading.Lock()
+
+# 大文件的发送方式: none 由本进程发送；x-sendfile 设置 X-Sendfile 头交给 Apache/lighttpd；
+# x-accel 设置 X-Accel-Redirect 头交给 nginx
+sendfile_mode = os.getenv('SENDFILE_MODE', 'none')
+# x-accel 模式下输出目录在 nginx 中对应的 internal location
+x_accel_prefix = os.getenv('X_ACCEL_PREFIX', '/protected/')
+# 浏览器播放时 mimetypes 猜不准的扩展名
+STREAM_MIMETYPES = {'.ts': 'video/mp2t', '.mp4': 'video/mp4', '.m4v': 'video/mp4', '.mkv': 'video/x-matroska'}
+
+# 批量任务同时解析的网页数，所有工作进程合计，浏览器解析还受 BROWSER_POOL_SIZE 限制
+batch_resolve_workers = int(os.getenv('BATCH_RESOLVE_WORKERS', '4'))
+# 单个批量任务最多包含的地址数
+batch_max_items = int(os.getenv('BATCH_MAX_ITEMS', '500'))
+batch_executor = ThreadPoolExecutor(max_workers=batch_resolve_workers, thread_name_prefix='batch-resolve')
+# 本进程内提交批量任务或解析完一项时唤醒批量解析调度器
+batch_cond = threading.Condition()
+
+# 本进程内任务状态变化时通知 SSE 连接
+progress_cond = threading.Condition()
+# 本进程内提交或结束任务时唤醒调度器
+scheduler_cond = threading.Condition()
+# 调度器检查其他工作进程提交的任务的间隔（秒）
+scheduler_poll_interval = float(os.getenv('SCHEDULER_POLL_INTERVAL', '1'))
+# 调度器上报心跳、回收已退出工作进程的任务的间隔（秒），须明显小于心跳超时
+scheduler_heartbeat_interval = owner_timeout / 3
+# SSE 连接检查其他工作进程更新的任务进度的间隔（秒）
+sse_poll_interval = float(os.getenv('SSE_POLL_INTERVAL', '0.5'))
+
+# 同时运行的后处理数（faststart、缩略图、ffprobe 检查），所有工作进程合计，与下载并发分开配置；0 为不做后处理
+postprocess_workers = int(os.getenv('POSTPROCESS_WORKERS', '1'))
+# 缩略图宽度（像素）
+thumbnail_width = int(os.getenv('THUMBNAIL_WIDTH', '320'))
+# 后处理在独立的进程池中运行，不占用下载任务的名额和 Web 工作线程；首次使用时创建
+postprocess_executor = None
+postprocess_executor_lock = threading.Lock()
+# 本进程内有新的后处理任务或后处理结束时唤醒后处理调度器
+postprocess_cond = threading.Condition()
+
+# 是否记录每个任务的网页解析、播放列表、分片下载和封装时间线
+trace_enabled = os.getenv('TRACE_ENABLED', '1') == '1'
+# 时间线保存目录
+trace_dir = os.path.join(output_dir, 'traces')
+# 是否用 py-spy 对下载进程采样，生成 speedscope 格式的性能分析文件
+profile_downloader = os.getenv('PROFILE_DOWNLOADER', '0') == '1'
+# py-spy 每秒采样次数
+profile_rate = int(os.getenv('PROFILE_RATE', '100'))
+
+# 解析网页的总截止时间（秒）
+resolve_timeout = float(os.getenv('RESOLVE_TIMEOUT', '30'))
+# 触发播放前被动等待页面自行请求m3u8的时间（秒）
+resolve_passive_wait = float(os.getenv('RESOLVE_PASSIVE_WAIT', '5'))
+# 每个触发播放动作之后等待m3u8请求的时间（秒）
+resolve_action_wait = float(os.getenv('RESOLVE_ACTION_WAIT', '2'))
+# 检查网络事件的间隔（秒）
+resolve_poll_interval = 0.1
+# 不启动浏览器直接请求网页并检查其中m3u8链接的总截止时间（秒），请求不重试，超时后改用浏览器解析
+resolve_html_timeout = float(os.getenv('RESOLVE_HTML_TIMEOUT', '10'))
+
+# 网页源码中的m3u8地址，可能是绝对地址，也可能是引号包裹的相对地址
+M3U8_IN_HTML = re.compile(
+    r'(?P<url>https?://[^\s"\'<>\\]+?\.m3u8(?:\?[^\s"\'<>\\]*)?)'
+    r'|(?<=["\'])(?P<rel>[^"\'\s<>\\]+?\.m3u8(?:\?[^"\'\s<>\\]*)?)(?=["\'])',
+    re.IGNORECASE
+)
+TITLE_IN_HTML = re.compile(r'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+OG_TITLE_IN_HTML = re.compile(r'<meta[^>]+property=["\']og:title["\'][^>]+content=["\']([^"\']*)', re.IGNORECASE)
+
+
+def clean_title(title):
+    """清理标题中不能用于文件名的特殊字符"""
+    return re.sub(r'[\\/:*?"<>|]', '_', title).strip()
+
 
+def resolve_from_html(web_url, tracer):
+    """不启动浏览器，直接请求网页并在HTML和内联脚本中查找m3u8链接"""
+    start = time.time()
+    deadline = start + resolve_html_timeout
+    try:
+        with tracer.span('html_fetch', 'resolver', url=web_url):
+            response = probe(web_url, timeout=resolve_html_timeout)
+            response.raise_for_status()
+    except requests.RequestException as e:
+        logger.info(f"直接请求网页失败: {str(e)}")
+        return None
+
+    # 还原脚本和 JSON 中转义过的地址
+    body = html.unescape(response.text).replace('\\/', '/').replace('\\u002F', '/').replace('\\u002f', '/')
+
+    candidates = []
+    for match in M3U8_IN_HTML.finditer(body):
+        url = urljoin(response.url, match.group('url') or match.group('rel'))
+        if url.startswith('http') and url not in candidates:
+            candidates.append(url)
+    if not candidates:
+        return None
 
-def get_m3u8_url(web_url):
-    """使用Selenium模拟手机访问并获取m3u8链接和视频名称"""
+    # 页面里可能出现无关的m3u8地址，取前几个中第一个可访问的
+    for url in candidates[:3]:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            logger.info(f"直接请求网页超过 {resolve_html_timeout} 秒，改用浏览器解析")
+            return None
+        with tracer.span('manifest_check', 'resolver', url=url) as span:
+            span['alive'] = check_manifest_alive(url, timeout=remaining)
+        if span['alive']:
+            break
+    else:
+        logger.info(f"网页中的M3U8链接均不可访问: {candidates[:3]}")
+        return None
+
+    title_match = TITLE_IN_HTML.search(body) or OG_TITLE_IN_HTML.search(body)
+    video_title = clean_title(' '.join(title_match.group(1).split())) if title_match else ''
+    if not video_title:
+        video_title = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+
+    time_to_m3u8 = round(time.time() - start, 3)
+    logger.info(f"从网页源码中找到M3U8链接: {url}，耗时 {time_to_m3u8} 秒")
+    return {'url': url, 'title': video_title, 'time_to_m3u8': time_to_m3u8}
+
+
+def get_m3u8_url(web_url, use_cache=True):
+    """获取m3u8链接和视频名称
+
+    依次尝试: 解析缓存 -> 直接请求网页查找 -> Selenium模拟手机访问，
+    返回结果中的 tier 表示由哪一层得到。
+    """
     logger.info(f"开始处理URL: {web_url}")
-    chrome_options = Options()
-    chrome_bin = None
-    chromedriver_path = None
-
-    # Docker 环境特定设置
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--headless=new')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-
-    # 检测运行环境
-    is_docker = os.path.exists('/.dockerenv')
-    logger.info(f"运行环境: {'Docker' if is_docker else '本地'}")
-
-    if is_docker:
-        # Docker 环境使用环境变量中的浏览器
-        chrome_bin = os.getenv('CHROME_BIN')
-        chromedriver_path = os.getenv('CHROMEDRIVER_PATH')
-
-        if not chrome_bin or not os.path.exists(chrome_bin):
-            logger.info("Google Chrome 不存在，尝试使用 Chromium")
-            chrome_bin = os.getenv('CHROMIUM_BIN')
-            chromedriver_path = os.getenv('CHROMIUM_DRIVER_PATH')
-
-        if not chrome_bin or not os.path.exists(chrome_bin):
-            logger.error(f"Docker环境中未找到可用的浏览器")
-            raise Exception("未找到可用的浏览器")
+    tracer = Tracer('resolver', enabled=trace_enabled)
+    with tracer.span('resolve', 'resolver', web_url=web_url) as span:
+        result = resolve_tiers(web_url, use_cache, tracer)
+        span['tier'] = result['tier'] if result else None
+    if result:
+        try:
+            tracer.save(resolve_trace_path(trace_dir, result['url']))
+        except OSError as e:
+            logger.warning(f"保存解析时间线失败: {e}")
+    return result
+
+
+def resolve_tiers(web_url, use_cache, tracer):
+    if use_cache:
+        with tracer.span('cache_lookup', 'resolver') as span:
+            cached = resolve_cache.get(web_url)
+            span['hit'] = bool(cached)
+        if cached:
+            logger.info(f"命中解析缓存: {cached['url']}")
+            return {'url': cached['url'], 'title': cached['title'], 'time_to_m3u8': None,
+                    'cache_hit': True, 'tier': 'cache'}
+
+    result = resolve_from_html(web_url, tracer)
+    if result:
+        result['tier'] = 'html'
     else:
-        # 本地环境自动检测浏览器
+        logger.info("网页源码中未找到M3U8链接，使用浏览器解析")
         try:
-            from webdriver_manager.chrome import ChromeDriverManager
-
-            # 尝试查找本地 Chrome 或 Chromium
-            if os.path.exists('/usr/bin/google-chrome'):
-                chrome_bin = '/usr/bin/google-chrome'
-            elif os.path.exists('/usr/bin/chromium'):
-                chrome_bin = '/usr/bin/chromium'
-            elif os.path.exists('C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe'):
-                chrome_bin = 'C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe'
-            elif os.path.exists('/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'):
-                chrome_bin = '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'
-            else:
-                chrome_bin = None
-                logger.warning("未找到本地Chrome/Chromium，将使用系统默认浏览器")
-
-            # 尝试使用缓存的 ChromeDriver
-            cache_path = os.path.join(os.path.expanduser("~"), ".wdm", "drivers.json")
-            if os.path.exists(cache_path):
-                try:
-                    with open(cache_path, 'r') as f:
-                        cache = json.load(f)
-                        for driver in cache.get('chrome', {}).values():
-                            driver_path = driver.get('binary_path')
-                            if driver_path and os.path.exists(driver_path):
-                                chromedriver_path = driver_path
-                                logger.info(f"使用缓存的ChromeDriver: {chromedriver_path}")
-                                break
-                except Exception as e:
-                    logger.warning(f"读取缓存失败: {str(e)}")
-
-            # 如果没有找到缓存的驱动，尝试下载
-            if not chromedriver_path:
-                try:
-                    chromedriver_path = ChromeDriverManager().install()
-                    logger.info(f"下载新的ChromeDriver: {chromedriver_path}")
-                except requests.exceptions.ConnectionError:
-                    logger.error("网络连接失败，无法下载ChromeDriver")
-                    raise Exception("网络连接失败，请检查网络或手动下载ChromeDriver")
-                except Exception as e:
-                    logger.error(f"下载ChromeDriver失败: {str(e)}")
-                    raise
-
+            # 借出浏览器的耗时包括等待空闲浏览器和按需启动浏览器
+            lease_start = time.time()
+            with browser_pool.lease() as driver:
+                tracer.add('browser_lease', 'resolver', lease_start, time.time() - lease_start)
+                result = resolve_with_driver(driver, web_url, tracer)
         except Exception as e:
-            logger.error(f"本地环境配置失败: {str(e)}")
-            raise Exception(f"浏览器配置失败: {str(e)}")
-
-    # 确保 chromedriver_path 已设置
-    if not chromedriver_path:
-        raise Exception("ChromeDriver 路径未设置")
+            logger.error(f"Selenium错误: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
+            raise
+        if result:
+            result['tier'] = 'browser'
+
+    if result:
+        resolve_cache.put(web_url, result)
+        result['cache_hit'] = False
+    return result
+
+
+def find_m3u8_in_logs(driver):
+    """读取自上次读取以来新增的网络事件，返回其中的m3u8链接"""
+    m3u8_urls = []
+    for entry in driver.get_log('performance'):
+        try:
+            log_data = json.loads(entry['message'])['message']
+            if (
+                    'Network.requestWillBeSent' in log_data['method']
+                    and 'm3u8' in log_data['params']['request']['url'].lower()
+            ):
+                url = log_data['params']['request']['url']
+                if url.startswith('http') and '.m3u8' in url:
+                    logger.info(f"捕获到M3U8链接: {url}")
+                    m3u8_urls.append(url)
+        except Exception as e:
+            logger.error(f"解析日志时出错: {str(e)}")
+            continue
+    return m3u8_urls
 
-    logger.info(f"使用浏览器: {chrome_bin if chrome_bin else '系统默认'}")
-    if chrome_bin:
-        chrome_options.binary_location = chrome_bin
 
-    # 启用性能日志
-    chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+def wait_for_m3u8(driver, until):
+    """持续监听网络事件，捕获到第一个m3u8请求立即返回，到达截止时间返回 None"""
+    while True:
+        m3u8_urls = find_m3u8_in_logs(driver)
+        if m3u8_urls:
+            return m3u8_urls[0]
+        if time.time() >= until:
+            return None
+        time.sleep(min(resolve_poll_interval, max(0, until - time.time())))
+
+
+def trigger_playback(driver):
+    """依次尝试触发视频播放的动作，每次产出动作名称"""
+    from selenium.webdriver.common.by import By
+
+    # 常见的视频播放器选择器
+    video_selectors = [
+        "video",  # HTML5 视频标签
+        ".video-player",  # 常见的视频播放器类名
+        "#player",  # 播放器ID
+        ".player",  # 播放器类名
+        ".play-button",  # 播放按钮
+        "[class*='play']",  # 包含play的类名
+        "[id*='player']",  # 包含player的ID
+    ]
+    for selector in video_selectors:
+        try:
+            elements = driver.find_elements(By.CSS_SELECTOR, selector)
+            if not elements:
+                continue
+            logger.info(f"找到视频元素: {selector}")
+            driver.execute_script("arguments[0].click();", elements[0])
+            yield selector
+        except Exception as e:
+            logger.debug(f"尝试选择器 {selector} 失败: {str(e)}")
+
+    # 尝试执行一些常见的视频初始化函数
+    init_scripts = [
+        "if(typeof player !== 'undefined') player.play();",
+        "document.querySelector('video')?.play();",
+        "document.querySelector('[class*=\"play\"]')?.click();",
+    ]
+    for script in init_scripts:
+        try:
+            driver.execute_script(script)
+            yield script
+        except Exception as e:
+            logger.debug(f"执行脚本失败: {str(e)}")
 
-    # 设置移动设备模拟
-    mobile_emulation = {
-        "deviceMetrics": {"width": 375, "height": 812, "pixelRatio": 3.0},
-        "userAgent": "Mozilla/5.0 (iPhone; CPU iPhone OS 15_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.0 Mobile/15E148 Safari/604.1"
-    }
-    chrome_options.add_experimental_option("mobileEmulation", mobile_emulation)
 
-    try:
-        logger.info(f"使用驱动: {chromedriver_path}")
-        service = Service(chromedriver_path)
-        driver = webdriver.Chrome(service=service, options=chrome_options)
+def resolve_with_driver(driver, web_url, tracer):
+    """在借出的浏览器会话中访问页面并捕获m3u8链接
 
-        # 启用性能日志
-        driver.execute_cdp_cmd('Network.enable', {})
-        driver.execute_cdp_cmd('Performance.enable', {})
+    网络事件一到就检查，整个解析过程只受 RESOLVE_TIMEOUT 一个总截止时间约束。
+    """
+    start = time.time()
+    deadline = start + resolve_timeout
 
-        # 访问页面
-        logger.info(f"开始访问页面: {web_url}")
+    # 访问页面，浏览器以 page_load_strategy=none 启动，不等待页面加载完成
+    logger.info(f"开始访问页面: {web_url}")
+    with tracer.span('page_load', 'resolver'):
         driver.get(web_url)
 
-        # 等待页面加载
-        logger.info("等待页面加载...")
-        time.sleep(10)
-
-        def check_for_m3u8():
-            """检查网络日志中是否有m3u8链接"""
-            logs = driver.get_log('performance')
-            m3u8_urls = []
-            for entry in logs:
-                try:
-                    log_data = json.loads(entry['message'])['message']
-                    if (
-                            'Network.requestWillBeSent' in log_data['method']
-                            and 'm3u8' in log_data['params']['request']['url'].lower()
-                    ):
-                        url = log_data['params']['request']['url']
-                        if url.startswith('http') and '.m3u8' in url:
-                            logger.info(f"捕获到M3U8链接: {url}")
-                            m3u8_urls.append(url)
-                except Exception as e:
-                    logger.error(f"解析日志时出错: {str(e)}")
-                    continue
-            return m3u8_urls
-
-        # 第一次检查m3u8链接
-        m3u8_urls = check_for_m3u8()
-
-        # 如果没有找到m3u8链接，尝试触发视频播放
-        if not m3u8_urls:
-            logger.info("未找到M3U8链接，尝试触发视频播放...")
-            try:
-                # 尝试点击视频播放按钮或视频区域
-                from selenium.webdriver.common.by import By
-                from selenium.webdriver.support.ui import WebDriverWait
-                from selenium.webdriver.support import expected_conditions as EC
-
-                # 常见的视频播放器选择器
-                video_selectors = [
-                    "video",  # HTML5 视频标签
-                    ".video-player",  # 常见的视频播放器类名
-                    "#player",  # 播放器ID
-                    ".player",  # 播放器类名
-                    ".play-button",  # 播放按钮
-                    "[class*='play']",  # 包含play的类名
-                    "[id*='player']",  # 包含player的ID
-                ]
-
-                # 尝试查找并点击视频元素
-                for selector in video_selectors:
-                    try:
-                        element = WebDriverWait(driver, 3).until(
-                            EC.presence_of_element_located((By.CSS_SELECTOR, selector))
-                        )
-                        logger.info(f"找到视频元素: {selector}")
-                        # 尝试点击元素
-                        driver.execute_script("arguments[0].click();", element)
-                        # 等待可能的m3u8请求
-                        time.sleep(3)
-                        # 再次检查m3u8链接
-                        m3u8_urls = check_for_m3u8()
-                        if m3u8_urls:
-                            break
-                    except Exception as e:
-                        logger.debug(f"尝试选择器 {selector} 失败: {str(e)}")
-                        continue
-
-                # 如果还是没有找到，尝试执行一些常见的视频初始化函数
-                if not m3u8_urls:
-                    logger.info("尝试执行视频初始化函数...")
-                    init_scripts = [
-                        "if(typeof player !== 'undefined') player.play();",
-                        "document.querySelector('video')?.play();",
-                        "document.querySelector('[class*=\"play\"]')?.click();",
-                    ]
-                    for script in init_scripts:
-                        try:
-                            driver.execute_script(script)
-                            time.sleep(3)
-                            m3u8_urls = check_for_m3u8()
-                            if m3u8_urls:
-                                break
-                        except Exception as e:
-                            logger.debug(f"执行脚本失败: {str(e)}")
-                            continue
-
-            except Exception as e:
-                logger.error(f"触发视频播放失败: {str(e)}")
-
-        # 获取视频标题
-        video_title = ""
+    # 先被动等待页面自己发起m3u8请求
+    with tracer.span('passive_wait', 'resolver') as span:
+        m3u8_url = wait_for_m3u8(driver, min(deadline, start + resolve_passive_wait))
+        span['found'] = bool(m3u8_url)
+
+    # 如果没有找到m3u8链接，尝试触发视频播放
+    if not m3u8_url:
+        logger.info("未找到M3U8链接，尝试触发视频播放...")
         try:
-            # 获取页面标题作为视频名称
-            video_title = driver.title
-            # 清理标题中的特殊字符
-            import re
-            video_title = re.sub(r'[\\/:*?"<>|]', '_', video_title)
-            logger.info(f"获取到视频标题: {video_title}")
+            action_start = time.time()
+            for action in trigger_playback(driver):
+                with tracer.span('action_wait', 'resolver', action=action) as span:
+                    m3u8_url = wait_for_m3u8(driver, min(deadline, time.time() + resolve_action_wait))
+                    span['found'] = bool(m3u8_url)
+                if m3u8_url or time.time() >= deadline:
+                    break
         except Exception as e:
-            logger.error(f"获取视频标题失败: {str(e)}")
-            video_title = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            logger.error(f"触发视频播放失败: {str(e)}")
+        finally:
+            tracer.add('trigger_playback', 'resolver', action_start, time.time() - action_start)
 
-        # 如果找到了m3u8链接，返回链接和标题
-        if m3u8_urls:
-            logger.info(f"成功找到M3U8链接: {m3u8_urls[0]}")
-            return {'url': m3u8_urls[0], 'title': video_title}
+    # 所有动作都试过后，用剩余时间继续等待
+    if not m3u8_url:
+        with tracer.span('final_wait', 'resolver') as span:
+            m3u8_url = wait_for_m3u8(driver, deadline)
+            span['found'] = bool(m3u8_url)
 
-        logger.warning("未找到M3U8链接")
-        return None
+    time_to_m3u8 = round(time.time() - start, 3) if m3u8_url else None
 
+    # 获取视频标题
+    video_title = ""
+    title_start = time.time()
+    try:
+        # 页面可能还未加载完，短暂等待标题出现
+        title_deadline = min(deadline, time.time() + 2)
+        video_title = driver.title
+        while not video_title and time.time() < title_deadline:
+            time.sleep(resolve_poll_interval)
+            video_title = driver.title
+        # 清理标题中的特殊字符
+        video_title = clean_title(video_title)
+        logger.info(f"获取到视频标题: {video_title}")
     except Exception as e:
-        logger.error(f"Selenium错误: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
-        raise
-    finally:
-        try:
-            driver.quit()
-        except Exception as e:
-            logger.error(f"关闭driver时出错: {str(e)}")
-            pass
+        logger.error(f"获取视频标题失败: {str(e)}")
+        video_title = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    tracer.add('title', 'resolver', title_start, time.time() - title_start)
+
+    # 如果找到了m3u8链接，返回链接和标题
+    if m3u8_url:
+        logger.info(f"成功找到M3U8链接: {m3u8_url}，耗时 {time_to_m3u8} 秒")
+        return {'url': m3u8_url, 'title': video_title, 'time_to_m3u8': time_to_m3u8}
+
+    logger.warning(f"未找到M3U8链接，耗时 {time.time() - start:.2f} 秒")
+    return None
 
 
 @app.route('/')
@@ -307,6 +427,8 @@ def index():
 @app.route('/get_m3u8', methods=['POST'])
 def get_m3u8():
     web_url = request.json.get('web_url')
+    # refresh 为 true 时跳过缓存重新解析
+    refresh = bool(request.json.get('refresh'))
     if not web_url:
         logger.warning("未提供网页URL")
         return jsonify({'success': False, 'error': '请输入网页URL'})
@@ -314,13 +436,16 @@ def get_m3u8():
     logger.info(f"收到请求，URL: {web_url}")
 
     try:
-        result = get_m3u8_url(web_url)
+        result = get_m3u8_url(web_url, use_cache=not refresh)
         if not result:
             return jsonify({'success': False, 'error': '未找到M3U8链接'})
         return jsonify({
             'success': True,
             'm3u8_url': result['url'],
-            'video_title': result['title']
+            'video_title': result['title'],
+            'time_to_m3u8': result['time_to_m3u8'],
+            'cache_hit': result['cache_hit'],
+            'tier': result['tier']
         })
     except Exception as e:
         error_msg = str(e)
@@ -328,96 +453,605 @@ def get_m3u8():
         return jsonify({'success': False, 'error': f'获取M3U8失败: {error_msg}'})
 
 
-def download_worker(m3u8_url, video_title):
-    """异步下载工作函数"""
+def job_view(job):
+    """返回可序列化的任务状态"""
+    postprocess = None
+    if job['postprocess_status']:
+        postprocess = {'status': job['postprocess_status'], **(job['postprocess'] or {})}
+    return {
+        'job_id': job['id'],
+        'm3u8_url': job['m3u8_url'],
+        'video_title': job['video_title'],
+        'mode': job['mode'],
+        'status': job['status'],  # queued, downloading, completed, failed
+        'progress': job['progress'],
+        'current_segments': job['current_segments'],
+        'total_segments': job['total_segments'],
+        'workers': job['workers'],
+        'error': job['error'],
+        'metrics': job['metrics'],
+        # 下载进程上报的各分片主机当前并发上限
+        'concurrency': job['concurrency'],
+        # 直播录制时的已录制时长和最新媒体序号
+        'live': job['live'],
+        'output_file': job['output_file'],
+        # 后处理状态（queued / running / completed / failed）及结果
+        'postprocess': postprocess,
+        'created_time': job['created_time']
+    }
+
+
+def create_job(m3u8_url, video_title, mode=None, headers=None, cookies=None):
+    """创建下载任务并放入等待队列"""
+    job = job_store.create(m3u8_url, video_title, mode or download_mode, headers, cookies)
+    wake_scheduler()
+    logger.info(f"任务 {job['id']} 已加入队列，排队中: {job_store.count_by_status().get('queued', 0)}")
+    return job
+
+
+def notify_progress():
+    """任务状态已变化，唤醒本进程中等待进度的 SSE 连接；其他进程的连接靠轮询发现"""
+    with progress_cond:
+        progress_cond.notify_all()
+
+
+def wake_scheduler():
+    with scheduler_cond:
+        scheduler_cond.notify_all()
+
+
+def handle_progress_event(job, line):
+    """处理下载进程通过标准输出上报的一行进度事件"""
     try:
-        logger.info(f"开始异步下载M3U8: {m3u8_url}")
-        logger.info(f"视频标题: {video_title}")
-        
-        # 更新下载状态
-        download_status.update({
-            'status': 'downloading',
-            'progress': 0,
-            'current_segments': 0,
-            'total_segments': 0,
-            'error': None
-        })
-        
-        # 删除可能存在的旧进度文件
-        progress_file = os.path.join(output_dir, 'download_progress.json')
-        if os.path.exists(progress_file):
-            try:
-                os.remove(progress_file)
-            except:
-                pass
-        
+        event = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(event, dict) or event.get('event') != 'progress':
+        return None
+    fields = {key: event[key] for key in ('progress', 'current_segments', 'total_segments', 'error',
+                                          'metrics', 'concurrency', 'live')
+              if event.get(key) is not None}
+    # 完成时（以及直播录制中止但已保存内容时）登记输出文件，与是否启用后处理无关
+    if event.get('output_file'):
+        fields['output_file'] = os.path.abspath(event['output_file'])
+    job_store.update(job['id'], **fields)
+    notify_progress()
+    return event
+
+
+def stop_downloader(pid):
+    """向本机上的下载进程发送 SIGTERM，返回是否发送成功"""
+    if not is_downloader_process(pid):
+        return False
+    try:
+        os.kill(pid, signal.SIGTERM)
+        return True
+    except OSError:
+        return False
+
+
+def scheduler_loop():
+    """任务调度器：在任务数和分片并发数的全局上限内依次启动排队的任务
+
+    每个 Web 工作进程各运行一个调度器，通过任务状态库原子地领取任务；
+    本进程内提交或结束任务时立即唤醒，其他进程的变化靠定时轮询发现。
+    """
+    last_heartbeat = 0
+    while True:
+        job = None
+        try:
+            if time.time() - last_heartbeat >= scheduler_heartbeat_interval:
+                job_store.heartbeat()
+                for pid in job_store.recover():
+                    logger.warning(f"结束遗留的下载进程 {pid}")
+                    stop_downloader(pid)
+                last_heartbeat = time.time()
+            job = job_store.claim_next(max_concurrent_jobs, max_segments_in_flight, download_workers)
+        except sqlite3.Error as e:
+            logger.error(f"任务调度失败: {str(e)}")
+        if job is None:
+            with scheduler_cond:
+                scheduler_cond.wait(timeout=scheduler_poll_interval)
+            continue
+        notify_progress()
+        thread = threading.Thread(target=download_worker, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+
+def wake_postprocessor():
+    with postprocess_cond:
+        postprocess_cond.notify_all()
+
+
+def get_postprocess_executor():
+    global postprocess_executor
+    with postprocess_executor_lock:
+        if postprocess_executor is None:
+            # 用 fork 启动子进程，不重新导入 Web 应用；子进程只运行 postprocess 中的函数
+            postprocess_executor = ProcessPoolExecutor(max_workers=postprocess_workers,
+                                                       mp_context=multiprocessing.get_context('fork'))
+        return postprocess_executor
+
+
+def reset_postprocess_executor():
+    """子进程异常退出后进程池不可再用，下次使用时重建"""
+    global postprocess_executor
+    with postprocess_executor_lock:
+        executor, postprocess_executor = postprocess_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def finish_postprocess(job, future):
+    """进程池中的后处理结束后记录结果"""
+    started = job['postprocess'].get('started_at') if job['postprocess'] else None
+    try:
+        result = future.result()
+        status = 'completed'
+        logger.info(f"任务 {job['id']} 后处理完成: 时长 {result['duration']} 秒，faststart {result['faststart']}，"
+                    f"缩略图 {result['thumbnail']}")
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            reset_postprocess_executor()
+        status = 'failed'
+        result = {'error': str(e) or type(e).__name__}
+        logger.error(f"任务 {job['id']} 后处理失败: {result['error']}")
+    result['expected_duration'] = (job['postprocess'] or {}).get('expected_duration')
+    if started:
+        result['elapsed_seconds'] = round(time.time() - started, 3)
+    try:
+        job_store.finish_postprocess(job['id'], status, result)
+    except sqlite3.Error as e:
+        logger.error(f"记录任务 {job['id']} 的后处理结果失败: {str(e)}")
+    wake_postprocessor()
+
+
+def postprocess_loop():
+    """后处理调度器：在 POSTPROCESS_WORKERS 的全局上限内领取待处理的任务，交给本进程的进程池执行
+
+    与下载调度器一样通过任务状态库原子地领取，工作进程退出后它名下的后处理由心跳检查重新排队。
+    """
+    while True:
+        job = None
+        try:
+            job = job_store.claim_postprocess(postprocess_workers)
+        except sqlite3.Error as e:
+            logger.error(f"后处理调度失败: {str(e)}")
+        if job is None:
+            with postprocess_cond:
+                postprocess_cond.wait(timeout=scheduler_poll_interval)
+            continue
+        postprocess = job['postprocess'] or {}
+        postprocess['started_at'] = time.time()
+        job['postprocess'] = postprocess
+        logger.info(f"任务 {job['id']} 开始后处理: {job['output_file']}")
+        try:
+            future = get_postprocess_executor().submit(postprocess_file, job['output_file'],
+                                                       postprocess.get('expected_duration'), thumbnail_width)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                reset_postprocess_executor()
+            logger.error(f"提交后处理失败: {str(e)}")
+            job_store.finish_postprocess(job['id'], 'failed', {'error': str(e)})
+            continue
+        future.add_done_callback(lambda future, job=job: finish_postprocess(job, future))
+
+
+def start_profiler(job_id, pid):
+    """用 py-spy 附加到下载进程采样，下载进程退出后 py-spy 写出分析文件并自行退出"""
+    if not shutil.which('py-spy'):
+        logger.warning("已开启 PROFILE_DOWNLOADER，但未找到 py-spy，跳过性能分析")
+        return None
+    os.makedirs(trace_dir, exist_ok=True)
+    try:
+        return subprocess.Popen(
+            ['py-spy', 'record', '--pid', str(pid), '--rate', str(profile_rate), '--format', 'speedscope',
+             '--output', profile_path(job_id), '--nonblocking'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+    except OSError as e:
+        logger.warning(f"启动 py-spy 失败: {e}")
+        return None
+
+
+def profile_path(job_id):
+    return os.path.join(trace_dir, f"{job_id}.speedscope.json")
+
+
+def record_job_trace(job, started, finished, status):
+    """在下载进程写出的时间线上补充排队和下载进程整体耗时"""
+    path = job_trace_path(trace_dir, job['id'])
+    spans, dropped = load_spans(path)
+    tracer = Tracer('app')
+    try:
+        created = datetime.datetime.strptime(job['created_time'], '%Y-%m-%d %H:%M:%S').timestamp()
+        # 创建时间只精确到秒
+        tracer.add('queued', 'job', created, max(0.0, started - created))
+    except (TypeError, ValueError):
+        pass
+    tracer.add('downloader_process', 'job', started, finished - started, status=status)
+    try:
+        save_spans(path, spans + tracer.spans, dropped)
+        prune_traces(trace_dir, max_job_history)
+    except OSError as e:
+        logger.warning(f"保存任务 {job['id']} 的时间线失败: {e}")
+
+
+def download_worker(job):
+    """异步下载工作函数：启动下载进程并等待其结束"""
+    status = 'failed'
+    error = None
+    started = time.time()
+    profiler = None
+    try:
+        logger.info(f"任务 {job['id']} 开始异步下载M3U8: {job['m3u8_url']}")
+        logger.info(f"视频标题: {job['video_title']}")
+        logger.info(f"下载模式: {job['mode']}，分片并发数: {job['workers']}")
+
         # 设置环境变量
         env = os.environ.copy()
-        env['M3U8_URL'] = m3u8_url
-        env['VIDEO_TITLE'] = video_title
-        
-        # 启动下载进程
+        env['M3U8_URL'] = job['m3u8_url']
+        env['VIDEO_TITLE'] = job['video_title']
+        env['DOWNLOAD_MODE'] = job['mode']
+        env['DOWNLOAD_WORKERS'] = str(job['workers'])
+        env['MAX_BANDWIDTH'] = str(max_bandwidth // max_concurrent_jobs)
+        env['HTTP_HEADERS'] = json.dumps(job['headers'])
+        env['HTTP_COOKIES'] = json.dumps(job['cookies'])
+        if trace_enabled:
+            env['TRACE_FILE'] = job_trace_path(trace_dir, job['id'])
+
+        # 启动下载进程，进度事件从标准输出的管道读取；日志已写入文件，不接管标准错误
         process = subprocess.Popen(
             ['python', 'download_m3u8.py'],
             env=env,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            encoding='utf-8'
         )
-        
-        download_status['process'] = process
-        
+        # 记录 pid，任意工作进程都可以据此停止任务
+        job_store.update(job['id'], pid=process.pid)
+        if profile_downloader:
+            profiler = start_profiler(job['id'], process.pid)
+        progress_data = {}
+        for line in process.stdout:
+            progress_data = handle_progress_event(job, line) or progress_data
+        process.wait()
+
+        # 上报完成时输出文件已生成；直播录制收尾后再收到的停止信号可能让退出码非零
+        if progress_data.get('status') == 'completed':
+            status = 'completed'
+            if postprocess_workers > 0 and progress_data.get('output_file'):
+                # 后处理另行排队，不占用下载名额
+                job_store.queue_postprocess(job['id'], os.path.abspath(progress_data['output_file']),
+                                            progress_data.get('duration'))
+                wake_postprocessor()
+        else:
+            error = progress_data.get('error') or "下载进程异常退出"
+        logger.info(f"任务 {job['id']} 结束，状态: {status}")
+
     except Exception as e:
-        download_status['status'] = 'failed'
-        download_status['error'] = str(e)
+        error = str(e)
         logger.error(f"下载异常: {str(e)}")
+    finally:
+        if profiler:
+            try:
+                profiler.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                profiler.kill()
+        if trace_enabled:
+            record_job_trace(job, started, time.time(), status)
+        job_store.finish(job['id'], status, error, progress=100 if status == 'completed' else None)
+        job_store.trim(max_job_history)
+        notify_progress()
+        wake_scheduler()
 
 
 @app.route('/execute', methods=['POST'])
 def execute():
     m3u8_url = request.json.get('m3u8_url')
     video_title = request.json.get('video_title', '')
+    # 可选: native(默认，并发分片下载) 或 ffmpeg(回退模式)
+    mode = request.json.get('mode')
+    # 可选: 下载时附加的请求头和 cookie，如 Referer
+    headers = request.json.get('headers') or {}
+    cookies = request.json.get('cookies') or {}
 
     if not m3u8_url:
         logger.warning("未提供M3U8 URL")
         return jsonify({'success': False, 'error': 'M3U8 URL is required'})
 
+    if mode and mode not in ('native', 'ffmpeg'):
+        return jsonify({'success': False, 'error': f'不支持的下载模式: {mode}'})
+
+    if not isinstance(headers, dict) or not isinstance(cookies, dict):
+        return jsonify({'success': False, 'error': 'headers 和 cookies 必须是对象'})
+
     try:
-        # 如果已经有下载任务在进行中，返回错误
-        if download_status['status'] == 'downloading':
-            return jsonify({'success': False, 'error': '已有下载任务在进行中'})
-        
-        # 重置下载状态
-        download_status['progress'] = 0
-        download_status['current_segments'] = 0
-        download_status['total_segments'] = 0
-        download_status['status'] = 'idle'
-        download_status['error'] = None
-        
-        # 创建新线程执行下载
-        thread = threading.Thread(
-            target=download_worker,
-            args=(m3u8_url, video_title)
-        )
-        thread.daemon = True
-        thread.start()
-        
-        return jsonify({'success': True})
-        
+        job = create_job(m3u8_url, video_title, mode, headers, cookies)
+        return jsonify({'success': True, 'job_id': job['id'], 'status': job['status']})
+
     except Exception as e:
         logger.error(f"启动下载失败: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
 
+def is_m3u8_url(url):
+    return urlsplit(url).path.lower().endswith('.m3u8')
+
+
+def wake_batch_resolver():
+    with batch_cond:
+        batch_cond.notify_all()
+
+
+def process_batch_item(item):
+    """解析批量任务中的一项并加入下载队列，每一项互不影响"""
+    batch_id, idx, url, title = item['batch_id'], item['idx'], item['url'], item['title']
+    options = item['options']
+    try:
+        if is_m3u8_url(url):
+            m3u8_url = url
+            tier = None
+        else:
+            result = get_m3u8_url(url, use_cache=not options.get('refresh'))
+            if not result:
+                job_store.update_batch_item(batch_id, idx, status='failed', error='未找到M3U8链接', owner=None)
+                return
+            m3u8_url = result['url']
+            tier = result['tier']
+            title = title or result['title']
+        job = job_store.queue_batch_item(batch_id, idx, m3u8_url, title, tier, options.get('mode') or download_mode,
+                                         options.get('headers'), options.get('cookies'))
+        wake_scheduler()
+        logger.info(f"批量任务 {batch_id} 第 {idx + 1} 项已加入队列，任务 {job['id']}")
+    except Exception as e:
+        logger.error(f"批量任务 {batch_id} 第 {idx + 1} 项失败: {str(e)}")
+        try:
+            job_store.update_batch_item(batch_id, idx, status='failed', error=str(e), owner=None)
+        except sqlite3.Error as e:
+            logger.error(f"记录批量任务 {batch_id} 第 {idx + 1} 项的结果失败: {str(e)}")
+    finally:
+        wake_batch_resolver()
+
+
+def batch_loop():
+    """批量解析调度器：在 BATCH_RESOLVE_WORKERS 的全局上限内领取待解析的项，交给本进程的线程池解析
+
+    与下载调度器一样通过任务状态库原子地领取，工作进程退出后它名下解析中的项由心跳检查重新排队。
+    """
+    while True:
+        item = None
+        try:
+            item = job_store.claim_batch_item(batch_resolve_workers)
+        except sqlite3.Error as e:
+            logger.error(f"批量解析调度失败: {str(e)}")
+        if item is None:
+            with batch_cond:
+                batch_cond.wait(timeout=scheduler_poll_interval)
+            continue
+        batch_executor.submit(process_batch_item, item)
+
+
+def batch_view(batch):
+    """汇总批量任务各项的状态；已入队的项以下载任务的状态为准，任务记录已清理时以项中记下的最终状态为准"""
+    items = []
+    counts = {}
+    for item in batch['items']:
+        status = item['job_status'] or item['status']
+        progress = item['job_progress']
+        if progress is None:
+            progress = 100 if status == 'completed' else 0
+        counts[status] = counts.get(status, 0) + 1
+        items.append({
+            'url': item['url'],
+            'title': item['title'],
+            'status': status,  # pending, resolving, queued, downloading, completed, failed
+            'm3u8_url': item['m3u8_url'],
+            'tier': item['tier'],
+            'job_id': item['job_id'],
+            'progress': progress,
+            'error': item['error'] or item['job_error']
+        })
+    total = len(items)
+    finished = counts.get('completed', 0) + counts.get('failed', 0)
+    return {
+        'batch_id': batch['id'],
+        'created_time': batch['created_time'],
+        'total': total,
+        'counts': counts,
+        'finished': finished == total,
+        'progress': round(sum(item['progress'] for item in items) / total, 2) if total else 0,
+        'items': items
+    }
+
+
+@app.route('/batch', methods=['POST'])
+def submit_batch():
+    """批量提交网页或 m3u8 地址：并发解析（受 BATCH_RESOLVE_WORKERS 限制），解析完成的项立即加入下载队列
+
+    items 中每一项可以是地址字符串，也可以是 {"url": ..., "title": ...}；
+    mode、headers、cookies 和 refresh 对所有项生效。
+    """
+    items = request.json.get('items') or []
+    mode = request.json.get('mode')
+    headers = request.json.get('headers') or {}
+    cookies = request.json.get('cookies') or {}
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'items 必须是非空列表'})
+    if len(items) > batch_max_items:
+        return jsonify({'success': False, 'error': f'单次最多提交 {batch_max_items} 项'})
+    if mode and mode not in ('native', 'ffmpeg'):
+        return jsonify({'success': False, 'error': f'不支持的下载模式: {mode}'})
+    if not isinstance(headers, dict) or not isinstance(cookies, dict):
+        return jsonify({'success': False, 'error': 'headers 和 cookies 必须是对象'})
+
+    entries = []
+    for raw in items:
+        item = {'url': raw} if isinstance(raw, str) else raw
+        url = (item.get('url') or '').strip() if isinstance(item, dict) else ''
+        if not url.startswith(('http://', 'https://')):
+            return jsonify({'success': False, 'error': f'无效的地址: {raw}'})
+        entries.append((url, clean_title(item.get('title') or '')))
+
+    options = {'mode': mode, 'headers': headers, 'cookies': cookies, 'refresh': bool(request.json.get('refresh'))}
+    batch_id = job_store.create_batch(entries, options)
+    job_store.trim_batches(max_job_history)
+    wake_batch_resolver()
+    logger.info(f"批量任务 {batch_id} 已提交，共 {len(entries)} 项")
+    return jsonify({'success': True, 'batch_id': batch_id, 'total': len(entries)})
+
+
+@app.route('/batch/<batch_id>')
+def batch_status(batch_id):
+    batch = job_store.get_batch(batch_id)
+    if batch is None:
+        return jsonify({'success': False, 'error': f'批量任务不存在: {batch_id}'}), 404
+    return jsonify({'success': True, **batch_view(batch)})
+
+
+@app.route('/stop', methods=['POST'])
+def stop_job():
+    """停止任务：排队中的任务直接取消；运行中的任务发送 SIGTERM，直播录制会保存已录制的内容"""
+    job_id = request.json.get('job_id')
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'任务不存在: {job_id}'})
+    if job_store.cancel_queued(job_id, '任务已取消'):
+        notify_progress()
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'failed'})
+    if job['status'] == 'downloading':
+        if not job['pid']:
+            return jsonify({'success': False, 'error': '任务正在启动，请稍后重试'})
+        logger.info(f"停止任务 {job_id}")
+        if not stop_downloader(job['pid']):
+            return jsonify({'success': False, 'error': '下载进程不在本机或已退出'})
+    return jsonify({'success': True, 'job_id': job_id, 'status': job['status']})
+
+
+@app.route('/jobs')
+def list_jobs():
+    """列出队列中及最近结束的下载任务"""
+    job_list = [job_view(job) for job in job_store.list()]
+    return jsonify({'success': True, 'jobs': job_list})
+
+
+def format_size(size):
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.2f} KB"
+    elif size < 1024 * 1024 * 1024:
+        return f"{size / (1024 * 1024):.2f} MB"
+    else:
+        return f"{size / (1024 * 1024 * 1024):.2f} GB"
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def scan_directory(path):
+    """列出目录内容，每个条目只 stat 一次
+
+    结果按目录的修改时间缓存：增删改名都会改变目录修改时间，
+    写入中的文件大小变化不会，因此缓存另有 LIST_CACHE_TTL 的最长有效期。
+    缓存以绝对路径为键，同一目录的不同写法共用；条目只含名称，路径由调用方按请求的写法拼接。
+    返回 (目录修改时间, 条目列表)。
+    """
+    key = os.path.abspath(path)
+    dir_mtime = os.stat(key).st_mtime_ns
+    now = time.time()
+    with listing_lock:
+        cached = listing_cache.get(key)
+        if cached and cached['dir_mtime'] == dir_mtime and now - cached['scanned_at'] < list_cache_ttl:
+            listing_cache.move_to_end(key)
+            return cached['dir_mtime'], cached['entries']
+
+    entries = []
+    with os.scandir(key) as it:
+        for entry in it:
+            try:
+                stats = entry.stat()
+            except OSError:
+                # 扫描期间被删除的条目
+                continue
+            entries.append({
+                'name': entry.name,
+                'is_dir': stat.S_ISDIR(stats.st_mode),
+                'size': stats.st_size,
+                'ctime': stats.st_ctime,
+                'mtime': stats.st_mtime
+            })
+
+    with listing_lock:
+        listing_cache[key] = {'dir_mtime': dir_mtime, 'scanned_at': now, 'entries': entries}
+        listing_cache.move_to_end(key)
+        while len(listing_cache) > LIST_CACHE_SIZE:
+            listing_cache.popitem(last=False)
+    return dir_mtime, entries
+
+
+def list_artifacts(entries, page_entries):
+    """查询本页视频文件的后处理结果和同名缩略图，返回 {路径: 附加字段}"""
+    names = {item['name'] for item in entries if not item['is_dir']}
+    # 任务库中记录的是绝对路径
+    paths = [os.path.abspath(item['path']) for item in page_entries if not item['is_dir']]
+    try:
+        jobs_by_file = job_store.postprocess_by_files(paths)
+    except sqlite3.Error as e:
+        logger.error(f"查询后处理状态失败: {str(e)}")
+        jobs_by_file = {}
+    artifacts = {}
+    for item in page_entries:
+        if item['is_dir']:
+            continue
+        extra = {}
+        thumbnail_name = os.path.splitext(item['name'])[0] + '.jpg'
+        if thumbnail_name != item['name'] and thumbnail_name in names:
+            extra['thumbnail'] = os.path.join(os.path.dirname(item['path']), thumbnail_name)
+        job = jobs_by_file.get(os.path.abspath(item['path']))
+        if job and job['postprocess_status']:
+            result = job['postprocess'] or {}
+            extra['postprocess'] = {
+                'status': job['postprocess_status'],
+                'duration': result.get('duration'),
+                'faststart': result.get('faststart'),
+                'error': result.get('error'),
+                'job_id': job['id']
+            }
+        if extra:
+            artifacts[item['path']] = extra
+    return artifacts
+
+
 @app.route('/list_files')
 def list_files():
+    """分页列出目录内容
+
+    参数: path，sort(mtime/ctime/name/size，默认 mtime)，order(desc/asc，默认 desc)，
+    page(从 1 开始)，page_size。响应带 ETag，目录未变化时返回 304。
+    """
     # 获取路径参数，如果为空则使用默认输出目录
     path = request.args.get('path')
     if not path:
         path = output_dir
-        logger.info(f"使用默认输出目录: {path}")
 
     logger.info(f"列出目录内容: {path}")
 
+    sort_key = request.args.get('sort', 'mtime')
+    order = request.args.get('order', 'desc')
+    if sort_key not in LIST_SORT_KEYS or order not in ('asc', 'desc'):
+        return jsonify({'success': False, 'error': f'不支持的排序方式: {sort_key} {order}'})
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        page_size = min(max(1, int(request.args.get('page_size', list_page_size))), LIST_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'success': False, 'error': '无效的分页参数'})
+
     # 确保目录存在
     try:
         # 检查路径是否为空或无效
@@ -432,62 +1066,113 @@ def list_files():
         return jsonify({'success': False, 'error': f'创建目录失败: {str(e)}'})
 
     try:
-        files = []
-        for item in os.listdir(path):
-            item_path = os.path.join(path, item)
-            stats = os.stat(item_path)
-
-            # 获取文件类型
-            file_type = '文件夹' if os.path.isdir(item_path) else '文件'
-
-            # 获取文件大小
-            size = stats.st_size
-            if size < 1024:
-                size_str = f"{size} B"
-            elif size < 1024 * 1024:
-                size_str = f"{size / 1024:.2f} KB"
-            elif size < 1024 * 1024 * 1024:
-                size_str = f"{size / (1024 * 1024):.2f} MB"
-            else:
-                size_str = f"{size / (1024 * 1024 * 1024):.2f} GB"
-
-            files.append({
-                'name': item,
-                'path': item_path,
-                'is_dir': os.path.isdir(item_path),
-                'type': file_type,
-                'size': size_str,
-                'created_time': datetime.datetime.fromtimestamp(stats.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
-                'modified_time': datetime.datetime.fromtimestamp(stats.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
-            })
-
-        # 按修改时间倒序排序
-        files.sort(key=lambda x: os.path.getmtime(x['path']), reverse=True)
-
-        return jsonify({
+        dir_mtime, entries = scan_directory(path)
+        reverse = order == 'desc'
+        if sort_key == 'name':
+            ordered = sorted(entries, key=lambda x: x['name'].lower(), reverse=reverse)
+        else:
+            ordered = sorted(entries, key=lambda x: x[sort_key], reverse=reverse)
+        total = len(ordered)
+        start = (page - 1) * page_size
+        # 与下载、播放地址一致，路径按请求中的目录写法拼接
+        page_entries = [{**item, 'path': os.path.join(path, item['name'])}
+                        for item in ordered[start:start + page_size]]
+
+        artifacts = list_artifacts(entries, page_entries)
+        files = [{
+            'name': item['name'],
+            'path': item['path'],
+            'is_dir': item['is_dir'],
+            'type': '文件夹' if item['is_dir'] else '文件',
+            'size': format_size(item['size']),
+            'created_time': format_time(item['ctime']),
+            'modified_time': format_time(item['mtime']),
+            **artifacts.get(item['path'], {})
+        } for item in page_entries]
+
+        response = jsonify({
             'success': True,
             'current_path': os.path.abspath(path),
-            'files': files
+            'files': files,
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'sort': sort_key,
+            'order': order
         })
+        # 内容由目录状态和分页参数决定，不同的页签不同的 ETag
+        signature = json.dumps([os.path.abspath(path), dir_mtime, sort_key, order, page, page_size,
+                                [(item['name'], item['size'], item['mtime']) for item in page_entries],
+                                artifacts], sort_keys=True)
+        response.set_etag(hashlib.sha1(signature.encode('utf-8')).hexdigest())
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"列出文件失败: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
 
+def local_file_path(filepath):
+    """把 URL 中的文件路径转换为本地路径"""
+    # 移除路径中的重复 /app 前缀
+    if filepath.startswith('app/'):
+        filepath = filepath.replace('app/', '', 1)
+    return filepath
+
+
+def serve_file(filepath, as_attachment):
+    """发送文件，支持 Range/206 和条件请求
+
+    SENDFILE_MODE 为 x-sendfile 或 x-accel 时只返回响应头，由前端服务器直接发送文件内容，
+    不占用本进程的线程；否则由 WSGI 服务器的 file_wrapper 发送（gunicorn 下为 sendfile 零拷贝）。
+    """
+    filepath = local_file_path(filepath)
+    if not os.path.isfile(filepath):
+        return jsonify({'success': False, 'error': f'文件不存在: {filepath}'}), 404
+
+    relative = os.path.relpath(os.path.abspath(filepath), os.path.abspath(output_dir))
+    # nginx 只能发送 internal location 映射到的输出目录下的文件
+    use_x_accel = sendfile_mode == 'x-accel' and not relative.startswith('..')
+    response = werkzeug_send_file(
+        filepath, request.environ,
+        mimetype=STREAM_MIMETYPES.get(os.path.splitext(filepath)[1].lower()),
+        as_attachment=as_attachment,
+        use_x_sendfile=sendfile_mode == 'x-sendfile' or use_x_accel,
+        response_class=app.response_class,
+        conditional=True,
+        max_age=None
+    )
+    if use_x_accel and 'X-Sendfile' in response.headers:
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = x_accel_prefix.rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+    return response
+
+
 @app.route('/download/<path:filepath>')
 def download_file(filepath):
     logger.info(f"下载文件: {filepath}")
     try:
-        # 移除路径中的重复 /app 前缀
-        if filepath.startswith('app/'):
-            filepath = filepath.replace('app/', '', 1)
-            logger.info(f"下载文件1: {filepath}")
-        return send_file(filepath, as_attachment=True)
+        return serve_file(filepath, as_attachment=True)
+    except HTTPException:
+        # 416 等由 werkzeug 生成的标准响应
+        raise
     except Exception as e:
         logger.error(f"文件下载失败: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
 
+@app.route('/stream/<path:filepath>')
+def stream_file(filepath):
+    """在浏览器中播放，<video> 拖动进度条时按 Range 请求对应片段"""
+    try:
+        return serve_file(filepath, as_attachment=False)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"文件播放失败: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)})
+
+
 @app.route('/rename', methods=['POST'])
 def rename_file():
     old_path = request.json.get('old_path')
@@ -542,101 +1227,68 @@ def delete_file():
         return jsonify({'success': False, 'error': str(e)})
 
 
+@app.route('/trace/<job_id>')
+def job_trace(job_id):
+    """返回任务的时间线：网页解析、排队、播放列表、每个分片、封装等阶段的开始时间和耗时
+
+    format=chrome 时返回 Chrome trace event 格式，可直接导入 chrome://tracing 或 Perfetto。
+    任务运行中时只有网页解析部分，下载进程结束后才有完整时间线。
+    """
+    job = job_store.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+
+    resolve_spans, _ = load_spans(resolve_trace_path(trace_dir, job['m3u8_url']))
+    job_spans, dropped = load_spans(job_trace_path(trace_dir, job_id))
+    spans = sorted(resolve_spans + job_spans, key=lambda span: span['start'])
+
+    if request.args.get('format') == 'chrome':
+        response = jsonify(to_chrome_trace(spans))
+        response.headers['Content-Disposition'] = f'attachment; filename="trace_{job_id}.json"'
+        return response
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': job['status'],
+        'complete': bool(job_spans),
+        'spans': spans,
+        'dropped_spans': dropped,
+        'summary': summarize(spans),
+        'profile': f"/trace/{job_id}/profile" if os.path.exists(profile_path(job_id)) else None
+    })
+
+
+@app.route('/trace/<job_id>/profile')
+def job_profile(job_id):
+    """下载 py-spy 生成的 speedscope 格式性能分析文件，可在 https://www.speedscope.app 打开"""
+    path = profile_path(job_id)
+    if not job_store.get(job_id) or not os.path.exists(path):
+        return jsonify({'success': False, 'error': '没有该任务的性能分析文件'}), 404
+    return send_file(path, mimetype='application/json', as_attachment=True,
+                     download_name=f"profile_{job_id}.speedscope.json")
+
+
 @app.route('/check_progress')
 def check_progress():
-    """检查下载进度"""
+    """检查下载进度，未指定 job_id 时返回最近提交的任务"""
     try:
-        progress_file = os.path.join(output_dir, 'download_progress.json')
-        
-        # 检查进程状态
-        if download_status['process']:
-            returncode = download_status['process'].poll()
-            
-            # 如果进程已结束且不是正常退出
-            if returncode is not None and returncode != 0:
-                download_status['status'] = 'failed'
-                download_status['error'] = "下载进程异常退出"
-                download_status['process'] = None
-                return jsonify({
-                    'success': True,
-                    'status': 'failed',
-                    'error': "下载进程异常退出"
-                })
-            
-            # 如果进程正在运行但还没有进度文件，返回等待状态
-            if returncode is None and not os.path.exists(progress_file):
-                return jsonify({
-                    'success': True,
-                    'progress': 0,
-                    'current_segments': 0,
-                    'total_segments': 0,
-                    'status': 'downloading',
-                    'error': None
-                })
-        
-        # 读取进度文件
-        if os.path.exists(progress_file):
-            try:
-                with open(progress_file, 'r') as f:
-                    progress_data = json.load(f)
-                    
-                    # 检查进度数据的有效性
-                    if not isinstance(progress_data, dict):
-                        raise ValueError("Invalid progress data format")
-                    
-                    # 更新全局状态
-                    download_status.update(progress_data)
-                    
-                    # 如果状态为完成，添加一个新的状态 'confirmed'
-                    if progress_data['status'] == 'completed':
-                        download_status['status'] = 'confirmed'
-                        if download_status['process']:
-                            download_status['process'] = None
-                        # # 删除进度文件
-                        # try:
-                        #     os.remove(progress_file)
-                        # except:
-                        #     pass
-                    elif progress_data['status'] == 'failed':
-                        if download_status['process']:
-                            download_status['process'] = None
-                        # 删除进度文件
-                        # try:
-                        #     os.remove(progress_file)
-                        # except:
-                        #     pass
-                        #
-            except Exception as e:
-                logger.error(f"读取进度文件失败: {str(e)}")
-                if download_status['process'] and download_status['process'].poll() is None:
-                    return jsonify({
-                        'success': True,
-                        'progress': 0,
-                        'current_segments': 0,
-                        'total_segments': 0,
-                        'status': 'downloading',
-                        'error': None
-                    })
-        elif download_status['status'] == 'downloading':
+        job_id = request.args.get('job_id')
+        job = job_store.get(job_id) if job_id else job_store.latest()
+
+        if job is None:
+            if job_id:
+                return jsonify({'success': False, 'error': f'任务不存在: {job_id}'})
             return jsonify({
                 'success': True,
                 'progress': 0,
                 'current_segments': 0,
                 'total_segments': 0,
-                'status': 'downloading',
+                'status': 'idle',
                 'error': None
             })
-        
-        # 返回当前状态
-        return jsonify({
-            'success': True,
-            'progress': download_status['progress'],
-            'current_segments': download_status['current_segments'],
-            'total_segments': download_status['total_segments'],
-            'status': download_status['status'],
-            'error': download_status['error']
-        })
-        
+
+        return jsonify({'success': True, **job_view(job)})
+
     except Exception as e:
         logger.error(f"检查进度失败: {str(e)}")
         return jsonify({
@@ -645,6 +1297,107 @@ def check_progress():
         })
 
 
+@app.route('/progress_stream')
+def progress_stream():
+    """通过 Server-Sent Events 推送任务进度，任务结束后关闭连接"""
+    job_id = request.args.get('job_id')
+    if job_store.get(job_id) is None:
+        return jsonify({'success': False, 'error': f'任务不存在: {job_id}'}), 404
+
+    def generate():
+        version = None
+        last_sent = time.time()
+        while True:
+            job = job_store.get(job_id)
+            if job is None:
+                return
+            if job['version'] != version:
+                version = job['version']
+                last_sent = time.time()
+                yield f"data: {json.dumps(job_view(job), ensure_ascii=False)}\n\n"
+                if job['status'] in ('completed', 'failed'):
+                    return
+            elif time.time() - last_sent >= sse_keepalive:
+                last_sent = time.time()
+                yield ': keep-alive\n\n'
+            # 本进程的进度更新会立即唤醒，其他进程处理的任务按间隔轮询
+            with progress_cond:
+                progress_cond.wait(timeout=sse_poll_interval)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metrics')
+def metrics():
+    """以 Prometheus 文本格式输出任务和全局下载指标"""
+    writer = PrometheusWriter()
+    job_list = job_store.list()
+    totals = job_store.totals()
+    for job in job_list:
+        if job['status'] == 'downloading' and job['metrics']:
+            add_totals(totals, job['metrics'])
+    segments_in_flight = sum(job['workers'] for job in job_list if job['status'] == 'downloading')
+
+    for status in ('queued', 'downloading', 'completed', 'failed'):
+        writer.sample('m3u8_jobs', 'gauge', '各状态的任务数',
+                      sum(1 for job in job_list if job['status'] == status), {'status': status})
+    writer.sample('m3u8_segments_in_flight', 'gauge', '调度器已分配的分片并发数', segments_in_flight)
+    writer.sample('m3u8_bytes_downloaded_total', 'counter', '全部任务累计下载字节数', totals['bytes_downloaded'])
+    writer.sample('m3u8_segments_downloaded_total', 'counter', '全部任务累计下载分片数', totals['segments_completed'])
+    writer.sample('m3u8_retries_total', 'counter', '全部任务累计重试次数', totals['retries'])
+    writer.sample('m3u8_segment_cache_hits_total', 'counter', '全部任务分片缓存命中次数', totals['cache_hits'])
+    writer.sample('m3u8_segment_cache_misses_total', 'counter', '全部任务分片缓存未命中次数', totals['cache_misses'])
+    writer.sample('m3u8_segment_cache_hit_bytes_total', 'counter', '全部任务因缓存命中免于下载的字节数',
+                  totals['cache_hit_bytes'])
+    for status, count in sorted(totals['status_counts'].items()):
+        writer.sample('m3u8_http_responses_total', 'counter', '全部任务按状态码统计的响应数', count, {'code': status})
+    writer.histogram('m3u8_segment_latency_seconds', '全部任务的分片下载耗时', totals['latency_buckets'],
+                     round(totals['latency_sum'], 3), totals['latency_count'])
+
+    for job in job_list:
+        snapshot = job['metrics']
+        labels = {'job_id': job['id']}
+        writer.sample('m3u8_job_progress_ratio', 'gauge', '任务进度 (0-1)', round((job['progress'] or 0) / 100, 4), labels)
+        if not snapshot:
+            continue
+        writer.sample('m3u8_job_bytes_downloaded', 'gauge', '任务已下载字节数', snapshot['bytes_downloaded'], labels)
+        writer.sample('m3u8_job_segments_downloaded', 'gauge', '任务已下载分片数', snapshot['segments_completed'], labels)
+        writer.sample('m3u8_job_throughput_bytes_per_second', 'gauge', '任务下载速度',
+                      snapshot['throughput_instant'], {**labels, 'window': 'instant'})
+        writer.sample('m3u8_job_throughput_bytes_per_second', 'gauge', '任务下载速度',
+                      snapshot['throughput_average'], {**labels, 'window': 'average'})
+        writer.sample('m3u8_job_eta_seconds', 'gauge', '任务预计剩余时间', snapshot['eta_seconds'], labels)
+        writer.sample('m3u8_job_retries', 'gauge', '任务重试次数', snapshot['retries'], labels)
+        writer.sample('m3u8_job_segment_cache_hit_ratio', 'gauge', '任务分片缓存命中率',
+                      snapshot.get('cache_hit_ratio'), labels)
+        writer.sample('m3u8_job_last_update_timestamp_seconds', 'gauge', '任务最近一次上报进度的时间',
+                      round(snapshot['updated_at'], 3), labels)
+        for status, count in sorted(snapshot['status_counts'].items()):
+            writer.sample('m3u8_job_http_responses', 'gauge', '任务按状态码统计的响应数', count, {**labels, 'code': status})
+        writer.histogram('m3u8_job_segment_latency_seconds', '任务的分片下载耗时', snapshot['latency_buckets'],
+                         snapshot['latency_sum'], snapshot['latency_count'], labels)
+        for host, limit in sorted((job['concurrency'] or {}).items()):
+            writer.sample('m3u8_job_host_concurrency', 'gauge', '任务对各分片主机的 AIMD 并发上限', limit,
+                          {**labels, 'host': host})
+
+    return Response(writer.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+scheduler_thread = threading.Thread(target=scheduler_loop, name='job-scheduler')
+scheduler_thread.daemon = True
+scheduler_thread.start()
+
+batch_thread = threading.Thread(target=batch_loop, name='batch-scheduler')
+batch_thread.daemon = True
+batch_thread.start()
+
+if postprocess_workers > 0:
+    postprocess_thread = threading.Thread(target=postprocess_loop, name='postprocess-scheduler')
+    postprocess_thread.daemon = True
+    postprocess_thread.start()
+
+
 if __name__ == '__main__':
     logger.info("启动应用服务器，监听端口: 5020")
     app.run(host='0.0.0.0', port=5020)
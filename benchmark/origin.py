@@ -0,0 +1,221 @@
+# benchmark/origin.py
+"""本地合成 HLS 源站，供基准测试使用，不访问任何外部网络
+
+提供的地址：
+- /master.m3u8             主播放列表，包含 variants 个码率版本
+- /v<n>/index.m3u8         第 n 个版本的媒体播放列表（点播，带 ENDLIST）
+- /v<n>/seg<i>.ts          分片，内容按序号确定生成，启用加密时为 AES-128-CBC 密文
+- /key.bin                 AES-128 密钥
+- /page.html               内嵌主播放列表地址的静态网页，用于测试网页解析
+"""
+import argparse
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+# 固定的测试密钥，下载器每个任务只请求一次
+KEY = bytes(range(16))
+CHUNK_SIZE = 16 * 1024
+
+
+@dataclass
+class OriginConfig:
+    segments: int = 1000
+    # 每个分片的字节数（加密前）
+    segment_bytes: int = 32 * 1024
+    segment_duration: float = 2.0
+    variants: int = 3
+    encrypted: bool = False
+    # 每个分片请求在返回响应头前的固定延迟秒数
+    latency: float = 0.0
+    # 每个连接的发送速率上限，单位字节/秒，0 为不限
+    bandwidth: int = 0
+    # 分片请求随机返回 503 的概率
+    error_rate: float = 0.0
+    # 分片请求随机出现长尾延迟的概率和延迟秒数
+    slow_rate: float = 0.0
+    slow_delay: float = 1.0
+    # 随机数种子，相同配置下注入的故障序列一致
+    seed: int = 1
+
+
+def master_playlist(config):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for n in range(config.variants):
+        height = 360 * (n + 1)
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={800000 * (n + 1)},RESOLUTION={height * 16 // 9}x{height}')
+        lines.append(f'v{n}/index.m3u8')
+    return '\n'.join(lines) + '\n'
+
+
+def media_playlist(config):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{int(config.segment_duration + 0.999)}',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+    if config.encrypted:
+        # 未指定 IV 时以媒体序号作为 IV
+        lines.append('#EXT-X-KEY:METHOD=AES-128,URI="/key.bin"')
+    for i in range(config.segments):
+        lines.append(f'#EXTINF:{config.segment_duration:.3f},')
+        lines.append(f'seg{i}.ts')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 基准测试会同时打开大量连接
+    request_queue_size = 128
+
+    def __init__(self, address, config):
+        super().__init__(address, OriginHandler)
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.errors_injected = 0
+        self.slow_injected = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def roll(self):
+        """按配置的概率决定本次分片请求是否出错、是否慢"""
+        config = self.config
+        with self.lock:
+            error = self.random.random() < config.error_rate
+            slow = not error and self.random.random() < config.slow_rate
+            if error:
+                self.errors_injected += 1
+            if slow:
+                self.slow_injected += 1
+        return error, slow
+
+    def segment(self, variant, index):
+        size = self.config.segment_bytes
+        pattern = b'%04d:%08d;' % (variant, index)
+        data = (pattern * (size // len(pattern) + 1))[:size]
+        if self.config.encrypted:
+            iv = index.to_bytes(16, 'big')
+            data = AES.new(KEY, AES.MODE_CBC, iv).encrypt(pad(data, AES.block_size))
+        return data
+
+    def page(self):
+        return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>基准测试视频</title></head>\n'
+                '<body><video id="player" controls></video>\n'
+                '<script>var config = {"source": "' + self.url + '/master.m3u8"};</script>\n'
+                '</body></html>\n')
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次写出，开启 Nagle 时与客户端的延迟确认叠加，每个响应多等约 40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?', 1)[0]
+        if path == '/master.m3u8':
+            self.send_body(master_playlist(server.config).encode(), 'application/vnd.apple.mpegurl')
+        elif path == '/page.html':
+            self.send_body(server.page().encode('utf-8'), 'text/html; charset=utf-8')
+        elif path == '/key.bin':
+            self.send_body(KEY, 'application/octet-stream')
+        elif path.startswith('/v') and path.endswith('/index.m3u8'):
+            self.send_body(media_playlist(server.config).encode(), 'application/vnd.apple.mpegurl')
+        elif path.startswith('/v') and '/seg' in path and path.endswith('.ts'):
+            self.send_segment(path)
+        else:
+            self.send_error(404)
+
+    def send_body(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_segment(self, path):
+        server = self.server
+        config = server.config
+        start = time.monotonic()
+        try:
+            variant_part, segment_part = path[2:].split('/seg', 1)
+            variant, index = int(variant_part), int(segment_part[:-3])
+        except ValueError:
+            self.send_error(404)
+            return
+        if variant >= config.variants or index >= config.segments:
+            self.send_error(404)
+            return
+
+        error, slow = server.roll()
+        if config.latency:
+            time.sleep(config.latency)
+        if slow:
+            time.sleep(config.slow_delay)
+        if error:
+            self.send_error(503)
+            return
+
+        data = server.segment(variant, index)
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if config.bandwidth:
+            # 按块发送，每块之后等待到该连接的速率不超过上限
+            sent = 0
+            for offset in range(0, len(data), CHUNK_SIZE):
+                chunk = data[offset:offset + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                wait = sent / config.bandwidth - (time.monotonic() - start)
+                if wait > 0:
+                    time.sleep(wait)
+        else:
+            self.wfile.write(data)
+
+
+def start_origin(config, host='127.0.0.1', port=0):
+    """在后台线程中启动源站，port 为 0 时使用随机空闲端口"""
+    server = OriginServer((host, port), config)
+    thread = threading.Thread(target=server.serve_forever, name='hls-origin', daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='启动本地合成 HLS 源站')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--segments', type=int, default=1000)
+    parser.add_argument('--segment-bytes', type=int, default=32 * 1024)
+    parser.add_argument('--variants', type=int, default=3)
+    parser.add_argument('--encrypted', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--slow-rate', type=float, default=0.0)
+    parser.add_argument('--slow-delay', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    origin = OriginServer((args.host, args.port), OriginConfig(
+        segments=args.segments, segment_bytes=args.segment_bytes, variants=args.variants,
+        encrypted=args.encrypted, latency=args.latency, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, slow_rate=args.slow_rate, slow_delay=args.slow_delay, seed=args.seed
+    ))
+    print(f"源站已启动: {origin.url}/master.m3u8 ，网页: {origin.url}/page.html")
+    try:
+        origin.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,308 @@
+# benchmark/run.py
+"""下载器基准测试：启动本地合成源站，按场景运行下载进程并与基线比较
+
+用法：
+    python benchmark/run.py                       运行全部场景并与 baseline.json 比较
+    python benchmark/run.py -s vod -s aes         只运行指定场景
+    python benchmark/run.py --save-baseline       运行后把结果保存为新的基线
+
+标准输出为结果表格；与基线相比任一指标变差超过 --tolerance 时退出码为 1。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from origin import OriginConfig, media_playlist, start_origin  # noqa: E402
+from tracing import load_spans  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+# 下载场景：名称 -> 源站配置
+SCENARIOS = {
+    # 主播放列表 + 数千个分片，无故障，衡量纯吞吐
+    'vod': OriginConfig(segments=3000, segment_bytes=32 * 1024),
+    # AES-128 加密分片，衡量解密开销
+    'aes': OriginConfig(segments=2000, segment_bytes=32 * 1024, encrypted=True),
+    # 每个分片 20ms 延迟、每连接 2MB/s 限速
+    'latency': OriginConfig(segments=500, segment_bytes=64 * 1024, latency=0.02, bandwidth=2 * 1024 * 1024),
+    # 2% 的分片返回 503，1% 的分片慢 1 秒
+    'faults': OriginConfig(segments=1000, segment_bytes=32 * 1024, error_rate=0.02, slow_rate=0.01, slow_delay=1.0),
+}
+# 不下载的场景：网页解析耗时、播放列表解析耗时
+EXTRA_SCENARIOS = ('resolver', 'parse')
+ALL_SCENARIOS = tuple(SCENARIOS) + EXTRA_SCENARIOS
+
+# 各指标越大越好还是越小越好，用于和基线比较
+HIGHER_IS_BETTER = {'segments_per_second', 'mb_per_second'}
+LOWER_IS_BETTER = {'elapsed_seconds', 'segment_latency_p50_ms', 'segment_latency_p99_ms', 'ttfb_p50_ms',
+                   'peak_rss_mb', 'time_to_url_seconds', 'parse_ms'}
+# 数值很小的指标抖动比例大，变化量不超过这些绝对值时不算退化；
+# parse_ms 受机器负载影响大，取多轮中最快的一次后仍可能有几十毫秒的波动
+NOISE_FLOOR = {'segment_latency_p50_ms': 1, 'segment_latency_p99_ms': 5, 'ttfb_p50_ms': 1,
+               'time_to_url_seconds': 0.05, 'parse_ms': 40}
+# 播放列表解析的轮数，取最快的一轮
+PARSE_ROUNDS = 7
+
+# 在子进程中导入 app 并解析网页，与 Web 服务的解析路径一致
+RESOLVE_SCRIPT = '''
+import json, sys, time
+import app
+start = time.time()
+result = app.get_m3u8_url(sys.argv[1], use_cache=False)
+print(json.dumps({'elapsed': time.time() - start, 'result': result}))
+'''
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def child_env(work_dir, extra=None):
+    env = os.environ.copy()
+    env.update({
+        'OUTPUT_DIR': work_dir,
+        # 分片缓存会让重复运行直接命中，测不到真实下载
+        'SEGMENT_CACHE_MB': '0',
+        'PYTHONUNBUFFERED': '1',
+    })
+    env.update(extra or {})
+    return env
+
+
+def segment_timings(trace_file):
+    """从下载进程的时间线取每个分片在客户端测得的请求耗时和首字节耗时（秒）
+
+    请求耗时为分片 span 的时长减去等待并发名额的时间，包含下载、重试和解密，不含排队。
+    """
+    spans, _ = load_spans(trace_file)
+    durations = []
+    ttfbs = []
+    for span in spans:
+        if span['name'] != 'segment' or 'error' in span['args']:
+            continue
+        durations.append(span['duration'] - span['args'].get('slot_wait', 0))
+        if 'ttfb' in span['args']:
+            ttfbs.append(span['args']['ttfb'])
+    return durations, ttfbs
+
+
+def run_download(origin, args, work_dir):
+    """运行一次下载进程，返回下载进程上报的最后一个事件、退出码和峰值内存（KB）"""
+    env = child_env(work_dir, {
+        'M3U8_URL': f"{origin.url}/master.m3u8",
+        'VIDEO_TITLE': 'benchmark',
+        'DOWNLOAD_MODE': args.mode,
+        'REMUX_MODE': args.remux_mode,
+        # 分片耗时从下载进程的时间线中统计
+        'TRACE_FILE': os.path.join(work_dir, 'trace.json'),
+    })
+    if args.workers:
+        env['DOWNLOAD_WORKERS'] = str(args.workers)
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'download_m3u8.py')], env=env,
+                               cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               universal_newlines=True)
+    last = {}
+    for line in process.stdout:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(event, dict):
+            last = event
+    # 用 wait4 取得该子进程自己的资源占用
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return last, process.returncode, usage.ru_maxrss
+
+
+def bench_download(name, config, args):
+    origin = start_origin(config)
+    work_dir = tempfile.mkdtemp(prefix=f'm3u8-bench-{name}-')
+    try:
+        start = time.monotonic()
+        event, returncode, peak_rss_kb = run_download(origin, args, work_dir)
+        elapsed = time.monotonic() - start
+        latencies, ttfbs = segment_timings(os.path.join(work_dir, 'trace.json'))
+    finally:
+        origin.shutdown()
+        origin.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    metrics = event.get('metrics') or {}
+    if event.get('status') != 'completed':
+        return {'error': event.get('error') or f"下载进程退出码 {returncode}"}
+    nbytes = metrics.get('bytes_downloaded', 0)
+    return {
+        'segments': config.segments,
+        'elapsed_seconds': round(elapsed, 3),
+        'segments_per_second': round(config.segments / elapsed, 1),
+        'mb_per_second': round(nbytes / 1024 / 1024 / elapsed, 2),
+        'segment_latency_p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'segment_latency_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'ttfb_p50_ms': round(percentile(ttfbs, 50) * 1000, 2) if ttfbs else None,
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'retries': metrics.get('retries', 0),
+        'errors_injected': origin.errors_injected,
+        'slow_injected': origin.slow_injected,
+    }
+
+
+def bench_resolver(args):
+    """网页直接包含 m3u8 地址，测量 get_m3u8_url 得到地址的耗时"""
+    origin = start_origin(OriginConfig(segments=10))
+    work_dir = tempfile.mkdtemp(prefix='m3u8-bench-resolver-')
+    try:
+        env = child_env(work_dir, {'BROWSER_PREWARM': '0', 'RESOLVE_CACHE_TTL': '0'})
+        completed = subprocess.run([sys.executable, '-c', RESOLVE_SCRIPT, f"{origin.url}/page.html"], env=env,
+                                   cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   universal_newlines=True, timeout=120)
+    finally:
+        origin.shutdown()
+        origin.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    try:
+        output = json.loads(completed.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return {'error': f"解析进程退出码 {completed.returncode}"}
+    result = output['result'] or {}
+    if not result.get('url'):
+        return {'error': '未解析到 m3u8 地址'}
+    return {'time_to_url_seconds': round(output['elapsed'], 4), 'tier': result.get('tier')}
+
+
+def bench_parse(args):
+    """解析一个 10000 个分片的加密媒体播放列表，取 PARSE_ROUNDS 轮中最快的一轮，减少机器负载的影响"""
+    from playlist import parse_playlist
+
+    content = media_playlist(OriginConfig(segments=10000, encrypted=True))
+    best = None
+    for _ in range(PARSE_ROUNDS):
+        start = time.perf_counter()
+        playlist = parse_playlist(content, 'http://127.0.0.1/v0/index.m3u8')
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'segments': len(playlist.segments), 'parse_ms': round(best * 1000, 2)}
+
+
+def run_scenario(name, args):
+    if name == 'resolver':
+        return bench_resolver(args)
+    if name == 'parse':
+        return bench_parse(args)
+    return bench_download(name, SCENARIOS[name], args)
+
+
+def compare(results, baseline, tolerance):
+    """返回 (场景, 指标, 基线值, 当前值, 变化比例) 列表，只包含变差超过容差的指标"""
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base or 'error' in metrics:
+            continue
+        for metric, value in metrics.items():
+            base_value = base.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(base_value, (int, float)) or not base_value:
+                continue
+            if abs(value - base_value) <= NOISE_FLOOR.get(metric, 0):
+                continue
+            change = (value - base_value) / base_value
+            if (metric in HIGHER_IS_BETTER and change < -tolerance) or \
+                    (metric in LOWER_IS_BETTER and change > tolerance):
+                regressions.append((name, metric, base_value, value, change))
+    return regressions
+
+
+def print_results(results, baseline):
+    for name, metrics in results.items():
+        print(f"[{name}]")
+        base = baseline.get('scenarios', {}).get(name, {})
+        for metric, value in metrics.items():
+            base_value = base.get(metric)
+            if isinstance(value, (int, float)) and isinstance(base_value, (int, float)) and base_value:
+                print(f"  {metric:<26} {value:>12}   基线 {base_value} ({(value - base_value) / base_value:+.1%})")
+            else:
+                print(f"  {metric:<26} {value!s:>12}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='使用本地合成 HLS 源站运行下载器基准测试')
+    parser.add_argument('-s', '--scenario', action='append', choices=ALL_SCENARIOS,
+                        help='要运行的场景，可重复指定（默认：全部）')
+    parser.add_argument('--mode', choices=('native', 'ffmpeg'), default='native', help='下载模式（默认：native）')
+    parser.add_argument('--remux-mode', choices=('file', 'pipe', 'none'), default='none',
+                        help='native 模式的封装方式（默认：none，只测下载，不需要 ffmpeg）')
+    parser.add_argument('-w', '--workers', type=int, help='DOWNLOAD_WORKERS（默认：下载器默认值）')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='基线文件路径')
+    parser.add_argument('--save-baseline', action='store_true', help='把本次结果写入基线文件')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='指标变差超过该比例视为退化（默认：0.25）')
+    parser.add_argument('-o', '--output', help='把本次结果另存为 JSON 文件')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if (args.mode == 'ffmpeg' or args.remux_mode != 'none') and not shutil.which('ffmpeg'):
+        print('未找到 ffmpeg，无法测试 ffmpeg 下载或封装', file=sys.stderr)
+        return 2
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in args.scenario or ALL_SCENARIOS:
+        print(f"运行场景 {name} ...", file=sys.stderr)
+        results[name] = run_scenario(name, args)
+
+    report = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': {'mode': args.mode, 'remux_mode': args.remux_mode, 'workers': args.workers},
+        'scenarios': results,
+    }
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = [name for name, metrics in results.items() if 'error' in metrics]
+    regressions = compare(results, baseline, args.tolerance)
+    for name, metric, base_value, value, change in regressions:
+        print(f"退化: {name}.{metric} {base_value} -> {value} ({change:+.1%})")
+    for name in failed:
+        print(f"失败: {name}: {results[name]['error']}")
+
+    if args.save_baseline:
+        if failed:
+            print('有场景失败，不保存基线', file=sys.stderr)
+            return 1
+        # 只更新本次运行的场景，其余场景保留原基线
+        merged = dict(baseline.get('scenarios', {}), **results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({**report, 'scenarios': merged}, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"已保存基线: {args.baseline}", file=sys.stderr)
+        return 0
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
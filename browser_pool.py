@@ -0,0 +1,279 @@
+# browser_pool.py
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import requests.exceptions
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+
+from download_m3u8 import setup_logger
+
+logger = setup_logger()
+
+# 浏览器池大小，即同时可用的浏览器会话数
+browser_pool_size = int(os.getenv('BROWSER_POOL_SIZE', '2'))
+# 等待空闲浏览器的超时时间（秒）
+browser_lease_timeout = float(os.getenv('BROWSER_LEASE_TIMEOUT', '60'))
+# 单个浏览器会话最多复用的次数，超过后重建以回收内存
+browser_max_uses = int(os.getenv('BROWSER_MAX_USES', '50'))
+# 启动时是否预先启动浏览器
+browser_prewarm = os.getenv('BROWSER_PREWARM', '1') == '1'
+
+
+def create_driver():
+    """创建模拟手机访问的无头Chrome会话"""
+    chrome_options = Options()
+    chrome_bin = None
+    chromedriver_path = None
+
+    # Docker 环境特定设置
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--headless=new')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--disable-gpu')
+
+    # 检测运行环境
+    is_docker = os.path.exists('/.dockerenv')
+    logger.info(f"运行环境: {'Docker' if is_docker else '本地'}")
+
+    if is_docker:
+        # Docker 环境使用环境变量中的浏览器
+        chrome_bin = os.getenv('CHROME_BIN')
+        chromedriver_path = os.getenv('CHROMEDRIVER_PATH')
+
+        if not chrome_bin or not os.path.exists(chrome_bin):
+            logger.info("Google Chrome 不存在，尝试使用 Chromium")
+            chrome_bin = os.getenv('CHROMIUM_BIN')
+            chromedriver_path = os.getenv('CHROMIUM_DRIVER_PATH')
+
+        if not chrome_bin or not os.path.exists(chrome_bin):
+            logger.error(f"Docker环境中未找到可用的浏览器")
+            raise Exception("未找到可用的浏览器")
+    else:
+        # 本地环境自动检测浏览器
+        try:
+            from webdriver_manager.chrome import ChromeDriverManager
+
+            # 尝试查找本地 Chrome 或 Chromium
+            if os.path.exists('/usr/bin/google-chrome'):
+                chrome_bin = '/usr/bin/google-chrome'
+            elif os.path.exists('/usr/bin/chromium'):
+                chrome_bin = '/usr/bin/chromium'
+            elif os.path.exists('C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe'):
+                chrome_bin = 'C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe'
+            elif os.path.exists('/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'):
+                chrome_bin = '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'
+            else:
+                chrome_bin = None
+                logger.warning("未找到本地Chrome/Chromium，将使用系统默认浏览器")
+
+            # 尝试使用缓存的 ChromeDriver
+            cache_path = os.path.join(os.path.expanduser("~"), ".wdm", "drivers.json")
+            if os.path.exists(cache_path):
+                try:
+                    with open(cache_path, 'r') as f:
+                        cache = json.load(f)
+                        for driver in cache.get('chrome', {}).values():
+                            driver_path = driver.get('binary_path')
+                            if driver_path and os.path.exists(driver_path):
+                                chromedriver_path = driver_path
+                                logger.info(f"使用缓存的ChromeDriver: {chromedriver_path}")
+                                break
+                except Exception as e:
+                    logger.warning(f"读取缓存失败: {str(e)}")
+
+            # 如果没有找到缓存的驱动，尝试下载
+            if not chromedriver_path:
+                try:
+                    chromedriver_path = ChromeDriverManager().install()
+                    logger.info(f"下载新的ChromeDriver: {chromedriver_path}")
+                except requests.exceptions.ConnectionError:
+                    logger.error("网络连接失败，无法下载ChromeDriver")
+                    raise Exception("网络连接失败，请检查网络或手动下载ChromeDriver")
+                except Exception as e:
+                    logger.error(f"下载ChromeDriver失败: {str(e)}")
+                    raise
+
+        except Exception as e:
+            logger.error(f"本地环境配置失败: {str(e)}")
+            raise Exception(f"浏览器配置失败: {str(e)}")
+
+    # 确保 chromedriver_path 已设置
+    if not chromedriver_path:
+        raise Exception("ChromeDriver 路径未设置")
+
+    logger.info(f"使用浏览器: {chrome_bin if chrome_bin else '系统默认'}")
+    if chrome_bin:
+        chrome_options.binary_location = chrome_bin
+
+    # 不等待页面加载完成，由调用方监听网络事件决定何时返回
+    chrome_options.page_load_strategy = 'none'
+
+    # 启用性能日志
+    chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+
+    # 设置移动设备模拟
+    mobile_emulation = {
+        "deviceMetrics": {"width": 375, "height": 812, "pixelRatio": 3.0},
+        "userAgent": "Mozilla/5.0 (iPhone; CPU iPhone OS 15_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.0 Mobile/15E148 Safari/604.1"
+    }
+    chrome_options.add_experimental_option("mobileEmulation", mobile_emulation)
+
+    logger.info(f"使用驱动: {chromedriver_path}")
+    service = Service(chromedriver_path)
+    driver = webdriver.Chrome(service=service, options=chrome_options)
+
+    # 启用性能日志
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Performance.enable', {})
+    return driver
+
+
+class BrowserPool:
+    """有上限的预启动浏览器池
+
+    通过 lease() 借出浏览器会话，归还时清理 cookie、缓存和性能日志后复用，
+    池满时等待空闲会话或被丢弃会话空出的名额，直到超时。
+    """
+
+    def __init__(self, size, lease_timeout, max_uses):
+        self.size = size
+        self.lease_timeout = lease_timeout
+        self.max_uses = max_uses
+        self._idle = deque()
+        self._created = 0
+        self._uses = {}
+        # 归还会话或丢弃会话空出名额时唤醒等待的借出方
+        self._cond = threading.Condition()
+
+    def _try_create(self):
+        """在未达上限时新建一个会话，达到上限返回 None"""
+        with self._cond:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+        return self._create()
+
+    def _create(self):
+        """为已占用的名额新建会话，失败时归还名额"""
+        try:
+            driver = create_driver()
+        except Exception:
+            self._free_slot()
+            raise
+        self._uses[id(driver)] = 0
+        logger.info(f"浏览器池新建会话，当前会话数: {self._created}/{self.size}")
+        return driver
+
+    def _free_slot(self):
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+    def _put_idle(self, driver):
+        with self._cond:
+            self._idle.append(driver)
+            self._cond.notify()
+
+    def _discard(self, driver):
+        self._uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error(f"关闭driver时出错: {str(e)}")
+        self._free_slot()
+
+    def _reset(self, driver):
+        """清理会话状态，避免上一次访问影响下一次"""
+        driver.get('about:blank')
+        # 关闭页面弹出的多余窗口
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+        driver.delete_all_cookies()
+        # 读取即清空性能日志
+        driver.get_log('performance')
+
+    def warm(self):
+        """预先启动全部浏览器会话"""
+        for _ in range(self.size):
+            try:
+                driver = self._try_create()
+            except Exception as e:
+                logger.error(f"预启动浏览器失败: {str(e)}")
+                return
+            if driver is None:
+                return
+            self._put_idle(driver)
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """借出一个浏览器会话，使用完毕后自动归还"""
+        timeout = self.lease_timeout if timeout is None else timeout
+        start = time.time()
+        driver = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    driver = self._idle.popleft()
+                    break
+                # 未达上限（包括其他会话被丢弃后空出名额）时占用名额，在锁外启动浏览器
+                if self._created < self.size:
+                    self._created += 1
+                    break
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    raise Exception(f"浏览器池繁忙，等待 {timeout:.0f} 秒后仍无空闲浏览器")
+                self._cond.wait(remaining)
+        if driver is None:
+            driver = self._create()
+        logger.info(f"借出浏览器会话，等待 {time.time() - start:.2f} 秒")
+
+        healthy = True
+        try:
+            yield driver
+        except Exception:
+            healthy = False
+            raise
+        finally:
+            self._release(driver, healthy)
+
+    def _release(self, driver, healthy):
+        self._uses[id(driver)] = self._uses.get(id(driver), 0) + 1
+        if self._uses[id(driver)] >= self.max_uses:
+            logger.info("浏览器会话达到最大复用次数，重建")
+            self._discard(driver)
+            return
+        try:
+            self._reset(driver)
+        except Exception as e:
+            # 会话已失效（如浏览器崩溃），直接丢弃
+            logger.warning(f"重置浏览器会话失败，丢弃: {str(e)}")
+            self._discard(driver)
+            return
+        if not healthy:
+            logger.info("浏览器会话在使用中出错，已重置后归还")
+        self._put_idle(driver)
+
+    def close(self):
+        while True:
+            with self._cond:
+                if not self._idle:
+                    break
+                driver = self._idle.popleft()
+            self._discard(driver)
+
+
+browser_pool = BrowserPool(browser_pool_size, browser_lease_timeout, browser_max_uses)
+
+if browser_prewarm:
+    threading.Thread(target=browser_pool.warm, name='browser-prewarm', daemon=True).start()
@@ -1,23 +1,97 @@
 import os
 import sys
+import argparse
 import subprocess
 import datetime
+import time
 import logging
 import requests
 import re
 from logging.handlers import TimedRotatingFileHandler
-from urllib.parse import urljoin
 import json
+import shutil
+import hashlib
+import signal
+import threading
+import bisect
+from collections import deque
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from hls_crypto import SegmentDecryptor, get_key, segment_iv
+from http_client import fetch, request_headers
+from metrics import DownloadMetrics
+from playlist import MediaPlaylist, parse_playlist, select_variant, select_audio, init_segment, with_init_sections
+from rate_control import THROTTLE_STATUS, ConcurrencyController, TokenBucket
+from segment_cache import SegmentCache
+from tracing import Tracer
 
 # 设置默认输出目录
 output_dir = os.getenv("OUTPUT_DIR", "downloaded_m3u8")
 
+# 下载模式: native 为内置并发分片下载, ffmpeg 为交给 ffmpeg 单连接拉取
+download_mode = os.getenv("DOWNLOAD_MODE", "native")
+# 并发下载分片的线程数
+download_workers = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+# 主播放列表的版本选择策略: highest(最高带宽) / resolution(最高分辨率) / bitrate_cap(不超过 MAX_BITRATE)
+variant_policy = os.getenv("VARIANT_POLICY", "highest")
+# bitrate_cap 策略的码率上限（bps）
+max_bitrate = int(os.getenv("MAX_BITRATE", "0"))
+# 重排缓冲区上限（MB），乱序到达的分片在此等待按顺序写入
+reorder_buffer_mb = int(os.getenv("REORDER_BUFFER_MB", "64"))
+# 封装方式: file 先合并为可断点续传的 ts 再封装 mp4；pipe 边下载边送入 ffmpeg 封装；none 只输出 ts
+remux_mode = os.getenv("REMUX_MODE", "file")
+# 每个分片主机的初始并发数，之后按 AIMD 在 1 到 DOWNLOAD_WORKERS 之间自动调整
+aimd_initial = int(os.getenv("AIMD_INITIAL", "4"))
+# 遇到限流或错误时并发数乘以该系数
+aimd_decrease = float(os.getenv("AIMD_DECREASE", "0.5"))
+# 首字节耗时超过平均值的倍数时视为拥塞
+aimd_latency_factor = float(os.getenv("AIMD_LATENCY_FACTOR", "3"))
+# 下载带宽上限（字节/秒），0 表示不限速
+max_bandwidth = int(os.getenv("MAX_BANDWIDTH", "0"))
+# 直播录制的最长时长（秒，按分片时长累计），0 表示录到直播结束或被手动停止
+live_max_duration = float(os.getenv("LIVE_MAX_DURATION", "0"))
+# 直播播放列表连续刷新失败多少次后放弃录制
+live_refresh_failures = int(os.getenv("LIVE_REFRESH_FAILURES", "5"))
+# 跨任务共享的分片缓存容量（MB），0 表示不缓存；启用后每个分片会多写一次磁盘，只在经常重复下载同一视频时开启
+segment_cache_mb = int(os.getenv("SEGMENT_CACHE_MB", "0"))
+# 单个分片的最大尝试次数
+segment_retries = int(os.getenv("SEGMENT_RETRIES", "3"))
+# ffmpeg 标准错误只保留最后的行数，失败时写入日志
+ffmpeg_stderr_lines = int(os.getenv("FFMPEG_STDERR_LINES", "200"))
+# 本次下载时间线的保存路径，由 Web 进程按任务指定，未设置时不记录
+trace_file = os.getenv("TRACE_FILE")
+# 时间线最多记录的 span 数，超出后只计数
+trace_max_spans = int(os.getenv("TRACE_MAX_SPANS", "50000"))
+
 # 确保输出目录存在
 os.makedirs(output_dir, exist_ok=True)
 os.makedirs(f"{output_dir}/videos", exist_ok=True)
 
-# 添加进度文件路径
-progress_file = os.path.join(output_dir, 'download_progress.json')
+# 进度事件的最小上报间隔（秒），期间的更新会合并，状态变化时立即上报
+progress_interval = float(os.getenv('PROGRESS_INTERVAL', '0.5'))
+_progress_lock = threading.Lock()
+_last_progress = {'time': 0, 'status': None}
+# 本次下载的字节数、速度、分片耗时、重试和状态码统计
+job_metrics = DownloadMetrics()
+# 按分片主机的 AIMD 并发控制，上限为本任务分到的下载线程数
+concurrency = ConcurrencyController(
+    initial=min(aimd_initial, download_workers),
+    maximum=download_workers,
+    decrease=aimd_decrease,
+    latency_factor=aimd_latency_factor
+)
+# 全局带宽上限
+bandwidth = TokenBucket(max_bandwidth)
+# 按分片地址和字节范围寻址的磁盘缓存，重复下载同一视频时不再回源
+segment_cache = SegmentCache(os.path.join(output_dir, 'cache', 'segments'), segment_cache_mb * 1024 * 1024)
+# 收到 SIGTERM 时置位，直播录制据此停止拉取新分片并正常收尾
+stop_event = threading.Event()
+# 正在录制直播时置位，此时 SIGTERM 表示停止录制而不是直接退出
+recording_live = threading.Event()
+# 播放列表、分片、封装等各阶段的耗时
+tracer = Tracer('downloader', trace_max_spans, enabled=bool(trace_file))
+
 
 def setup_logger():
     """配置日志记录器"""
@@ -55,136 +129,188 @@ logger = setup_logger()
 
 
 def get_m3u8_content(url):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 15_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'
-    }
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        with tracer.span('playlist', 'playlist', url=url):
+            response = fetch(url)
+            response.raise_for_status()
         return response.text
     except requests.RequestException as e:
-        print(f"获取M3U8文件失败: {e}")
+        # 标准输出用于上报进度事件，错误只写日志
+        logger.error(f"获取M3U8文件失败: {e}")
         return None
 
 
-def parse_m3u8(content, base_url):
-    lines = content.splitlines()
-    segments = []
-    for line in lines:
-        if line.startswith('#EXT-X-STREAM-INF'):
-            next_line = next((l for l in lines if l), None)
-            if next_line:
-                new_url = urljoin(base_url, next_line)
-                new_content = get_m3u8_content(new_url)
-                if new_content:
-                    segments.extend(parse_m3u8(new_content, new_url))
-        elif not line.startswith('#'):
-            segment_url = urljoin(base_url, line)
-            segments.append(segment_url)
-    return segments
-
-
-def get_total_segments(m3u8_url):
-    """获取m3u8文件中的总片段数，包括处理嵌套的m3u8文件"""
-    try:
-        segments = []
-        m3u8_content = get_m3u8_content(m3u8_url)
-        if m3u8_content:
-            segments = parse_m3u8(m3u8_content, m3u8_url)
-            # download_segments(segments, segment_path)
-            # merge_segments(output_dir, segment_path, output_file)
-        return len(segments)
+def resolve_media_playlist(m3u8_url):
+    """获取播放列表，遇到主播放列表时按策略选出一个版本，返回媒体播放列表
 
-    except Exception as e:
-        logger.error(f"获取片段数失败: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        return 0
+    选中的版本使用独立的音轨播放列表时，音轨地址记在返回结果的 audio_url 中。
+    """
+    url = m3u8_url
+    audio_url = None
+    # 主播放列表最多嵌套几层，防止循环引用
+    for _ in range(3):
+        content = get_m3u8_content(url)
+        if not content:
+            return None
+        playlist = parse_playlist(content, url)
+        if isinstance(playlist, MediaPlaylist):
+            playlist.audio_url = audio_url
+            return playlist
+        variant = select_variant(playlist.variants, variant_policy, max_bitrate)
+        logger.info(f"主播放列表共 {len(playlist.variants)} 个版本，按 {variant_policy} 选择: "
+                    f"带宽 {variant.bandwidth} 分辨率 {variant.resolution} {variant.uri}")
+        audio = select_audio(playlist, variant)
+        if audio:
+            logger.info(f"版本使用独立音轨: {audio.name or audio.group_id} {audio.uri}")
+            audio_url = audio.uri
+        url = variant.uri
+    logger.error("主播放列表嵌套层数过多")
+    return None
 
 
-def update_progress(progress, current_segments=None, total_segments=None, status='downloading', error=None):
-    """更新下载进度"""
+def update_progress(progress, current_segments=None, total_segments=None, status='downloading', error=None,
+                    live=None, output_file=None, duration=None):
+    """以 JSON Lines 的形式把进度事件写到标准输出，由 Web 进程通过管道读取"""
     try:
-        progress_data = {
-            'progress': progress,
-            'current_segments': current_segments,
-            'total_segments': total_segments,
-            'status': status,
-            'error': error
-        }
-        with open(progress_file, 'w') as f:
-            json.dump(progress_data, f)
+        with _progress_lock:
+            now = time.time()
+            if (status == _last_progress['status'] and status == 'downloading'
+                    and now - _last_progress['time'] < progress_interval):
+                return
+            _last_progress['time'] = now
+            _last_progress['status'] = status
+            progress_data = {
+                'event': 'progress',
+                'progress': progress,
+                'current_segments': current_segments,
+                'total_segments': total_segments,
+                'status': status,
+                'error': error,
+                'metrics': job_metrics.snapshot(),
+                'concurrency': concurrency.snapshot(),
+                'live': live,
+                # 完成时生成的文件路径和播放列表中的媒体总时长，供后处理校验
+                'output_file': output_file,
+                'duration': duration
+            }
+            sys.stdout.write(json.dumps(progress_data, ensure_ascii=False) + '\n')
+            sys.stdout.flush()
     except Exception as e:
         logger.error(f"更新进度失败: {str(e)}")
 
 
-def execute_ffmpeg(m3u8_url, output_file):
-    """使用ffmpeg下载并合并视频片段"""
+def ffmpeg_out_time(block):
+    """从 -progress 输出中取已处理的媒体时长（秒），尚无数据时返回 None"""
+    # out_time_ms 实际也是微秒，新旧版本 ffmpeg 都会输出 out_time_us 或 out_time_ms
+    for key in ('out_time_us', 'out_time_ms'):
+        value = block.get(key, '')
+        if value.lstrip('-').isdigit():
+            return max(0, int(value)) / 1000000
+    return None
+
+
+def run_ffmpeg(command, on_progress=None):
+    """运行 ffmpeg，从 -progress pipe:1 读取结构化进度，返回 (退出码, 标准错误的最后若干行)
+
+    每个进度块以 progress=continue/end 结束，结束时调用 on_progress(块内容)；
+    标准错误由单独的线程读入有长度上限的环形缓冲区，长时间运行时内存占用不变。
+    """
+    command = [command[0], '-hide_banner', '-nostats', '-loglevel', 'warning', '-progress', 'pipe:1',
+               *command[1:]]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True, encoding='utf-8', errors='replace')
+    stderr_tail = deque(maxlen=ffmpeg_stderr_lines)
+
+    def drain_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line.rstrip())
+
+    reader = threading.Thread(target=drain_stderr, name='ffmpeg-stderr', daemon=True)
+    reader.start()
+    block = {}
+    for line in process.stdout:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        if key == 'progress':
+            if on_progress:
+                on_progress(block)
+            block = {}
+        else:
+            block[key] = value
+    process.wait()
+    reader.join()
+    return process.returncode, list(stderr_tail)
+
+
+def execute_ffmpeg(m3u8_url, output_file, playlist=None):
+    """使用ffmpeg下载并合并视频片段，按 ffmpeg 上报的已处理时长和播放列表总时长计算进度"""
+    total_segments = 0
     try:
-        # 获取总片段数
-        total_segments = get_total_segments(m3u8_url)
+        # 解析一次播放列表，计数、总时长和下载都使用选中的媒体播放列表
+        if playlist is None:
+            playlist = resolve_media_playlist(m3u8_url)
+        segment_ends = []
+        if playlist:
+            m3u8_url = playlist.url
+            total_segments = len(playlist.segments)
+            # 每个分片结束时的累计时长，用于由已处理时长估算完成的分片数
+            segment_ends = list(accumulate(segment.duration for segment in playlist.segments))
+        duration = segment_ends[-1] if segment_ends else 0
         if total_segments > 0:
-            logger.info(f"预计总片段数: {total_segments}")
+            logger.info(f"预计总片段数: {total_segments}，总时长: {duration:.1f} 秒")
             update_progress(0, 0, total_segments)
+        job_metrics.total_segments = total_segments
 
         # 准备ffmpeg命令
-        command = [
-            'ffmpeg',
-            '-i', m3u8_url,
+        # 与原生下载使用相同的请求头和 cookie，-headers 只对其后的一个输入生效
+        headers = ''.join(f'{name}: {value}\r\n' for name, value in request_headers().items())
+        command = ['ffmpeg', '-headers', headers, '-i', m3u8_url]
+        if playlist and playlist.audio_url:
+            # 视频取选中的版本，音频取独立的音轨播放列表
+            command += ['-headers', headers, '-i', playlist.audio_url, '-map', '0:v', '-map', '1:a']
+        command += [
             '-c', 'copy',
             '-bsf:a', 'aac_adtstoasc',
             output_file
         ]
 
-        # 使用subprocess.Popen来实时获取输出
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
+        state = {'size': 0, 'out_time': 0.0, 'segments': 0, 'logged': None}
+
+        def on_progress(block):
+            out_time = ffmpeg_out_time(block)
+            if out_time is None:
+                return
+            segments = bisect.bisect_right(segment_ends, out_time + 0.001)
+            # total_size 是已写入输出文件的字节数，-c copy 时与下载量接近
+            size = block.get('total_size', '')
+            size = int(size) if size.isdigit() else state['size']
+            job_metrics.record_progress(max(0, size - state['size']), segments)
+            state.update(size=size, out_time=out_time, segments=segments)
+            # 完成事件由 ffmpeg 退出后上报，这里最多到 99.9
+            progress = min(99.9, out_time / duration * 100) if duration else 0
+            update_progress(progress, segments, total_segments)
+            # 每 10% 记录一次日志
+            step = int(progress // 10)
+            if step != state['logged']:
+                state['logged'] = step
+                logger.info(f"下载进度: {progress:.1f}% ({out_time:.1f}/{duration:.1f} 秒，约 {segments}/{total_segments} 片，"
+                            f"已写入 {size / 1024 / 1024:.1f} MB，速度 {block.get('speed', 'N/A').strip()})")
 
-        # 初始化计数器
-        frame_count = 0
-        processed_lines = set()
-
-        # 实时读取输出
-        while True:
-            line = process.stderr.readline()
-            if not line and process.poll() is not None:
-                break
-
-            if line:
-                logger.info(line)
-                if 'hls @' in line and line not in processed_lines:
-                    frame_count += 1
-                    processed_lines.add(line)
-                    logger.info(f"总片数：{total_segments}  已完成数：{frame_count}")
-
-                    # 更新进度
-                    if total_segments > 0:
-                        progress = min(100, (frame_count / total_segments) * 100)
-                        update_progress(
-                            progress=progress,
-                            current_segments=frame_count,
-                            total_segments=total_segments
-                        )
-                        logger.info(f"下载进度: {progress:.2f}% ({frame_count}/{total_segments})")
-                    else:
-                        logger.info(f"已下载片段: {frame_count}")
-
-        # 等待进程完成
-        process.wait()
-
-        if process.returncode == 0:
-            logger.info(f"下载完成: {output_file}")
-            logger.info(f"总共处理片段: {frame_count}")
-            update_progress(100, frame_count, total_segments, status='completed')
-            # 不在这里删除进度文件，让前端确认后再删除
+        ffmpeg_start = time.time()
+        returncode, stderr_tail = run_ffmpeg(command, on_progress)
+        tracer.add('ffmpeg', 'ffmpeg', ffmpeg_start, time.time() - ffmpeg_start, returncode=returncode,
+                   out_time=state['out_time'], total_size=state['size'])
+
+        if returncode == 0:
+            logger.info(f"下载完成: {output_file}，时长 {state['out_time']:.1f} 秒，大小 {state['size']} 字节")
+            update_progress(100, total_segments, total_segments, status='completed', output_file=output_file,
+                            duration=duration or None)
             return True
         else:
-            logger.error("下载失败")
-            update_progress(0, frame_count, total_segments, status='failed', error="FFmpeg 执行失败")
+            logger.error("下载失败，ffmpeg 输出:\n" + '\n'.join(stderr_tail))
+            error = f"FFmpeg 执行失败: {stderr_tail[-1]}" if stderr_tail else "FFmpeg 执行失败"
+            update_progress(0, state['segments'], total_segments, status='failed', error=error)
             return False
 
     except Exception as e:
@@ -193,24 +319,806 @@ def execute_ffmpeg(m3u8_url, output_file):
         return False
 
 
-if __name__ == "__main__":
-    # 从环境变量获取 m3u8_url 和 video_title
-    m3u8_url = os.getenv("M3U8_URL")
-    video_title = os.getenv("VIDEO_TITLE", "")
+def get_job_dir(m3u8_url):
+    """根据m3u8地址生成固定的任务目录，重启任务时可找回已下载的分片"""
+    job_key = hashlib.sha1(m3u8_url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(output_dir, 'tmp', job_key)
 
-    if not m3u8_url:
-        logger.error("请设置环境变量 M3U8_URL")
-        sys.exit(1)
 
-    # 生成输出文件名
+class SegmentManifest:
+    """分片级断点清单
+
+    以追加写入的 JSON Lines 文件按顺序记录已写入合并文件的分片及其大小，
+    首行记录播放列表指纹，播放列表变化时旧记录作废。
+    恢复时把合并文件截断到最后一条完整记录处，从下一个分片继续。
+    """
+
+    def __init__(self, job_dir, m3u8_url, segments, merged_file):
+        self.path = os.path.join(job_dir, 'manifest.jsonl')
+        self.merged_file = merged_file
+        self.fingerprint = self._fingerprint(segments)
+        self.merged_count = 0
+        self.merged_bytes = 0
+        self._load()
+        if not self.merged_count:
+            with open(self.path, 'w') as f:
+                f.write(json.dumps({'m3u8_url': m3u8_url, 'fingerprint': self.fingerprint,
+                                    'total_segments': len(segments)}) + '\n')
+        # 丢弃合并文件中没有记录的尾部
+        with open(self.merged_file, 'ab') as f:
+            f.truncate(self.merged_bytes)
+        self._file = open(self.path, 'a')
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                # 补齐中断时写了一半的行，避免和新记录粘连
+                self._file.write('\n')
+
+    @staticmethod
+    def _fingerprint(segments):
+        # 忽略查询参数，避免带签名的分片地址导致断点失效
+        digest = hashlib.sha1()
+        for segment in segments:
+            digest.update(segment.uri.split('?', 1)[0].encode('utf-8'))
+        return f"{len(segments)}:{digest.hexdigest()}"
+
+    def _load(self):
+        if not os.path.exists(self.path) or not os.path.exists(self.merged_file):
+            return
+        merged_size = os.path.getsize(self.merged_file)
+        try:
+            with open(self.path, 'r') as f:
+                header = json.loads(f.readline() or '{}')
+                if header.get('fingerprint') != self.fingerprint:
+                    logger.info("播放列表已变化，丢弃旧的断点记录")
+                    return
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 进程中断时留下的不完整行，恢复后补齐了换行，其后还有新的记录
+                        continue
+                    # 只认可从头连续且确实已写入合并文件的记录
+                    if record['index'] != self.merged_count or self.merged_bytes + record['size'] > merged_size:
+                        break
+                    self.merged_count += 1
+                    self.merged_bytes += record['size']
+        except Exception as e:
+            logger.warning(f"读取断点记录失败，将重新下载: {str(e)}")
+            self.merged_count = 0
+            self.merged_bytes = 0
+        if self.merged_count:
+            logger.info(f"从断点恢复，已完成分片: {self.merged_count}")
+
+    def mark_merged(self, index, size):
+        """记录分片已写入合并文件，由 OrderedMerger 按顺序调用"""
+        self.merged_count = index + 1
+        self.merged_bytes += size
+        self._file.write(json.dumps({'index': index, 'size': size}) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class OrderedMerger:
+    """按播放列表顺序把分片直接追加到输出流
+
+    乱序到达的分片暂存在有字节上限的重排缓冲区里；缓冲区满时，
+    拿着靠后分片的线程会阻塞等待，从而限制跑得快的下载线程和内存占用。
+    """
+
+    def __init__(self, sink, next_index, buffer_limit, on_merged=None):
+        self.sink = sink
+        self.next_index = next_index
+        self.buffer_limit = buffer_limit
+        self.on_merged = on_merged
+        self._buffer = {}
+        self._buffered = 0
+        self._error = None
+        self._cond = threading.Condition()
+
+    def put(self, index, data):
+        with self._cond:
+            # 下一个要写的分片永远不会被阻塞，保证缓冲区总能排空
+            while (index != self.next_index and self._buffer
+                   and self._buffered + len(data) > self.buffer_limit and self._error is None):
+                self._cond.wait()
+            if self._error is not None:
+                raise Exception(f"合并已中止: {self._error}")
+            if index != self.next_index:
+                self._buffer[index] = data
+                self._buffered += len(data)
+                return
+            self._write(index, data)
+            while self.next_index in self._buffer:
+                data = self._buffer.pop(self.next_index)
+                self._buffered -= len(data)
+                self._write(self.next_index, data)
+            self._cond.notify_all()
+
+    def _write(self, index, data):
+        self.sink.write(data)
+        self.sink.flush()
+        if self.on_merged:
+            self.on_merged(index, len(data))
+        self.next_index = index + 1
+
+    def abort(self, error):
+        with self._cond:
+            self._error = error
+            self._buffer.clear()
+            self._buffered = 0
+            self._cond.notify_all()
+
+
+def record_response(response):
+    """统计响应状态码和连接池内部自动重试过的次数，返回期间是否遇到过限流"""
+    throttled = response.status_code in THROTTLE_STATUS
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None:
+        for attempt in retries.history:
+            job_metrics.record_retry()
+            job_metrics.record_status(attempt.status or 'error')
+            throttled = throttled or attempt.status is None or attempt.status in THROTTLE_STATUS
+    job_metrics.record_status(response.status_code)
+    return throttled
+
+
+def fetch_segment(segment, span=None):
+    """从源站流式下载单个分片的原始内容，返回字节串；span 不为空时补充等待并发名额和首字节的耗时"""
+    url = segment.uri
+    headers = {}
+    if segment.byterange:
+        offset, length = segment.byterange
+        headers['Range'] = f'bytes={offset}-{offset + length - 1}'
+    # 按主机的 AIMD 并发名额，限流或变慢时自动收缩
+    queued = time.time()
+    with concurrency.slot(url) as outcome:
+        start = time.time()
+        response = fetch(url, stream=True, headers=headers)
+        # 以首字节耗时衡量主机拥塞程度，不受带宽限速影响
+        outcome['latency'] = response.elapsed.total_seconds()
+        if span is not None:
+            span['slot_wait'] = round(start - queued, 6)
+            span['ttfb'] = round(outcome['latency'], 6)
+        if record_response(response):
+            outcome['ok'] = False
+        response.raise_for_status()
+        data = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            bandwidth.consume(len(chunk))
+            data += chunk
+        received = len(data)
+        expected = response.headers.get('Content-Length')
+        if expected and 'Content-Encoding' not in response.headers and int(expected) != received:
+            raise requests.RequestException(f"分片大小不符: {received}/{expected}")
+        # 源站忽略 Range 返回了整个资源时，自行截取
+        if segment.byterange and response.status_code == 200:
+            data = data[offset:offset + length]
+    job_metrics.record_segment(time.time() - start, received)
+    return bytes(data)
+
+
+def download_segment(segment):
+    """下载单个分片，先查分片缓存，加密分片在下载线程里解密，失败时重试，返回分片内容"""
+    with tracer.span('segment', 'segment', sequence=segment.sequence) as span:
+        return _download_segment(segment, span)
+
+
+def _download_segment(segment, span):
+    url = segment.uri
+    cache_key = SegmentCache.key(url, segment.byterange)
+    data = segment_cache.get(cache_key)
+    if data is not None:
+        job_metrics.record_cache_hit(len(data))
+        span['cache_hit'] = True
+    last_error = None
+    for attempt in range(1, segment_retries + 1):
+        span['attempts'] = attempt
+        try:
+            if data is None:
+                data = fetch_segment(segment, span)
+                if segment_cache.enabled:
+                    job_metrics.record_cache_miss()
+                    segment_cache.put(cache_key, data)
+            span['bytes'] = len(data)
+            if not segment.key:
+                return data
+            decryptor = SegmentDecryptor(get_key(segment.key.uri), segment_iv(segment.key, segment.sequence))
+            return decryptor.update(data) + decryptor.finalize()
+        except (requests.RequestException, ValueError) as e:
+            last_error = e
+            # 缓存或下载的内容无法解密时重新下载
+            data = None
+            if isinstance(e, requests.ConnectionError):
+                job_metrics.record_status('error')
+            if attempt < segment_retries:
+                job_metrics.record_retry()
+            logger.warning(f"分片下载失败({attempt}/{segment_retries}): {url} {e}")
+    raise Exception(f"分片下载失败: {url} {last_error}")
+
+
+def fetch_and_merge(segment, index, merger):
+    merger.put(index, download_segment(segment))
+
+
+def fetch_and_merge_live(segment, index, merger):
+    """下载并合并直播分片，返回合并的时长；重试后仍下载失败时跳过该分片，返回 None
+
+    直播分片滑出窗口后无法补录，跳过时向合并器写入空分片，后续分片照常合并。
+    """
+    try:
+        data = download_segment(segment)
+    except Exception as e:
+        logger.warning(f"直播分片 {segment.sequence} 下载失败，已跳过: {e}")
+        merger.put(index, b'')
+        return None
+    merger.put(index, data)
+    return segment.duration
+
+
+def download_segments(segments, merger, workers=None):
+    """从合并器的下一个分片开始并发下载剩余分片，按顺序写入输出"""
+    workers = workers or download_workers
+    total_segments = len(segments)
+    completed = merger.next_index
+    job_metrics.total_segments = total_segments - merger.next_index
+    if completed:
+        update_progress(min(100, (completed / total_segments) * 100), completed, total_segments)
+
+    # 与 ffmpeg 模式一致，每 10% 记录一次日志，不逐个分片记录
+    logged_step = None
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            tracer.span('segments', 'segment', first=merger.next_index, total=total_segments, workers=workers):
+        futures = [
+            executor.submit(fetch_and_merge, segments[i], i, merger)
+            for i in range(merger.next_index, total_segments)
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+                completed += 1
+                progress = min(100, (completed / total_segments) * 100)
+                update_progress(progress, completed, total_segments)
+                step = int(progress // 10)
+                if step != logged_step:
+                    logged_step = step
+                    logger.info(f"下载进度: {progress:.2f}% ({completed}/{total_segments})")
+        except Exception as e:
+            for future in futures:
+                future.cancel()
+            merger.abort(e)
+            raise
+
+
+def remux_command(input_file, output_file):
+    return [
+        'ffmpeg', '-y',
+        '-i', input_file,
+        '-c', 'copy',
+        '-bsf:a', 'aac_adtstoasc',
+        output_file
+    ]
+
+
+def remux(input_file, output_file):
+    """使用ffmpeg将合并后的ts无损封装为mp4"""
+    with tracer.span('remux', 'remux'):
+        returncode, stderr_tail = run_ffmpeg(remux_command(input_file, output_file))
+    if returncode != 0:
+        logger.error("ffmpeg 输出:\n" + '\n'.join(stderr_tail))
+        raise Exception(f"FFmpeg 封装失败: {stderr_tail[-1]}" if stderr_tail else "FFmpeg 封装失败")
+
+
+def finish_output(merged_file, output_file, fragmented=False):
+    """把合并好的 ts 封装为 mp4（REMUX_MODE=none 时直接改名为 ts），返回最终文件路径
+
+    fragmented 为 True 时合并结果是带初始化分片的 fMP4，不封装时保留 mp4 扩展名。
+    """
+    if remux_mode == 'none':
+        output_file = os.path.splitext(output_file)[0] + ('.mp4' if fragmented else '.ts')
+        with tracer.span('move', 'output'):
+            os.replace(merged_file, output_file)
+    else:
+        logger.info("开始封装mp4")
+        remux(merged_file, output_file)
+    return output_file
+
+
+def open_sink(job_dir, output_file):
+    """打开直播录制的输出流：pipe 模式为 ffmpeg 的标准输入，否则为任务目录中的 merged.ts"""
+    if remux_mode == 'pipe':
+        ffmpeg_log = open(os.path.join(job_dir, 'ffmpeg.log'), 'w')
+        process = subprocess.Popen(remux_command('pipe:0', output_file), stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=ffmpeg_log)
+        ffmpeg_log.close()
+        return process.stdin, process
+    return open(os.path.join(job_dir, 'merged.ts'), 'wb'), None
+
+
+def refresh_playlist(playlist):
+    """重新获取直播媒体播放列表，失败时返回 None"""
+    content = get_m3u8_content(playlist.url)
+    if not content:
+        return None
+    refreshed = parse_playlist(content, playlist.url)
+    if not isinstance(refreshed, MediaPlaylist):
+        logger.error("直播播放列表刷新后不是媒体播放列表")
+        return None
+    return refreshed
+
+
+def record_live(playlist, merger, workers=None):
+    """按 EXT-X-TARGETDURATION 轮询直播播放列表，按媒体序号找出新分片并发下载，按顺序合并
+
+    新分片提交给线程池后立即继续轮询，不等待下载完成，录制不会落后于直播边缘。
+    遇到 EXT-X-ENDLIST、达到 LIVE_MAX_DURATION、超过三个目标时长没有新分片或收到停止信号时结束。
+    单个分片下载失败只跳过该分片；播放列表连续刷新失败或写入输出失败时中止录制，
+    已合并的内容保留。返回 (录制的分片数, 录制时长, 中止录制的异常或 None)。
+    """
+    workers = workers or download_workers
+    last_sequence = None
+    last_init = None
+    recorded = 0.0
+    failures = 0
+    idle_since = time.time()
+    submitted = 0
+    completed = 0
+    skipped = 0
+    error = None
+    # 提交的下载任务 -> 合并序号，以及已下载分片的合并序号 -> 时长
+    pending = {}
+    durations = {}
+
+    def collect(future, index):
+        nonlocal completed, skipped
+        duration = future.result()
+        if duration is None:
+            skipped += 1
+        else:
+            completed += 1
+            durations[index] = duration
+
+    def report():
+        update_progress(min(100, recorded / live_max_duration * 100) if live_max_duration else 0,
+                        completed, submitted,
+                        live={'recorded_seconds': round(recorded, 3), 'media_sequence': last_sequence})
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                changed = False
+                for segment in playlist.segments:
+                    if last_sequence is not None and segment.sequence <= last_sequence:
+                        continue
+                    if live_max_duration and recorded >= live_max_duration:
+                        break
+                    if last_sequence is not None and segment.sequence > last_sequence + 1:
+                        logger.warning(f"直播分片 {last_sequence + 1}-{segment.sequence - 1} 已滑出播放列表，无法录制")
+                    if segment.init is not None and segment.init != last_init:
+                        # fMP4 直播在初始化分片首次出现和变化时先写入初始化分片
+                        pending[executor.submit(fetch_and_merge_live, init_segment(segment), submitted, merger)] = submitted
+                        submitted += 1
+                    last_init = segment.init
+                    pending[executor.submit(fetch_and_merge_live, segment, submitted, merger)] = submitted
+                    submitted += 1
+                    recorded += segment.duration
+                    last_sequence = segment.sequence
+                    changed = True
+                job_metrics.total_segments = submitted
+                if changed:
+                    idle_since = time.time()
+
+                for future in [future for future in pending if future.done()]:
+                    collect(future, pending.pop(future))
+                report()
+
+                if playlist.endlist:
+                    logger.info("直播已结束")
+                    break
+                if live_max_duration and recorded >= live_max_duration:
+                    logger.info(f"已录制 {recorded:.1f} 秒，达到时长上限")
+                    break
+                target = playlist.target_duration or 1
+                # 部分点播播放列表缺少 EXT-X-ENDLIST，长时间没有新分片时视为已结束
+                if time.time() - idle_since > target * 3:
+                    logger.info("播放列表长时间未更新，视为已结束")
+                    break
+                # 播放列表未更新时按半个目标时长重试
+                if stop_event.wait(target if changed else target / 2):
+                    logger.info("收到停止请求，结束录制")
+                    break
+
+                refreshed = refresh_playlist(playlist)
+                if refreshed is None:
+                    failures += 1
+                    if failures >= live_refresh_failures:
+                        # 已提交的分片继续下载合并，不再轮询新分片
+                        error = Exception(f"直播播放列表连续 {failures} 次刷新失败")
+                        logger.error(f"{error}，停止录制")
+                        break
+                    continue
+                failures = 0
+                playlist = refreshed
+
+            for future in as_completed(pending):
+                collect(future, pending[future])
+                report()
+        except Exception as e:
+            # 写入输出失败，后面的分片已无法合并
+            logger.error(f"合并直播分片出错: {str(e)}")
+            for future in pending:
+                future.cancel()
+            merger.abort(e)
+            error = e
+    if skipped:
+        logger.warning(f"共跳过 {skipped} 个下载失败的直播分片")
+    # 写入出错时，重排缓冲区里尚未写出的分片不计入
+    written = [duration for index, duration in durations.items() if index < merger.next_index]
+    completed, recorded = len(written), sum(written)
+    logger.info(f"直播录制结束，共 {completed} 个分片，约 {recorded:.1f} 秒")
+    return completed, recorded, error
+
+
+def execute_live(playlist, output_file, workers=None):
+    """录制直播流，结束后按 REMUX_MODE 输出；录制中止时仍输出已录制的内容，但任务记为失败"""
+    completed = 0
+    recorded = 0.0
+    try:
+        recording_live.set()
+        logger.info(f"检测到直播播放列表，开始录制，并发数: {workers or download_workers}，"
+                    f"时长上限: {live_max_duration or '不限'}")
+        job_dir = get_job_dir(playlist.url)
+        # 直播无法断点续传，每次重新录制
+        shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(job_dir, exist_ok=True)
+
+        sink, process = open_sink(job_dir, output_file)
+        try:
+            merger = OrderedMerger(sink, 0, reorder_buffer_mb * 1024 * 1024)
+            with tracer.span('record_live', 'segment'):
+                completed, recorded, error = record_live(playlist, merger, workers)
+        finally:
+            sink.close()
+            if process:
+                process.wait()
+        if completed == 0:
+            raise error or Exception("没有录制到任何分片")
+        if process:
+            if process.returncode != 0:
+                raise Exception("FFmpeg 封装失败")
+        else:
+            output_file = finish_output(os.path.join(job_dir, 'merged.ts'), output_file, playlist.fragmented)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+        if error is not None:
+            logger.error(f"录制中止: {str(error)}，已保存录制的 {completed} 个分片: {output_file}")
+            update_progress(0, completed, completed, status='failed', error=str(error), output_file=output_file,
+                            duration=round(recorded, 3))
+            return False
+        logger.info(f"录制完成: {output_file}")
+        update_progress(100, completed, completed, status='completed', output_file=output_file,
+                        duration=round(recorded, 3))
+        return True
+
+    except Exception as e:
+        logger.error(f"录制出错: {str(e)}")
+        update_progress(0, completed, completed, status='failed', error=str(e))
+        return False
+
+
+def handle_stop_signal(signum, frame):
+    """录制直播时收到 SIGTERM 或 SIGINT（Ctrl+C）停止录制并保存已录制的内容，其他情况按默认行为退出"""
+    if recording_live.is_set():
+        stop_event.set()
+        return
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def execute_download(m3u8_url, output_file, workers=None):
+    """解析播放列表，并发下载分片，按顺序合并后封装为mp4"""
+    total_segments = 0
+    try:
+        with tracer.span('resolve_playlist', 'playlist'):
+            playlist = resolve_media_playlist(m3u8_url)
+        if not playlist:
+            raise Exception("获取M3U8文件失败")
+
+        # 只支持 AES-128 整段加密，SAMPLE-AES 等交给ffmpeg处理
+        unsupported = playlist.encryption_methods - {'AES-128'}
+        if unsupported:
+            logger.info(f"检测到不支持的加密方式 {unsupported}，改用ffmpeg模式下载")
+            return execute_ffmpeg(m3u8_url, output_file, playlist)
+        # 视频和独立音轨需要分别下载再合流，交给ffmpeg处理
+        if playlist.audio_url:
+            logger.info("选中的版本使用独立音轨，改用ffmpeg模式下载")
+            return execute_ffmpeg(m3u8_url, output_file, playlist)
+        if playlist.encryption_methods:
+            logger.info("检测到 AES-128 加密播放列表，下载时解密")
+        if not playlist.endlist:
+            return execute_live(playlist, output_file, workers)
+
+        if not playlist.segments:
+            raise Exception("播放列表中没有分片")
+        if playlist.fragmented:
+            logger.info("检测到 fMP4 分片，合并时写入初始化分片")
+        # fMP4 的初始化分片和媒体分片一起按顺序下载合并，断点清单和进度也把它计为一个分片
+        segments = with_init_sections(playlist.segments)
+        total_segments = len(segments)
+        logger.info(f"总片段数: {total_segments}，并发数: {workers or download_workers}，封装方式: {remux_mode}")
+        update_progress(0, 0, total_segments)
+
+        job_dir = get_job_dir(m3u8_url)
+        os.makedirs(job_dir, exist_ok=True)
+        buffer_limit = reorder_buffer_mb * 1024 * 1024
+
+        if remux_mode == 'pipe':
+            # 分片按顺序直接送入ffmpeg封装，不落地中间文件，也不支持断点续传
+            with open(os.path.join(job_dir, 'ffmpeg.log'), 'w') as ffmpeg_log:
+                process = subprocess.Popen(remux_command('pipe:0', output_file), stdin=subprocess.PIPE,
+                                           stdout=subprocess.DEVNULL, stderr=ffmpeg_log)
+                try:
+                    download_segments(segments, OrderedMerger(process.stdin, 0, buffer_limit), workers)
+                finally:
+                    process.stdin.close()
+                    # 分片全部送入后 ffmpeg 还需写完剩余数据
+                    with tracer.span('remux', 'remux'):
+                        process.wait()
+            if process.returncode != 0:
+                raise Exception("FFmpeg 封装失败")
+        else:
+            merged_file = os.path.join(job_dir, 'merged.ts')
+            manifest = SegmentManifest(job_dir, m3u8_url, segments, merged_file)
+            try:
+                with open(merged_file, 'ab') as sink:
+                    merger = OrderedMerger(sink, manifest.merged_count, buffer_limit, manifest.mark_merged)
+                    download_segments(segments, merger, workers)
+            finally:
+                manifest.close()
+
+            output_file = finish_output(merged_file, output_file, playlist.fragmented)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+        logger.info(f"下载完成: {output_file}")
+        update_progress(100, total_segments, total_segments, status='completed', output_file=output_file,
+                        duration=round(playlist.total_duration, 3))
+        return True
+
+    except Exception as e:
+        logger.error(f"执行出错: {str(e)}")
+        update_progress(0, 0, total_segments, status='failed', error=str(e))
+        return False
+
+
+def build_output_file(video_title):
+    """生成输出文件名"""
     nowtime = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     # 确保输出目录存在
     os.makedirs(f"{output_dir}/videos", exist_ok=True)
     if video_title:
-        output_file = f"{output_dir}/videos/{video_title}_{nowtime}.mp4"
-    else:
-        output_file = f"{output_dir}/videos/merged_video_{nowtime}.mp4"
+        return f"{output_dir}/videos/{video_title}_{nowtime}.mp4"
+    return f"{output_dir}/videos/merged_video_{nowtime}.mp4"
+
+
+def run_from_env():
+    """从环境变量 M3U8_URL、VIDEO_TITLE 读取参数，在本进程中下载一个视频，Web 进程即以这种方式调用"""
+    m3u8_url = os.getenv("M3U8_URL")
+    video_title = os.getenv("VIDEO_TITLE", "")
 
+    if not m3u8_url:
+        logger.error("请设置环境变量 M3U8_URL，或通过命令行参数指定地址")
+        return 1
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+
+    output_file = build_output_file(video_title)
     logger.info(f"output_dir: {output_dir}")
     logger.info(f"output_file: {output_file}")
-    execute_ffmpeg(m3u8_url, output_file)
+    logger.info(f"下载模式: {download_mode}")
+    try:
+        with tracer.span('download', 'job', mode=download_mode) as span:
+            if download_mode == 'ffmpeg':
+                success = execute_ffmpeg(m3u8_url, output_file)
+            else:
+                success = execute_download(m3u8_url, output_file)
+            span['success'] = success
+    finally:
+        if trace_file:
+            try:
+                tracer.save(trace_file)
+            except OSError as e:
+                logger.warning(f"保存时间线失败: {e}")
+    return 0 if success else 1
+
+
+def read_batch(stream):
+    """读取 "地址<TAB>标题" 格式的批量列表，标题可省略，忽略空行和 # 开头的注释"""
+    items = []
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        url, _, title = line.partition('\t')
+        # 标题用作文件名，替换不能出现在文件名中的字符
+        items.append((url.strip(), re.sub(r'[\\/:*?"<>|]', '_', title).strip()))
+    return items
+
+
+class BatchRunner:
+    """命令行批量下载：每个条目在单独的子进程中按环境变量方式下载
+
+    子进程各自有独立的下载指标、并发控制和停止信号，与 Web 进程调用时完全一致；
+    本进程把子进程的进度事件加上条目编号后转发到标准输出，最后输出汇总。
+    同一地址的条目共用临时目录，不会同时下载，后面的条目等前一个结束后再开始。
+    """
+
+    def __init__(self, parallel=1, workers=None, mode=None):
+        self.parallel = max(1, parallel)
+        self.workers = workers
+        self.mode = mode
+        self.stopping = False
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._running = set()
+        self._cond = threading.Condition()
+
+    def emit(self, event):
+        with self._lock:
+            sys.stdout.write(json.dumps(event, ensure_ascii=False) + '\n')
+            sys.stdout.flush()
+
+    def stop(self, signum=None, frame=None):
+        """停止所有正在下载的条目，尚未开始的条目不再启动；直播录制会保存已录制的内容"""
+        self.stopping = True
+        with self._lock:
+            for process in self._processes:
+                process.send_signal(signal.SIGTERM)
+
+    def claim(self):
+        """取出第一个地址不在下载中的条目并标记其地址，全部取完返回 None"""
+        with self._cond:
+            while self._pending:
+                for position, (index, url, title) in enumerate(self._pending):
+                    if url not in self._running:
+                        del self._pending[position]
+                        self._running.add(url)
+                        return index, url, title
+                self._cond.wait()
+            return None
+
+    def release(self, url):
+        with self._cond:
+            self._running.discard(url)
+            self._cond.notify_all()
+
+    def run_item(self, index, url, title):
+        start = time.time()
+        result = {'index': index, 'url': url, 'title': title, 'status': 'failed', 'elapsed_seconds': 0,
+                  'bytes_downloaded': 0, 'segments': 0, 'cache_hits': 0, 'output_file': None, 'error': None}
+        if self.stopping:
+            result['error'] = '已停止'
+            return result
+
+        env = os.environ.copy()
+        env['M3U8_URL'] = url
+        env['VIDEO_TITLE'] = title
+        if self.workers:
+            env['DOWNLOAD_WORKERS'] = str(self.workers)
+        if self.mode:
+            env['DOWNLOAD_MODE'] = self.mode
+        # 日志照常写到标准错误，标准输出只用于进度事件；
+        # 子进程在单独的会话中运行，终端的 Ctrl+C 只发给本进程，由 stop 转发为 SIGTERM
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env,
+                                   stdout=subprocess.PIPE, universal_newlines=True, encoding='utf-8',
+                                   start_new_session=True)
+        with self._lock:
+            self._processes.add(process)
+        last = {}
+        try:
+            for line in process.stdout:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(event, dict):
+                    continue
+                last = event
+                self.emit({**event, 'item': index, 'url': url})
+            process.wait()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+
+        metrics = last.get('metrics') or {}
+        result.update(
+            status='completed' if last.get('status') == 'completed' else 'failed',
+            elapsed_seconds=round(time.time() - start, 3),
+            bytes_downloaded=metrics.get('bytes_downloaded', 0),
+            segments=last.get('current_segments') or 0,
+            cache_hits=metrics.get('cache_hits', 0),
+            output_file=last.get('output_file'),
+            error=last.get('error') or (None if last.get('status') == 'completed'
+                                        else f"下载进程退出码 {process.returncode}")
+        )
+        return result
+
+    def run(self, items):
+        start = time.time()
+        self._pending = [(index, url, title) for index, (url, title) in enumerate(items)]
+        results = [None] * len(items)
+
+        def work():
+            while True:
+                claimed = self.claim()
+                if claimed is None:
+                    return
+                index, url, title = claimed
+                try:
+                    results[index] = self.run_item(index, url, title)
+                finally:
+                    self.release(url)
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            for future in [executor.submit(work) for _ in range(self.parallel)]:
+                future.result()
+        summary = {
+            'event': 'summary',
+            'total': len(results),
+            'completed': sum(1 for r in results if r['status'] == 'completed'),
+            'failed': sum(1 for r in results if r['status'] != 'completed'),
+            'elapsed_seconds': round(time.time() - start, 3),
+            'bytes_downloaded': sum(r['bytes_downloaded'] for r in results),
+            'items': results
+        }
+        self.emit(summary)
+        for r in results:
+            logger.info(f"[{r['status']}] {r['url']} 耗时 {r['elapsed_seconds']} 秒，"
+                        f"{r['bytes_downloaded'] / 1024 / 1024:.2f} MB {r['error'] or r['output_file'] or ''}")
+        return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='下载 M3U8 视频。标准输出为 JSON Lines 格式的进度事件，最后一行为汇总；日志写到标准错误。'
+                    '不带参数时从环境变量 M3U8_URL、VIDEO_TITLE 读取。'
+    )
+    parser.add_argument('url', nargs='?', help='m3u8 地址')
+    parser.add_argument('-t', '--title', default='', help='视频标题，用作文件名')
+    parser.add_argument('-i', '--input', help='批量列表文件，每行 "地址<TAB>标题"，- 表示从标准输入读取')
+    parser.add_argument('-j', '--parallel', type=int, default=1, help='同时下载的条目数（默认：1）')
+    parser.add_argument('-w', '--workers', type=int, help='每个条目并发下载分片的线程数（默认：DOWNLOAD_WORKERS）')
+    parser.add_argument('--mode', choices=('native', 'ffmpeg'), help='下载模式（默认：DOWNLOAD_MODE）')
+    args = parser.parse_args(argv)
+    if args.url and args.input:
+        parser.error('地址和 --input 只能指定一个')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.url and not args.input:
+        return run_from_env()
+
+    if args.input == '-':
+        items = read_batch(sys.stdin)
+    elif args.input:
+        with open(args.input, encoding='utf-8') as f:
+            items = read_batch(f)
+    else:
+        items = [(args.url, args.title)]
+    if not items:
+        logger.error("没有需要下载的地址")
+        return 1
+
+    runner = BatchRunner(args.parallel, args.workers, args.mode)
+    signal.signal(signal.SIGTERM, runner.stop)
+    signal.signal(signal.SIGINT, runner.stop)
+    summary = runner.run(items)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,14 @@
+# gunicorn.conf.py
+import os
+
+# 监听地址
+bind = os.getenv('SERVER_BIND', '0.0.0.0:5020')
+# 工作进程数，每个进程各有一个任务调度器和浏览器池
+workers = int(os.getenv('SERVER_WORKERS', '4'))
+# 进度推送的 SSE 长连接各占一个线程，使用线程型工作进程
+worker_class = 'gthread'
+threads = int(os.getenv('SERVER_THREADS', '32'))
+# gthread 的超时只检查工作进程主循环是否存活，不限制单个请求的时长
+timeout = 60
+graceful_timeout = 30
+accesslog = '-'
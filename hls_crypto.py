@@ -0,0 +1,62 @@
+# hls_crypto.py
+import threading
+
+from Crypto.Cipher import AES
+
+from http_client import fetch
+
+BLOCK_SIZE = 16
+
+# 密钥 URI -> 密钥内容，同一任务内每个密钥只请求一次
+_keys = {}
+_keys_lock = threading.Lock()
+
+
+def get_key(uri):
+    """获取并缓存 AES-128 密钥"""
+    key = _keys.get(uri)
+    if key is not None:
+        return key
+    with _keys_lock:
+        # 持锁期间其他线程可能已取到同一个密钥
+        if uri not in _keys:
+            response = fetch(uri)
+            response.raise_for_status()
+            if len(response.content) != BLOCK_SIZE:
+                raise ValueError(f"AES-128 密钥长度错误: {len(response.content)}")
+            _keys[uri] = response.content
+        return _keys[uri]
+
+
+def segment_iv(key, sequence):
+    """EXT-X-KEY 未指定 IV 时，以分片的媒体序列号作为 IV"""
+    if key.iv:
+        return bytes.fromhex(key.iv[2:] if key.iv.lower().startswith('0x') else key.iv).rjust(BLOCK_SIZE, b'\0')
+    return sequence.to_bytes(BLOCK_SIZE, 'big')
+
+
+class SegmentDecryptor:
+    """AES-128-CBC 流式解密，边下载边解密，结束时去掉 PKCS7 填充"""
+
+    def __init__(self, key, iv):
+        self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        self._pending = b''
+
+    def update(self, data):
+        self._pending += data
+        # 不足一块的尾部和最后一个完整块留到后面处理，最后一块要在 finalize 时去填充
+        keep = len(self._pending) % BLOCK_SIZE or BLOCK_SIZE
+        ready = len(self._pending) - keep
+        if ready <= 0:
+            return b''
+        chunk, self._pending = self._pending[:ready], self._pending[ready:]
+        return self._cipher.decrypt(chunk)
+
+    def finalize(self):
+        if len(self._pending) != BLOCK_SIZE:
+            raise ValueError("加密分片长度不是16字节的整数倍")
+        plain = self._cipher.decrypt(self._pending)
+        padding = plain[-1]
+        if not 1 <= padding <= BLOCK_SIZE or plain[-padding:] != bytes([padding]) * padding:
+            raise ValueError("加密分片填充错误")
+        return plain[:-padding]
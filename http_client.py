@@ -0,0 +1,134 @@
+# http_client.py
+import os
+import json
+import random
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('m3u8_downloader')
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 15_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'
+}
+
+# 建立连接和读取数据的超时时间（秒）
+http_connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+http_read_timeout = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+# 连接失败、连接被重置、5xx 和 429 时的最大重试次数
+http_retries = int(os.getenv('HTTP_RETRIES', '5'))
+# 指数退避的基数（秒）和单次等待上限（秒）
+http_backoff = float(os.getenv('HTTP_BACKOFF', '0.5'))
+http_backoff_max = float(os.getenv('HTTP_BACKOFF_MAX', '30'))
+# 每个主机的连接池大小
+http_pool_size = int(os.getenv('HTTP_POOL_SIZE', '32'))
+# 每个任务附加的请求头和 cookie，JSON 对象
+http_headers = json.loads(os.getenv('HTTP_HEADERS') or '{}')
+http_cookies = json.loads(os.getenv('HTTP_COOKIES') or '{}')
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url, keep_fragment=False):
+    """规范化地址，使同一资源的不同写法命中同一缓存
+
+    锚点默认忽略；网页地址需要保留，#/video/1 这类前端路由指向不同的页面
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path or '/'
+    # 去掉统计参数并排序
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not k.lower().startswith('utm_'))
+    fragment = parts.fragment if keep_fragment else ''
+    return urlunsplit((scheme, host, path, urlencode(query), fragment))
+
+
+class JitterRetry(Retry):
+    """在指数退避的基础上加入随机抖动，避免并发请求同时重试"""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return 0
+        return min(http_backoff_max, backoff * random.uniform(0.5, 1.5))
+
+
+def build_session(headers=None, cookies=None, retries=http_retries):
+    """创建带连接池、重试和默认请求头的会话"""
+    retry = JitterRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        backoff_factor=http_backoff,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=http_pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(HEADERS)
+    session.headers.update(headers or {})
+    for name, value in (cookies or {}).items():
+        session.cookies.set(name, value)
+    return session
+
+
+_session = None
+_probe_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """返回进程内共享的会话"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session(http_headers, http_cookies)
+    return _session
+
+
+def get_probe_session():
+    """返回进程内共享的不重试会话"""
+    global _probe_session
+    if _probe_session is None:
+        with _session_lock:
+            if _probe_session is None:
+                _probe_session = build_session(http_headers, http_cookies, retries=0)
+    return _probe_session
+
+
+def fetch(url, method='GET', **kwargs):
+    """通过共享会话发起请求，默认带连接/读取超时"""
+    kwargs.setdefault('timeout', (http_connect_timeout, http_read_timeout))
+    return get_session().request(method, url, **kwargs)
+
+
+def probe(url, method='GET', **kwargs):
+    """不重试的请求，用于解析网页这类失败后还有其他办法的场景，避免退避等待拖慢后续步骤"""
+    kwargs.setdefault('timeout', (http_connect_timeout, http_read_timeout))
+    return get_probe_session().request(method, url, **kwargs)
+
+
+def request_headers():
+    """共享会话实际发送的请求头（含 cookie），供 ffmpeg 等外部程序使用"""
+    session = get_session()
+    headers = dict(session.headers)
+    cookies = '; '.join(f'{name}={value}' for name, value in session.cookies.items())
+    if cookies:
+        headers['Cookie'] = cookies
+    return headers
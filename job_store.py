@@ -0,0 +1,517 @@
+# job_store.py
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import datetime
+import threading
+
+from download_m3u8 import output_dir, setup_logger
+from metrics import empty_totals, add_totals
+
+logger = setup_logger()
+
+# 任务状态库的路径，多个 Web 工作进程共享；不要放在网络存储上，SQLite WAL 依赖本地文件锁
+job_store_path = os.getenv('JOB_STORE_PATH', os.path.join(output_dir, 'state', 'jobs.db'))
+# 工作进程超过多少秒没有心跳视为已退出，它名下运行中的任务重新排队
+owner_timeout = float(os.getenv('JOB_OWNER_TIMEOUT', '30'))
+
+# 以 JSON 文本保存的字段
+JSON_FIELDS = ('metrics', 'concurrency', 'live', 'headers', 'cookies', 'postprocess')
+FINISHED_STATUSES = ('completed', 'failed')
+# 后处理尚未结束的状态，这些任务不会被清理
+PENDING_POSTPROCESS = ('queued', 'running')
+
+# 旧版本任务库中没有的列，启动时补上
+MIGRATIONS = (
+    ('jobs', 'output_file', 'TEXT'),
+    ('jobs', 'postprocess_status', 'TEXT'),
+    ('jobs', 'postprocess', 'TEXT'),
+    ('jobs', 'postprocess_owner', 'TEXT'),
+    ('batches', 'options', 'TEXT'),
+    ('batch_items', 'owner', 'TEXT'),
+)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    m3u8_url TEXT NOT NULL,
+    video_title TEXT NOT NULL DEFAULT '',
+    mode TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    current_segments INTEGER NOT NULL DEFAULT 0,
+    total_segments INTEGER NOT NULL DEFAULT 0,
+    workers INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    metrics TEXT,
+    concurrency TEXT,
+    live TEXT,
+    headers TEXT,
+    cookies TEXT,
+    owner TEXT,
+    pid INTEGER,
+    output_file TEXT,
+    postprocess_status TEXT,
+    postprocess TEXT,
+    postprocess_owner TEXT,
+    version INTEGER NOT NULL DEFAULT 0,
+    created_time TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq);
+CREATE INDEX IF NOT EXISTS jobs_output_file ON jobs (output_file);
+CREATE TABLE IF NOT EXISTS owners (
+    owner TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    options TEXT,
+    created_time TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batch_items (
+    batch_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    m3u8_url TEXT,
+    tier TEXT,
+    job_id TEXT,
+    error TEXT,
+    owner TEXT,
+    PRIMARY KEY (batch_id, idx)
+);
+CREATE INDEX IF NOT EXISTS batch_items_status ON batch_items (status);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS resolutions (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    resolved_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resolutions_used_at ON resolutions (used_at);
+'''
+
+
+def is_downloader_process(pid):
+    """确认 pid 仍是本机上的下载进程，避免误杀复用了该 pid 的其他进程"""
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return b'download_m3u8.py' in f.read()
+    except OSError:
+        return False
+
+
+class JobStore:
+    """保存在 SQLite（WAL 模式）中的任务状态，供多个 Web 工作进程共享
+
+    每个线程使用自己的连接；需要先读后写的操作用 BEGIN IMMEDIATE 取得写锁，
+    保证排队任务只会被一个工作进程领取。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # 本进程的标识，记录在它领取的任务上
+        self.host = socket.gethostname()
+        self.owner = f'{self.host}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        self._migrate(conn)
+        conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _migrate(conn):
+        for table, column, kind in MIGRATIONS:
+            columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+            # 表还不存在时由 SCHEMA 按最新结构创建
+            if columns and column not in columns:
+                try:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+                except sqlite3.OperationalError:
+                    # 其他工作进程已同时补上
+                    pass
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # 自动提交模式，事务由 BEGIN 显式开启
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    @staticmethod
+    def _to_job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        for key in JSON_FIELDS:
+            job[key] = json.loads(job[key]) if job[key] else None
+        job['headers'] = job['headers'] or {}
+        job['cookies'] = job['cookies'] or {}
+        return job
+
+    @staticmethod
+    def _insert_job(conn, m3u8_url, video_title, mode, headers, cookies):
+        job_id = uuid.uuid4().hex[:12]
+        conn.execute(
+            'INSERT INTO jobs (id, m3u8_url, video_title, mode, status, headers, cookies, created_time, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, m3u8_url, video_title or '', mode, 'queued', json.dumps(headers or {}),
+             json.dumps(cookies or {}), datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), time.time())
+        )
+        return job_id
+
+    def create(self, m3u8_url, video_title, mode, headers=None, cookies=None):
+        job_id = self._insert_job(self._conn(), m3u8_url, video_title, mode, headers, cookies)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_job(row)
+
+    def latest(self):
+        row = self._conn().execute('SELECT * FROM jobs ORDER BY seq DESC LIMIT 1').fetchone()
+        return self._to_job(row)
+
+    def list(self):
+        rows = self._conn().execute('SELECT * FROM jobs ORDER BY seq').fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def update(self, job_id, **fields):
+        """更新任务字段并递增版本号，SSE 连接据此判断是否有新进度"""
+        columns = ', '.join(f'{key} = ?' for key in fields)
+        values = [json.dumps(value, ensure_ascii=False) if key in JSON_FIELDS and value is not None else value
+                  for key, value in fields.items()]
+        self._conn().execute(
+            f'UPDATE jobs SET {columns}{", " if columns else ""}version = version + 1, updated_at = ? WHERE id = ?',
+            (*values, time.time(), job_id)
+        )
+
+    def count_by_status(self):
+        rows = self._conn().execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def claim_next(self, max_jobs, max_segments, default_workers):
+        """在全局上限内领取最早排队的任务，标记为下载中并记在本进程名下，没有可领取的任务时返回 None"""
+        conn = self._transaction()
+        try:
+            running = conn.execute(
+                "SELECT COUNT(*) AS n, COALESCE(SUM(workers), 0) AS segments FROM jobs WHERE status = 'downloading'"
+            ).fetchone()
+            # 同一地址的任务共用断点续传目录，前一个结束后才领取下一个
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND m3u8_url NOT IN "
+                "(SELECT m3u8_url FROM jobs WHERE status = 'downloading') ORDER BY seq LIMIT 1"
+            ).fetchone()
+            if row is None or running['n'] >= max_jobs or running['segments'] >= max_segments:
+                conn.execute('COMMIT')
+                return None
+            # ffmpeg 模式单连接拉取，只占一个并发名额
+            workers = 1 if row['mode'] == 'ffmpeg' else min(default_workers, max_segments - running['segments'])
+            conn.execute(
+                "UPDATE jobs SET status = 'downloading', workers = ?, owner = ?, pid = NULL, "
+                "version = version + 1, updated_at = ? WHERE id = ?",
+                (workers, self.owner, time.time(), row['id'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(row['id'])
+
+    def cancel_queued(self, job_id, error):
+        """取消仍在排队的任务，返回是否取消成功"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'failed', error = ?, version = version + 1, updated_at = ? "
+            "WHERE id = ? AND status = 'queued'",
+            (error, time.time(), job_id)
+        )
+        return cursor.rowcount > 0
+
+    def finish(self, job_id, status, error=None, progress=None):
+        """结束任务，并把它的下载指标累加到全局计数"""
+        conn = self._transaction()
+        try:
+            row = conn.execute('SELECT metrics, progress FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, progress = ?, pid = NULL, version = version + 1, '
+                'updated_at = ? WHERE id = ?',
+                (status, error, row['progress'] if progress is None else progress, time.time(), job_id)
+            )
+            # 批量任务中的项记下最终状态，任务记录被清理后仍能显示结果
+            conn.execute('UPDATE batch_items SET status = ?, error = COALESCE(?, error) WHERE job_id = ?',
+                         (status, error, job_id))
+            if row['metrics']:
+                totals = self._load_totals(conn)
+                add_totals(totals, json.loads(row['metrics']))
+                conn.execute("INSERT OR REPLACE INTO totals (name, value) VALUES ('metrics', ?)",
+                             (json.dumps(totals),))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _load_totals(conn):
+        row = conn.execute("SELECT value FROM totals WHERE name = 'metrics'").fetchone()
+        return json.loads(row['value']) if row else empty_totals()
+
+    def totals(self):
+        """已结束任务累加的全局下载指标"""
+        return self._load_totals(self._conn())
+
+    def get_resolution(self, key):
+        """返回网页解析缓存中的条目，不存在时返回 None"""
+        row = self._conn().execute('SELECT * FROM resolutions WHERE key = ?', (key,)).fetchone()
+        return dict(row) if row else None
+
+    def touch_resolution(self, key):
+        self._conn().execute('UPDATE resolutions SET used_at = ? WHERE key = ?', (time.time(), key))
+
+    def put_resolution(self, key, url, title, max_entries):
+        """保存网页解析结果，超出条目上限时淘汰最久未使用的条目"""
+        now = time.time()
+        conn = self._transaction()
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO resolutions (key, url, title, resolved_at, used_at) VALUES (?, ?, ?, ?, ?)',
+                (key, url, title or '', now, now)
+            )
+            conn.execute(
+                'DELETE FROM resolutions WHERE key NOT IN (SELECT key FROM resolutions ORDER BY used_at DESC LIMIT ?)',
+                (max_entries,)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete_resolution(self, key):
+        self._conn().execute('DELETE FROM resolutions WHERE key = ?', (key,))
+
+    def trim(self, max_history):
+        """只保留最近的已结束任务"""
+        self._conn().execute(
+            'DELETE FROM jobs WHERE status IN (?, ?) AND COALESCE(postprocess_status, \'\') NOT IN (?, ?) '
+            'AND seq NOT IN (SELECT seq FROM jobs WHERE status IN (?, ?) ORDER BY seq DESC LIMIT ?)',
+            (*FINISHED_STATUSES, *PENDING_POSTPROCESS, *FINISHED_STATUSES, max_history)
+        )
+
+    def queue_postprocess(self, job_id, output_file, expected_duration=None):
+        """下载完成后登记输出文件，加入后处理队列"""
+        self.update(job_id, output_file=output_file, postprocess_status='queued',
+                    postprocess={'expected_duration': expected_duration})
+
+    def claim_postprocess(self, max_running):
+        """在全局上限内领取最早排队的后处理任务，标记为运行中并记在本进程名下，没有可领取的任务时返回 None"""
+        conn = self._transaction()
+        try:
+            running = conn.execute(
+                "SELECT COUNT(*) AS n FROM jobs WHERE postprocess_status = 'running'"
+            ).fetchone()['n']
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE postprocess_status = 'queued' ORDER BY seq LIMIT 1"
+            ).fetchone()
+            if row is None or running >= max_running:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE jobs SET postprocess_status = 'running', postprocess_owner = ?, "
+                "version = version + 1, updated_at = ? WHERE id = ?",
+                (self.owner, time.time(), row['id'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(row['id'])
+
+    def finish_postprocess(self, job_id, status, result):
+        self.update(job_id, postprocess_status=status, postprocess=result, postprocess_owner=None)
+
+    def postprocess_by_files(self, paths):
+        """按输出文件路径查询后处理状态，返回 {路径: 任务}，用于在文件列表中显示"""
+        if not paths:
+            return {}
+        placeholders = ', '.join('?' for _ in paths)
+        rows = self._conn().execute(
+            f'SELECT * FROM jobs WHERE output_file IN ({placeholders}) ORDER BY seq', list(paths)
+        ).fetchall()
+        # 同一文件只取最近的任务
+        return {row['output_file']: self._to_job(row) for row in rows}
+
+    def create_batch(self, items, options=None):
+        """创建批量任务，items 为 (url, title) 列表，每项初始为 pending 等待领取解析，返回批量任务ID
+
+        options 为对所有项生效的下载选项，保存在库中，任何工作进程领取到其中的项都能使用。
+        """
+        batch_id = uuid.uuid4().hex[:12]
+        conn = self._transaction()
+        try:
+            conn.execute('INSERT INTO batches (id, options, created_time) VALUES (?, ?, ?)',
+                         (batch_id, json.dumps(options or {}), datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.executemany(
+                "INSERT INTO batch_items (batch_id, idx, url, title, status) VALUES (?, ?, ?, ?, 'pending')",
+                [(batch_id, idx, url, title or '') for idx, (url, title) in enumerate(items)]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return batch_id
+
+    def claim_batch_item(self, max_running):
+        """在全局上限内领取最早提交的待解析项，标记为解析中并记在本进程名下，没有可领取的项时返回 None"""
+        conn = self._transaction()
+        try:
+            running = conn.execute(
+                "SELECT COUNT(*) AS n FROM batch_items WHERE status = 'resolving'"
+            ).fetchone()['n']
+            row = conn.execute(
+                "SELECT batch_items.*, batches.options FROM batch_items JOIN batches ON batches.id = batch_items.batch_id "
+                "WHERE batch_items.status = 'pending' ORDER BY batches.seq, batch_items.idx LIMIT 1"
+            ).fetchone()
+            if row is None or running >= max_running:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE batch_items SET status = 'resolving', owner = ? WHERE batch_id = ? AND idx = ?",
+                (self.owner, row['batch_id'], row['idx'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        item = dict(row)
+        item['options'] = json.loads(item['options']) if item['options'] else {}
+        return item
+
+    def queue_batch_item(self, batch_id, idx, m3u8_url, video_title, tier, mode, headers=None, cookies=None):
+        """为解析完成的项创建下载任务，并在同一事务中把该项标记为已入队，返回任务
+
+        工作进程在两步之间退出时不会留下已创建任务却仍待解析的项，重新解析时也不会重复创建任务。
+        """
+        conn = self._transaction()
+        try:
+            job_id = self._insert_job(conn, m3u8_url, video_title, mode, headers, cookies)
+            conn.execute(
+                "UPDATE batch_items SET status = 'queued', m3u8_url = ?, tier = ?, title = ?, job_id = ?, owner = NULL "
+                "WHERE batch_id = ? AND idx = ?",
+                (m3u8_url, tier, video_title or '', job_id, batch_id, idx)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(job_id)
+
+    def update_batch_item(self, batch_id, idx, **fields):
+        columns = ', '.join(f'{key} = ?' for key in fields)
+        self._conn().execute(f'UPDATE batch_items SET {columns} WHERE batch_id = ? AND idx = ?',
+                             (*fields.values(), batch_id, idx))
+
+    def get_batch(self, batch_id):
+        """返回批量任务及每一项的状态，已入队的项带上对应下载任务的状态和进度
+
+        任务记录已被清理的项 job_status 为空，此时项自身的状态即任务的最终状态。
+        """
+        conn = self._conn()
+        batch = conn.execute('SELECT * FROM batches WHERE id = ?', (batch_id,)).fetchone()
+        if batch is None:
+            return None
+        rows = conn.execute(
+            'SELECT batch_items.*, jobs.status AS job_status, jobs.progress AS job_progress, '
+            'jobs.error AS job_error FROM batch_items LEFT JOIN jobs ON jobs.id = batch_items.job_id '
+            'WHERE batch_id = ? ORDER BY idx',
+            (batch_id,)
+        ).fetchall()
+        return {'id': batch['id'], 'created_time': batch['created_time'], 'items': [dict(row) for row in rows]}
+
+    def trim_batches(self, max_history):
+        """只保留最近的批量任务"""
+        conn = self._transaction()
+        try:
+            stale = [row['id'] for row in conn.execute(
+                'SELECT id FROM batches ORDER BY seq DESC LIMIT -1 OFFSET ?', (max_history,))]
+            for batch_id in stale:
+                conn.execute('DELETE FROM batch_items WHERE batch_id = ?', (batch_id,))
+                conn.execute('DELETE FROM batches WHERE id = ?', (batch_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def heartbeat(self):
+        self._conn().execute('INSERT OR REPLACE INTO owners (owner, heartbeat) VALUES (?, ?)',
+                             (self.owner, time.time()))
+
+    def recover(self):
+        """把心跳超时的工作进程名下运行中的任务、后处理和批量解析重新排队，返回本机上遗留的下载进程 pid
+
+        任务重新开始时会从断点继续；遗留的下载进程需要先结束，避免两个进程写同一个任务目录。
+        """
+        deadline = time.time() - owner_timeout
+        conn = self._transaction()
+        try:
+            alive = {row['owner'] for row in conn.execute('SELECT owner FROM owners WHERE heartbeat >= ?', (deadline,))}
+            alive.add(self.owner)
+            rows = conn.execute("SELECT id, owner, pid FROM jobs WHERE status = 'downloading'").fetchall()
+            orphaned = [row for row in rows if row['owner'] not in alive]
+            for row in orphaned:
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', workers = 0, owner = NULL, pid = NULL, "
+                    "version = version + 1, updated_at = ? WHERE id = ?",
+                    (time.time(), row['id'])
+                )
+                logger.warning(f"任务 {row['id']} 所在的工作进程 {row['owner']} 已退出，重新排队")
+            rows = conn.execute(
+                "SELECT id, postprocess_owner FROM jobs WHERE postprocess_status = 'running'"
+            ).fetchall()
+            for row in rows:
+                if row['postprocess_owner'] not in alive:
+                    conn.execute(
+                        "UPDATE jobs SET postprocess_status = 'queued', postprocess_owner = NULL, "
+                        "version = version + 1, updated_at = ? WHERE id = ?",
+                        (time.time(), row['id'])
+                    )
+                    logger.warning(f"任务 {row['id']} 的后处理所在的工作进程 {row['postprocess_owner']} 已退出，重新排队")
+            rows = conn.execute(
+                "SELECT batch_id, idx, owner FROM batch_items WHERE status = 'resolving'"
+            ).fetchall()
+            for row in rows:
+                if row['owner'] not in alive:
+                    conn.execute(
+                        "UPDATE batch_items SET status = 'pending', owner = NULL WHERE batch_id = ? AND idx = ?",
+                        (row['batch_id'], row['idx'])
+                    )
+                    logger.warning(f"批量任务 {row['batch_id']} 第 {row['idx'] + 1} 项所在的工作进程 {row['owner']} 已退出，重新排队")
+            conn.execute('DELETE FROM owners WHERE heartbeat < ?', (deadline,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [row['pid'] for row in orphaned
+                if row['pid'] and (row['owner'] or '').startswith(f'{self.host}:')]
+
+
+job_store = JobStore(job_store_path)
@@ -0,0 +1,185 @@
+# metrics.py
+import time
+import threading
+from collections import deque
+
+# 分片耗时直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 计算瞬时速度的时间窗口（秒）
+THROUGHPUT_WINDOW = 5
+
+
+class DownloadMetrics:
+    """下载进程内的计数器，快照随进度事件上报给 Web 进程"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.bytes_downloaded = 0
+        self.segments_completed = 0
+        self.total_segments = 0
+        self.retries = 0
+        # 分片缓存命中、未命中次数，以及命中时免于下载的字节数
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_hit_bytes = 0
+        self.status_counts = {}
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def record_segment(self, latency, nbytes):
+        with self._lock:
+            now = time.time()
+            self.bytes_downloaded += nbytes
+            self.segments_completed += 1
+            self.latency_sum += latency
+            self.latency_count += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    self.latency_buckets[i] += 1
+            self._recent.append((now, nbytes))
+            while self._recent and now - self._recent[0][0] > THROUGHPUT_WINDOW:
+                self._recent.popleft()
+
+    def record_cache_hit(self, nbytes):
+        """缓存命中的分片计入完成数，但不计入下载字节数和速度"""
+        with self._lock:
+            self.segments_completed += 1
+            self.cache_hits += 1
+            self.cache_hit_bytes += nbytes
+
+    def record_progress(self, nbytes, segments_completed):
+        """ffmpeg 模式没有逐个分片的下载事件，按 ffmpeg 上报的增量字节数和估算的完成分片数记录"""
+        with self._lock:
+            now = time.time()
+            self.bytes_downloaded += nbytes
+            self.segments_completed = segments_completed
+            self._recent.append((now, nbytes))
+            while self._recent and now - self._recent[0][0] > THROUGHPUT_WINDOW:
+                self._recent.popleft()
+
+    def record_cache_miss(self):
+        with self._lock:
+            self.cache_misses += 1
+
+    def record_status(self, status):
+        with self._lock:
+            status = str(status)
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def record_retry(self, count=1):
+        with self._lock:
+            self.retries += count
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            elapsed = max(now - self.started_at, 1e-6)
+            recent = [(t, n) for t, n in self._recent if now - t <= THROUGHPUT_WINDOW]
+            window = min(THROUGHPUT_WINDOW, elapsed)
+            instant = sum(n for _, n in recent) / window
+            average = self.bytes_downloaded / elapsed
+            lookups = self.cache_hits + self.cache_misses
+            eta = None
+            remaining = self.total_segments - self.segments_completed
+            # 缓存命中的分片没有下载字节，按实际下载的分片估算平均大小
+            fetched = self.segments_completed - self.cache_hits
+            if self.segments_completed and remaining == 0:
+                eta = 0.0
+            elif fetched and remaining > 0:
+                rate = instant or average
+                if rate > 0:
+                    eta = remaining * (self.bytes_downloaded / fetched) / rate
+            return {
+                'bytes_downloaded': self.bytes_downloaded,
+                'segments_completed': self.segments_completed,
+                'total_segments': self.total_segments,
+                'throughput_instant': round(instant, 1),
+                'throughput_average': round(average, 1),
+                'eta_seconds': round(eta, 1) if eta is not None else None,
+                'elapsed_seconds': round(elapsed, 1),
+                'retries': self.retries,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'cache_hit_bytes': self.cache_hit_bytes,
+                'cache_hit_ratio': round(self.cache_hits / lookups, 4) if lookups else None,
+                'status_counts': dict(self.status_counts),
+                'latency_buckets': list(self.latency_buckets),
+                'latency_sum': round(self.latency_sum, 3),
+                'latency_count': self.latency_count,
+                'updated_at': now
+            }
+
+
+def empty_totals():
+    return {
+        'bytes_downloaded': 0,
+        'segments_completed': 0,
+        'retries': 0,
+        'cache_hits': 0,
+        'cache_misses': 0,
+        'cache_hit_bytes': 0,
+        'status_counts': {},
+        'latency_buckets': [0] * len(LATENCY_BUCKETS),
+        'latency_sum': 0.0,
+        'latency_count': 0
+    }
+
+
+def add_totals(totals, snapshot):
+    """把一个任务的快照累加到全局计数"""
+    for key in ('bytes_downloaded', 'segments_completed', 'retries', 'cache_hits', 'cache_misses',
+                'cache_hit_bytes', 'latency_sum', 'latency_count'):
+        totals[key] += snapshot.get(key, 0)
+    for status, count in snapshot.get('status_counts', {}).items():
+        totals['status_counts'][status] = totals['status_counts'].get(status, 0) + count
+    for i, count in enumerate(snapshot.get('latency_buckets', [])):
+        totals['latency_buckets'][i] += count
+    return totals
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+class PrometheusWriter:
+    """按 Prometheus 文本格式输出指标，同名指标的样本归到一组输出"""
+
+    def __init__(self):
+        # 指标名 -> (类型, 说明, 样本行列表)，保持首次出现的顺序
+        self._families = {}
+
+    def _family(self, name, metric_type, help_text):
+        if name not in self._families:
+            self._families[name] = (metric_type, help_text, [])
+        return self._families[name][2]
+
+    def sample(self, name, metric_type, help_text, value, labels=None):
+        if value is None:
+            return
+        self._family(name, metric_type, help_text).append(f'{name}{format_labels(labels)} {value}')
+
+    def histogram(self, name, help_text, buckets, total, count, labels=None):
+        labels = labels or {}
+        lines = self._family(name, 'histogram', help_text)
+        for bound, value in zip(LATENCY_BUCKETS, buckets):
+            lines.append(f'{name}_bucket{format_labels({**labels, "le": bound})} {value}')
+        lines.append(f'{name}_bucket{format_labels({**labels, "le": "+Inf"})} {count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {total}')
+        lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+    def render(self):
+        lines = []
+        for name, (metric_type, help_text, samples) in self._families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
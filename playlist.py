@@ -0,0 +1,259 @@
+# playlist.py
+import re
+from dataclasses import dataclass, field
+from urllib.parse import urljoin
+
+# 属性列表中的 KEY=VALUE，VALUE 可能是带逗号的引号字符串
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+VARIANT_POLICIES = ('highest', 'resolution', 'bitrate_cap')
+
+
+@dataclass
+class Key:
+    """EXT-X-KEY 描述的分片加密方式"""
+    method: str
+    uri: str = None
+    iv: str = None
+
+
+@dataclass
+class InitSection:
+    """EXT-X-MAP 描述的初始化分片（fMP4 的 ftyp/moov），其后的分片依赖它才能解码"""
+    uri: str
+    byterange: tuple = None
+    # MAP 标签处生效的密钥
+    key: Key = None
+
+
+@dataclass
+class Segment:
+    """媒体播放列表中的一个分片"""
+    uri: str
+    duration: float
+    sequence: int
+    key: Key = None
+    # EXT-X-BYTERANGE 指定的 (偏移, 长度)，None 表示整个资源
+    byterange: tuple = None
+    init: InitSection = None
+
+
+@dataclass
+class Variant:
+    """主播放列表中的一个码率/分辨率版本"""
+    uri: str
+    bandwidth: int = 0
+    resolution: tuple = None
+    codecs: str = None
+    # 使用的音轨组 GROUP-ID
+    audio: str = None
+
+    @property
+    def pixels(self):
+        return self.resolution[0] * self.resolution[1] if self.resolution else 0
+
+
+@dataclass
+class Rendition:
+    """主播放列表中 EXT-X-MEDIA 描述的备选音轨、字幕等，uri 为空时包含在版本自身的分片中"""
+    type: str
+    group_id: str
+    name: str = None
+    uri: str = None
+    language: str = None
+    default: bool = False
+    autoselect: bool = False
+
+
+@dataclass
+class MediaPlaylist:
+    url: str
+    segments: list = field(default_factory=list)
+    target_duration: float = 0
+    media_sequence: int = 0
+    endlist: bool = False
+    # 选中版本的独立音轨播放列表地址，由下载器在解析主播放列表后填写
+    audio_url: str = None
+
+    @property
+    def total_duration(self):
+        return sum(segment.duration for segment in self.segments)
+
+    @property
+    def encryption_methods(self):
+        methods = set()
+        for segment in self.segments:
+            for key in (segment.key, segment.init.key if segment.init else None):
+                if key:
+                    methods.add(key.method)
+        return methods
+
+    @property
+    def fragmented(self):
+        """分片是否为 fMP4，合并结果是 mp4 而不是 ts"""
+        return any(segment.init for segment in self.segments)
+
+
+@dataclass
+class MasterPlaylist:
+    url: str
+    variants: list = field(default_factory=list)
+    renditions: list = field(default_factory=list)
+
+
+def parse_attributes(value):
+    """解析 #EXT-X-...: 后面的属性列表"""
+    attributes = {}
+    for key, raw in ATTRIBUTE_PATTERN.findall(value):
+        attributes[key] = raw[1:-1] if raw.startswith('"') else raw
+    return attributes
+
+
+def parse_byterange(value):
+    """解析 长度[@偏移]，返回 (偏移, 长度)，省略偏移时偏移为 None"""
+    length, _, offset = value.partition('@')
+    return int(offset) if offset else None, int(length)
+
+
+def parse_playlist(content, base_url):
+    """一次遍历解析播放列表，返回 MasterPlaylist 或 MediaPlaylist"""
+    master = MasterPlaylist(base_url)
+    media = MediaPlaylist(base_url)
+    pending_variant = None
+    pending_duration = None
+    sequence = 0
+    key = None
+    init = None
+    pending_range = None
+    # 每个资源上一个字节范围的结束位置，省略偏移时紧接其后
+    range_ends = {}
+
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            tag, _, value = line.partition(':')
+            if tag == '#EXT-X-STREAM-INF':
+                attributes = parse_attributes(value)
+                resolution = None
+                if 'RESOLUTION' in attributes and 'x' in attributes['RESOLUTION']:
+                    width, _, height = attributes['RESOLUTION'].partition('x')
+                    resolution = (int(width), int(height))
+                pending_variant = Variant(
+                    uri='',
+                    bandwidth=int(attributes.get('BANDWIDTH', 0) or 0),
+                    resolution=resolution,
+                    codecs=attributes.get('CODECS'),
+                    audio=attributes.get('AUDIO')
+                )
+            elif tag == '#EXT-X-MEDIA':
+                attributes = parse_attributes(value)
+                uri = attributes.get('URI')
+                master.renditions.append(Rendition(
+                    type=attributes.get('TYPE'),
+                    group_id=attributes.get('GROUP-ID'),
+                    name=attributes.get('NAME'),
+                    uri=urljoin(base_url, uri) if uri else None,
+                    language=attributes.get('LANGUAGE'),
+                    default=attributes.get('DEFAULT') == 'YES',
+                    autoselect=attributes.get('AUTOSELECT') == 'YES'
+                ))
+            elif tag == '#EXTINF':
+                pending_duration = float(value.split(',', 1)[0] or 0)
+            elif tag == '#EXT-X-BYTERANGE':
+                pending_range = parse_byterange(value)
+            elif tag == '#EXT-X-TARGETDURATION':
+                media.target_duration = float(value)
+            elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                media.media_sequence = int(value)
+                sequence = media.media_sequence
+            elif tag == '#EXT-X-ENDLIST':
+                media.endlist = True
+            elif tag == '#EXT-X-KEY':
+                # 密钥对其后的所有分片生效，直到下一个 EXT-X-KEY
+                attributes = parse_attributes(value)
+                method = attributes.get('METHOD', 'NONE')
+                if method == 'NONE':
+                    key = None
+                else:
+                    uri = attributes.get('URI')
+                    key = Key(method, urljoin(base_url, uri) if uri else None, attributes.get('IV'))
+            elif tag == '#EXT-X-MAP':
+                # 初始化分片对其后的所有分片生效，直到下一个 EXT-X-MAP
+                attributes = parse_attributes(value)
+                byterange = None
+                if 'BYTERANGE' in attributes:
+                    offset, length = parse_byterange(attributes['BYTERANGE'])
+                    byterange = (offset or 0, length)
+                init = InitSection(urljoin(base_url, attributes.get('URI', '')), byterange, key)
+            continue
+
+        # 非注释行是 URI，归属于前面最近的 STREAM-INF 或 EXTINF
+        uri = urljoin(base_url, line)
+        if pending_variant is not None:
+            pending_variant.uri = uri
+            master.variants.append(pending_variant)
+            pending_variant = None
+        else:
+            byterange = None
+            if pending_range is not None:
+                offset, length = pending_range
+                if offset is None:
+                    offset = range_ends.get(uri, 0)
+                byterange = (offset, length)
+                range_ends[uri] = offset + length
+            media.segments.append(Segment(uri, pending_duration or 0, sequence, key, byterange, init))
+            sequence += 1
+            pending_duration = None
+            pending_range = None
+
+    return master if master.variants else media
+
+
+def init_segment(segment):
+    """把分片所需的初始化分片转换为可下载的分片；序号取所属分片的，用于未指定 IV 时推导 IV"""
+    init = segment.init
+    return Segment(init.uri, 0, segment.sequence, init.key, init.byterange)
+
+
+def with_init_sections(segments):
+    """在初始化分片首次出现和变化处插入初始化分片，返回按顺序下载合并的分片列表"""
+    expanded = []
+    current = None
+    for segment in segments:
+        if segment.init is not None and segment.init != current:
+            expanded.append(init_segment(segment))
+        current = segment.init
+        expanded.append(segment)
+    return expanded
+
+
+def select_audio(master, variant):
+    """返回版本所用音轨组中需要单独下载的音轨，优先 DEFAULT=YES，其次 AUTOSELECT=YES；音轨在版本自身分片中时返回 None"""
+    if not variant.audio:
+        return None
+    group = [rendition for rendition in master.renditions
+             if rendition.type == 'AUDIO' and rendition.group_id == variant.audio]
+    if not group:
+        return None
+    rendition = max(group, key=lambda r: (r.default, r.autoselect))
+    return rendition if rendition.uri else None
+
+
+def select_variant(variants, policy='highest', max_bitrate=None):
+    """按策略选择一个版本
+
+    highest: 带宽最高；resolution: 分辨率最高，相同时取带宽高的；
+    bitrate_cap: 不超过 max_bitrate 的最高带宽，都超过时取最低带宽。
+    """
+    if not variants:
+        return None
+    if policy == 'resolution':
+        return max(variants, key=lambda v: (v.pixels, v.bandwidth))
+    if policy == 'bitrate_cap' and max_bitrate:
+        under_cap = [v for v in variants if v.bandwidth <= max_bitrate]
+        if under_cap:
+            return max(under_cap, key=lambda v: v.bandwidth)
+        return min(variants, key=lambda v: v.bandwidth)
+    return max(variants, key=lambda v: v.bandwidth)
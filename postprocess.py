@@ -0,0 +1,126 @@
+# postprocess.py
+import os
+import json
+import struct
+import subprocess
+
+# 实际时长与预期时长相差超过该比例（且超过 DURATION_MIN_DIFF 秒）时视为文件不完整
+DURATION_TOLERANCE = 0.05
+DURATION_MIN_DIFF = 2.0
+# 截取缩略图的时间点：时长的 10%，最多第 10 秒
+THUMBNAIL_AT = 0.1
+THUMBNAIL_MAX_AT = 10.0
+
+
+class PostprocessError(Exception):
+    pass
+
+
+def last_line(text):
+    lines = text.strip().splitlines()
+    return lines[-1] if lines else ''
+
+
+def probe(path):
+    """用 ffprobe 读取容器时长和音视频流，文件无法解析或没有流时抛出 PostprocessError"""
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration,format_name:stream=codec_type,codec_name',
+             '-of', 'json', path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=300
+        )
+    except FileNotFoundError:
+        raise PostprocessError("未找到 ffprobe")
+    if result.returncode != 0:
+        raise PostprocessError(f"ffprobe 检查失败: {last_line(result.stderr) or result.returncode}")
+    info = json.loads(result.stdout or '{}')
+    streams = [{'type': stream.get('codec_type'), 'codec': stream.get('codec_name')}
+               for stream in info.get('streams', [])]
+    if not streams:
+        raise PostprocessError("文件中没有音视频流")
+    try:
+        duration = float(info.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        raise PostprocessError("无法读取文件时长")
+    return {'duration': round(duration, 3), 'format': info.get('format', {}).get('format_name'), 'streams': streams}
+
+
+def moov_before_mdat(path):
+    """按 MP4 顶层 box 判断 moov 是否已在 mdat 之前，两者都没找到时返回 None"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= size:
+            f.seek(offset)
+            box_size, box_type = struct.unpack('>I4s', f.read(8))
+            if box_type == b'moov':
+                return True
+            if box_type == b'mdat':
+                return False
+            if box_size == 1:
+                box_size = struct.unpack('>Q', f.read(8))[0]
+            elif box_size == 0:
+                break
+            if box_size < 8:
+                break
+            offset += box_size
+    return None
+
+
+def faststart(path):
+    """把 mp4 的 moov 移到文件开头，边下边播时不必先取到文件末尾；返回 applied / already / skipped"""
+    if os.path.splitext(path)[1].lower() not in ('.mp4', '.m4v', '.mov'):
+        return 'skipped'
+    if moov_before_mdat(path) is not False:
+        return 'already'
+    tmp_path = f"{path}.faststart.tmp"
+    result = subprocess.run(
+        ['ffmpeg', '-y', '-v', 'error', '-i', path, '-map', '0', '-c', 'copy', '-movflags', '+faststart',
+         '-f', 'mp4', tmp_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if result.returncode != 0:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise PostprocessError(f"faststart 处理失败: {last_line(result.stderr)}")
+    os.replace(tmp_path, path)
+    return 'applied'
+
+
+def thumbnail(path, duration, width):
+    """在视频旁边生成同名 jpg 缩略图，返回缩略图路径"""
+    thumbnail_path = os.path.splitext(path)[0] + '.jpg'
+    at = min(duration * THUMBNAIL_AT, THUMBNAIL_MAX_AT)
+    result = subprocess.run(
+        ['ffmpeg', '-y', '-v', 'error', '-ss', f'{at:.3f}', '-i', path, '-frames:v', '1',
+         '-vf', f'scale={width}:-2', '-q:v', '3', thumbnail_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if result.returncode != 0 or not os.path.exists(thumbnail_path):
+        raise PostprocessError(f"生成缩略图失败: {last_line(result.stderr)}")
+    return thumbnail_path
+
+
+def postprocess_file(path, expected_duration=None, thumbnail_width=320):
+    """检查完整性、faststart、生成缩略图，返回结果字典；在进程池的子进程中运行，不使用日志和任务库"""
+    if not os.path.isfile(path):
+        raise PostprocessError(f"文件不存在: {path}")
+    info = probe(path)
+    if expected_duration:
+        diff = abs(info['duration'] - expected_duration)
+        if diff > max(DURATION_MIN_DIFF, expected_duration * DURATION_TOLERANCE):
+            raise PostprocessError(f"文件时长 {info['duration']} 秒与播放列表的 {expected_duration:.3f} 秒不符")
+    result = {
+        'duration': info['duration'],
+        'expected_duration': expected_duration,
+        'format': info['format'],
+        'streams': info['streams'],
+        'faststart': faststart(path),
+        'thumbnail': None
+    }
+    if any(stream['type'] == 'video' for stream in info['streams']):
+        result['thumbnail'] = thumbnail(path, info['duration'], thumbnail_width)
+    result['size'] = os.path.getsize(path)
+    return result
@@ -0,0 +1,122 @@
+# rate_control.py
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# 视为被限流或拥塞的状态码
+THROTTLE_STATUS = (403, 429, 500, 502, 503, 504)
+
+
+class HostLimiter:
+    """单个主机的 AIMD 并发控制
+
+    每成功一轮（约 limit 个请求）并发数加 1；遇到限流、错误或明显变慢时并发数按 decrease 比例减少，
+    两次减少之间至少间隔一个冷却期，避免同一波失败把并发数压到最低。
+    """
+
+    def __init__(self, initial, minimum, maximum, decrease, latency_factor, cooldown):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.samples = 0
+        self.errors = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, ok, latency=None):
+        with self._cond:
+            self.in_flight -= 1
+            slow = False
+            if ok and latency is not None:
+                self.samples += 1
+                if self.latency_ewma is None:
+                    self.latency_ewma = latency
+                else:
+                    slow = self.samples > 5 and latency > self.latency_ewma * self.latency_factor
+                    self.latency_ewma = self.latency_ewma * 0.8 + latency * 0.2
+            if not ok:
+                self.errors += 1
+            if not ok or slow:
+                now = time.time()
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class ConcurrencyController:
+    """按分片所在主机分别做 AIMD 并发控制"""
+
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease=0.5, latency_factor=3.0, cooldown=1.0):
+        self.options = dict(initial=initial, minimum=minimum, maximum=maximum, decrease=decrease,
+                            latency_factor=latency_factor, cooldown=cooldown)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(**self.options)
+            return self._hosts[host]
+
+    @contextmanager
+    def slot(self, url):
+        """占用目标主机的一个并发名额，调用方通过 outcome 报告结果"""
+        limiter = self.host(url)
+        limiter.acquire()
+        outcome = {'ok': True, 'latency': None}
+        start = time.time()
+        try:
+            yield outcome
+        except Exception:
+            outcome['ok'] = False
+            raise
+        finally:
+            if outcome['ok'] and outcome['latency'] is None:
+                outcome['latency'] = time.time() - start
+            limiter.release(outcome['ok'], outcome['latency'])
+
+    def snapshot(self):
+        with self._lock:
+            return {host: round(limiter.limit, 2) for host, limiter in self._hosts.items()}
+
+
+class TokenBucket:
+    """全局带宽上限，rate 为每秒字节数，0 表示不限速"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # 单次请求超过桶容量时允许透支，后续请求等待补齐
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,89 @@
+# resolve_cache.py
+import os
+import time
+import sqlite3
+
+import requests
+
+from download_m3u8 import setup_logger
+from http_client import probe, normalize_url
+from job_store import job_store
+
+logger = setup_logger()
+
+# 解析结果缓存的有效期（秒），0 表示禁用缓存
+resolve_cache_ttl = float(os.getenv('RESOLVE_CACHE_TTL', '3600'))
+# 解析结果缓存的最大条目数，超出后淘汰最久未使用的条目
+resolve_cache_size = int(os.getenv('RESOLVE_CACHE_SIZE', '500'))
+# 返回缓存前检查m3u8是否仍可访问的超时时间（秒）
+resolve_cache_check_timeout = float(os.getenv('RESOLVE_CACHE_CHECK_TIMEOUT', '5'))
+
+
+def check_manifest_alive(m3u8_url, timeout=None):
+    """用 HEAD 请求检查缓存的m3u8是否仍可访问，不支持 HEAD 时退回 GET；不重试，失败即视为失效"""
+    timeout = resolve_cache_check_timeout if timeout is None else timeout
+    try:
+        response = probe(m3u8_url, method='HEAD', timeout=timeout, allow_redirects=True)
+        if response.status_code in (405, 501):
+            response = probe(m3u8_url, timeout=timeout, stream=True)
+            response.close()
+        return response.status_code < 400
+    except requests.RequestException as e:
+        logger.info(f"缓存的M3U8已失效: {m3u8_url} {str(e)}")
+        return False
+
+
+class ResolveCache:
+    """网页地址 -> m3u8解析结果的缓存，带有效期和 LRU 淘汰
+
+    条目保存在共享的任务库中，一个工作进程解析的结果其他工作进程也能命中；
+    缓存读写失败只记录日志，不影响解析。
+    """
+
+    def __init__(self, store, ttl, max_size):
+        self.store = store
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @staticmethod
+    def key(web_url):
+        # 保留锚点，#/video/1 这类前端路由是不同的页面
+        return normalize_url(web_url, keep_fragment=True)
+
+    def get(self, web_url):
+        """返回仍有效的缓存结果，过期或m3u8已失效时返回 None"""
+        if self.ttl <= 0:
+            return None
+        key = self.key(web_url)
+        try:
+            entry = self.store.get_resolution(key)
+            if entry is None:
+                return None
+            if time.time() - entry['resolved_at'] > self.ttl:
+                self.store.delete_resolution(key)
+                return None
+            if not check_manifest_alive(entry['url']):
+                self.store.delete_resolution(key)
+                return None
+            self.store.touch_resolution(key)
+        except sqlite3.Error as e:
+            logger.warning(f"读取解析缓存失败，忽略: {str(e)}")
+            return None
+        return entry
+
+    def put(self, web_url, result):
+        if self.ttl <= 0:
+            return
+        try:
+            self.store.put_resolution(self.key(web_url), result['url'], result['title'], self.max_size)
+        except sqlite3.Error as e:
+            logger.warning(f"保存解析缓存失败: {str(e)}")
+
+    def invalidate(self, web_url):
+        try:
+            self.store.delete_resolution(self.key(web_url))
+        except sqlite3.Error as e:
+            logger.warning(f"删除解析缓存失败: {str(e)}")
+
+
+resolve_cache = ResolveCache(job_store, resolve_cache_ttl, resolve_cache_size)
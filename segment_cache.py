@@ -0,0 +1,119 @@
+# segment_cache.py
+import os
+import hashlib
+import logging
+import threading
+
+from http_client import normalize_url
+
+logger = logging.getLogger('m3u8_downloader')
+
+
+class SegmentCache:
+    """按分片地址和字节范围寻址的磁盘缓存，多个下载进程共享
+
+    缓存的是源站返回的原始字节（加密分片未解密），文件名为键的 sha256。
+    命中时更新文件修改时间，超出容量时按修改时间淘汰最久未使用的分片。
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        # 本进程估算的缓存总大小，首次写入时扫描目录得到
+        self._size = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(url, byterange=None):
+        source = normalize_url(url)
+        if byterange:
+            source += '#%d-%d' % byterange
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """返回缓存的分片内容，未命中时返回 None"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        # 先写临时文件再改名，其他进程不会读到写了一半的分片
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"写入分片缓存失败: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        """列出缓存中的 (修改时间, 大小, 路径)"""
+        entries = []
+        try:
+            shards = list(os.scandir(self.root))
+        except OSError:
+            return entries
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """淘汰最久未使用的分片，直到总大小降到上限的 90%"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            # 已被其他进程删除的文件同样不再占用空间
+            total -= size
+        self._size = total
+        logger.info(f"分片缓存淘汰 {removed} 个文件，当前约 {total / 1024 / 1024:.1f} MB")
@@ -0,0 +1,8 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+
+# download_m3u8 在导入时创建输出目录和日志文件，测试时放到临时目录
+os.environ.setdefault('OUTPUT_DIR', tempfile.mkdtemp(prefix='m3u8-test-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,52 @@
+# tests/test_hls_crypto.py
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+from hls_crypto import SegmentDecryptor, segment_iv
+from playlist import Key
+
+KEY = bytes(range(16))
+
+
+def encrypt(data, iv):
+    return AES.new(KEY, AES.MODE_CBC, iv).encrypt(pad(data, 16))
+
+
+def test_iv_defaults_to_media_sequence():
+    assert segment_iv(Key('AES-128', 'k'), 258) == (258).to_bytes(16, 'big')
+
+
+def test_explicit_iv_is_parsed_with_or_without_prefix():
+    expected = bytes.fromhex('000102030405060708090a0b0c0d0e0f')
+    assert segment_iv(Key('AES-128', 'k', '0x000102030405060708090A0B0C0D0E0F'), 7) == expected
+    assert segment_iv(Key('AES-128', 'k', '000102030405060708090a0b0c0d0e0f'), 7) == expected
+    # 短 IV 左侧补零
+    assert segment_iv(Key('AES-128', 'k', '0x01'), 7) == b'\0' * 15 + b'\x01'
+
+
+@pytest.mark.parametrize('size', [0, 1, 15, 16, 17, 1000])
+@pytest.mark.parametrize('chunk', [1, 7, 16, 4096])
+def test_streaming_decrypt_strips_pkcs7_padding(size, chunk):
+    data = bytes(i % 251 for i in range(size))
+    iv = segment_iv(Key('AES-128', 'k'), 3)
+    encrypted = encrypt(data, iv)
+    decryptor = SegmentDecryptor(KEY, iv)
+    plain = b''.join(decryptor.update(encrypted[i:i + chunk]) for i in range(0, len(encrypted), chunk))
+    assert plain + decryptor.finalize() == data
+
+
+def test_truncated_ciphertext_is_rejected():
+    iv = bytes(16)
+    decryptor = SegmentDecryptor(KEY, iv)
+    decryptor.update(encrypt(b'x' * 40, iv)[:-3])
+    with pytest.raises(ValueError):
+        decryptor.finalize()
+
+
+def test_wrong_key_fails_padding_check():
+    iv = bytes(16)
+    decryptor = SegmentDecryptor(bytes(16), iv)
+    decryptor.update(encrypt(b'x' * 40, iv))
+    with pytest.raises(ValueError):
+        decryptor.finalize()
@@ -0,0 +1,153 @@
+# tests/test_merge.py
+import io
+import json
+import os
+import threading
+
+import pytest
+
+from download_m3u8 import OrderedMerger, SegmentManifest
+from playlist import Segment
+
+
+def segments(count, prefix='http://example.com/seg'):
+    return [Segment(f'{prefix}{i}.ts?token=abc', 2.0, i) for i in range(count)]
+
+
+def test_out_of_order_segments_are_written_in_playlist_order():
+    sink = io.BytesIO()
+    merged = []
+    merger = OrderedMerger(sink, 0, 1024, on_merged=lambda index, size: merged.append((index, size)))
+    for index in (2, 0, 3, 1):
+        merger.put(index, b'%d' % index * (index + 1))
+    assert sink.getvalue() == b'0' + b'11' + b'222' + b'3333'
+    assert merged == [(0, 1), (1, 2), (2, 3), (3, 4)]
+    assert merger.next_index == 4
+
+
+def test_merging_can_start_after_resumed_segments():
+    sink = io.BytesIO()
+    merger = OrderedMerger(sink, 5, 1024)
+    merger.put(6, b'b')
+    merger.put(5, b'a')
+    assert sink.getvalue() == b'ab'
+
+
+def test_full_reorder_buffer_blocks_later_segments_but_not_the_next_one():
+    sink = io.BytesIO()
+    merger = OrderedMerger(sink, 0, 4)
+    merger.put(1, b'1111')
+    done = threading.Event()
+    blocked = threading.Thread(target=lambda: (merger.put(2, b'2222'), done.set()))
+    blocked.start()
+    # 缓冲区已满，分片 2 须等待
+    assert not done.wait(0.2)
+    # 下一个要写的分片从不阻塞，写入后缓冲区排空
+    merger.put(0, b'0')
+    assert done.wait(5)
+    blocked.join()
+    assert sink.getvalue() == b'0' + b'1111' + b'2222'
+
+
+def test_abort_wakes_blocked_threads_and_rejects_new_segments():
+    merger = OrderedMerger(io.BytesIO(), 0, 1)
+    merger.put(1, b'1')
+    errors = []
+
+    def put_blocked():
+        try:
+            merger.put(2, b'2')
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=put_blocked)
+    thread.start()
+    merger.abort('源站错误')
+    thread.join(5)
+    assert not thread.is_alive()
+    assert errors and '源站错误' in str(errors[0])
+    with pytest.raises(Exception):
+        merger.put(0, b'0')
+
+
+def write_records(manifest, sizes, merged_file):
+    with open(merged_file, 'ab') as f:
+        for index, size in enumerate(sizes):
+            f.write(b'x' * size)
+            manifest.mark_merged(index, size)
+
+
+def test_resume_truncates_merged_file_to_last_recorded_segment(tmp_path):
+    merged_file = str(tmp_path / 'merged.ts')
+    manifest = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    write_records(manifest, [10, 20, 30], merged_file)
+    manifest.close()
+    # 中断时第 4 个分片只写了一半，没有记录
+    with open(merged_file, 'ab') as f:
+        f.write(b'y' * 7)
+
+    resumed = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    resumed.close()
+    assert resumed.merged_count == 3
+    assert os.path.getsize(merged_file) == 60
+
+
+def test_resume_ignores_a_half_written_record(tmp_path):
+    merged_file = str(tmp_path / 'merged.ts')
+    manifest = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    write_records(manifest, [10, 20], merged_file)
+    manifest.close()
+    with open(manifest.path, 'a') as f:
+        f.write('{"index": 2, "si')
+
+    resumed = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    # 补齐半行后新记录仍可读
+    resumed.mark_merged(2, 5)
+    resumed.close()
+    with open(merged_file, 'ab') as f:
+        f.write(b'z' * 5)
+    again = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    again.close()
+    assert resumed.merged_count == 3
+    assert again.merged_count == 3
+    assert os.path.getsize(merged_file) == 35
+
+
+def test_records_beyond_merged_file_size_are_not_trusted(tmp_path):
+    merged_file = str(tmp_path / 'merged.ts')
+    manifest = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    write_records(manifest, [10, 20], merged_file)
+    manifest.mark_merged(2, 30)
+    manifest.close()
+
+    resumed = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    resumed.close()
+    assert resumed.merged_count == 2
+    assert os.path.getsize(merged_file) == 30
+
+
+def test_changed_playlist_discards_old_records(tmp_path):
+    merged_file = str(tmp_path / 'merged.ts')
+    manifest = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(5), merged_file)
+    write_records(manifest, [10, 20], merged_file)
+    manifest.close()
+
+    resumed = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8',
+                              segments(5, 'http://example.com/other'), merged_file)
+    resumed.close()
+    assert resumed.merged_count == 0
+    assert os.path.getsize(merged_file) == 0
+    with open(resumed.path) as f:
+        assert json.loads(f.readline())['total_segments'] == 5
+
+
+def test_fingerprint_ignores_query_parameters(tmp_path):
+    merged_file = str(tmp_path / 'merged.ts')
+    manifest = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', segments(3), merged_file)
+    write_records(manifest, [10], merged_file)
+    manifest.close()
+
+    signed = [Segment(s.uri.replace('token=abc', 'token=xyz'), s.duration, s.sequence) for s in segments(3)]
+    resumed = SegmentManifest(str(tmp_path), 'http://example.com/index.m3u8', signed, merged_file)
+    resumed.close()
+    assert resumed.merged_count == 1
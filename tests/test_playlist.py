@@ -0,0 +1,151 @@
+# tests/test_playlist.py
+from playlist import (Key, MediaPlaylist, MasterPlaylist, parse_playlist, select_variant, select_audio,
+                      with_init_sections)
+
+BASE = 'http://example.com/hls/index.m3u8'
+
+
+def test_media_playlist_segments_and_sequence():
+    playlist = parse_playlist('''#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:10
+#EXTINF:4.0,
+a.ts
+#EXTINF:3.5,title
+/abs/b.ts
+#EXT-X-ENDLIST
+''', BASE)
+    assert isinstance(playlist, MediaPlaylist)
+    assert [s.uri for s in playlist.segments] == ['http://example.com/hls/a.ts', 'http://example.com/abs/b.ts']
+    assert [s.sequence for s in playlist.segments] == [10, 11]
+    assert playlist.target_duration == 4
+    assert playlist.total_duration == 7.5
+    assert playlist.endlist
+
+
+def test_live_playlist_has_no_endlist():
+    playlist = parse_playlist('#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXTINF:2,\na.ts\n', BASE)
+    assert not playlist.endlist
+
+
+def test_byterange_offset_continues_after_previous_range_of_same_resource():
+    playlist = parse_playlist('''#EXTM3U
+#EXTINF:2,
+#EXT-X-BYTERANGE:1000@0
+all.ts
+#EXTINF:2,
+#EXT-X-BYTERANGE:500
+all.ts
+#EXTINF:2,
+#EXT-X-BYTERANGE:300
+other.ts
+#EXTINF:2,
+#EXT-X-BYTERANGE:200
+all.ts
+#EXTINF:2,
+whole.ts
+''', BASE)
+    assert [s.byterange for s in playlist.segments] == [(0, 1000), (1000, 500), (0, 300), (1500, 200), None]
+
+
+def test_key_applies_until_next_key_tag():
+    playlist = parse_playlist('''#EXTM3U
+#EXTINF:2,
+plain.ts
+#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x0000000000000000000000000000000A
+#EXTINF:2,
+enc1.ts
+#EXTINF:2,
+enc2.ts
+#EXT-X-KEY:METHOD=NONE
+#EXTINF:2,
+plain2.ts
+''', BASE)
+    keys = [s.key for s in playlist.segments]
+    assert keys[0] is None and keys[3] is None
+    assert keys[1] == keys[2] == Key('AES-128', 'http://example.com/hls/key.bin', '0x0000000000000000000000000000000A')
+    assert playlist.encryption_methods == {'AES-128'}
+
+
+def test_key_attribute_values_may_contain_commas():
+    playlist = parse_playlist('#EXTM3U\n#EXT-X-KEY:METHOD=SAMPLE-AES,URI="skd://a,b"\n#EXTINF:2,\na.ts\n', BASE)
+    assert playlist.segments[0].key.uri == 'skd://a,b'
+    assert playlist.encryption_methods == {'SAMPLE-AES'}
+
+
+def test_init_sections_are_inserted_where_the_map_changes():
+    playlist = parse_playlist('''#EXTM3U
+#EXT-X-MEDIA-SEQUENCE:5
+#EXT-X-MAP:URI="init.mp4",BYTERANGE="800@16"
+#EXTINF:2,
+s1.m4s
+#EXTINF:2,
+s2.m4s
+#EXT-X-DISCONTINUITY
+#EXT-X-MAP:URI="init2.mp4"
+#EXTINF:2,
+s3.m4s
+''', BASE)
+    assert playlist.fragmented
+    assert playlist.segments[0].init.byterange == (16, 800)
+    expanded = with_init_sections(playlist.segments)
+    assert [s.uri.rsplit('/', 1)[1] for s in expanded] == ['init.mp4', 's1.m4s', 's2.m4s', 'init2.mp4', 's3.m4s']
+    # 初始化分片不计时长，序号取所属分片的
+    assert expanded[0].duration == 0 and expanded[0].sequence == 5
+    assert expanded[0].byterange == (16, 800)
+    assert sum(s.duration for s in expanded) == playlist.total_duration
+
+
+def test_segments_without_map_are_unchanged():
+    playlist = parse_playlist('#EXTM3U\n#EXTINF:2,\na.ts\n#EXTINF:2,\nb.ts\n', BASE)
+    assert not playlist.fragmented
+    assert with_init_sections(playlist.segments) == playlist.segments
+
+
+MASTER = '''#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="English",LANGUAGE="en",DEFAULT=YES,AUTOSELECT=YES,URI="audio/en.m3u8"
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="Deutsch",LANGUAGE="de",URI="audio/de.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,AUDIO="aud"
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2400000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+mid.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION=1920x1080
+high.m3u8
+'''
+
+
+def test_master_playlist_variants_and_renditions():
+    master = parse_playlist(MASTER, BASE)
+    assert isinstance(master, MasterPlaylist)
+    assert [(v.bandwidth, v.resolution) for v in master.variants] == \
+        [(800000, (640, 360)), (2400000, (1280, 720)), (2000000, (1920, 1080))]
+    assert master.variants[1].codecs == 'avc1.4d401f,mp4a.40.2'
+    assert master.variants[0].audio == 'aud'
+    assert [r.name for r in master.renditions] == ['English', 'Deutsch']
+
+
+def test_select_variant_policies():
+    variants = parse_playlist(MASTER, BASE).variants
+    assert select_variant(variants, 'highest').uri.endswith('mid.m3u8')
+    assert select_variant(variants, 'resolution').uri.endswith('high.m3u8')
+    assert select_variant(variants, 'bitrate_cap', 2000000).uri.endswith('high.m3u8')
+    # 都超过上限时取最低带宽
+    assert select_variant(variants, 'bitrate_cap', 100).uri.endswith('low.m3u8')
+    assert select_variant([], 'highest') is None
+
+
+def test_select_audio_prefers_default_rendition():
+    master = parse_playlist(MASTER, BASE)
+    audio = select_audio(master, master.variants[0])
+    assert audio.uri == 'http://example.com/hls/audio/en.m3u8'
+    # 未引用音轨组的版本音频包含在自身分片中
+    assert select_audio(master, master.variants[1]) is None
+
+
+def test_select_audio_ignores_renditions_without_uri():
+    master = parse_playlist('''#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="main",DEFAULT=YES
+#EXT-X-STREAM-INF:BANDWIDTH=1,AUDIO="aud"
+v.m3u8
+''', BASE)
+    assert select_audio(master, master.variants[0]) is None
@@ -0,0 +1,151 @@
+# tracing.py
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+
+
+class Tracer:
+    """记录一段处理过程的时间线，每个阶段是一个带开始时间和耗时的 span
+
+    span 按结束顺序追加，嵌套关系由时间区间体现；超过 max_spans 后只计数不再记录，
+    避免长时间的直播录制占用过多内存。enabled 为 False 时不记录任何内容。
+    """
+
+    def __init__(self, process_name, max_spans=50000, enabled=True):
+        self.process_name = process_name
+        self.max_spans = max_spans
+        self.enabled = enabled
+        self.dropped = 0
+        self._spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """记录 with 块的耗时，块内可向产出的字典补充参数，抛出异常时记录错误"""
+        start = time.time()
+        try:
+            yield args
+        except Exception as e:
+            args['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            self.add(name, category, start, time.time() - start, **args)
+
+    def add(self, name, category, start, duration, **args):
+        if not self.enabled:
+            return
+        span = {
+            'name': name,
+            'category': category,
+            'start': round(start, 6),
+            'duration': round(duration, 6),
+            'process': self.process_name,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'args': args
+        }
+        with self._lock:
+            if len(self._spans) >= self.max_spans:
+                self.dropped += 1
+                return
+            self._spans.append(span)
+
+    @property
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def save(self, path):
+        if self.enabled:
+            save_spans(path, self.spans, self.dropped)
+
+
+def save_spans(path, spans, dropped=0):
+    """写入时间线文件，先写临时文件再改名，读取方不会读到写了一半的内容"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'spans': spans, 'dropped': dropped}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_spans(path):
+    """读取时间线文件，返回 (spans, 丢弃数)，文件不存在时返回空列表"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return [], 0
+    return data.get('spans', []), data.get('dropped', 0)
+
+
+def job_trace_path(trace_dir, job_id):
+    return os.path.join(trace_dir, f"{job_id}.json")
+
+
+def resolve_trace_path(trace_dir, m3u8_url):
+    """网页解析发生在任务创建之前，按解析得到的 m3u8 地址保存，任务通过同一地址找到它"""
+    key = hashlib.sha1(m3u8_url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(trace_dir, 'resolve', f"{key}.json")
+
+
+def summarize(spans):
+    """按名称汇总 span 的次数、总耗时和最长耗时"""
+    summary = {}
+    for span in spans:
+        item = summary.setdefault(span['name'], {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        item['count'] += 1
+        item['total_seconds'] += span['duration']
+        item['max_seconds'] = max(item['max_seconds'], span['duration'])
+    for item in summary.values():
+        item['total_seconds'] = round(item['total_seconds'], 6)
+    return summary
+
+
+def to_chrome_trace(spans):
+    """转换为 Chrome trace event 格式，可在 chrome://tracing 或 Perfetto 中打开"""
+    events = []
+    threads = {}
+    for span in sorted(spans, key=lambda span: span['start']):
+        key = (span['pid'], span['thread'])
+        if key not in threads:
+            threads[key] = len(threads) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': span['pid'], 'tid': threads[key],
+                           'args': {'name': span['thread']}})
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': span['pid'], 'tid': threads[key],
+                           'args': {'name': f"{span['process']} ({span['pid']})"}})
+        events.append({
+            'name': span['name'],
+            'cat': span['category'],
+            'ph': 'X',
+            'ts': int(span['start'] * 1000000),
+            'dur': int(span['duration'] * 1000000),
+            'pid': span['pid'],
+            'tid': threads[key],
+            'args': span['args']
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def prune_traces(trace_dir, keep):
+    """按修改时间只保留最近的 keep 个任务时间线和 keep 个网页解析时间线"""
+    for directory in (trace_dir, os.path.join(trace_dir, 'resolve')):
+        try:
+            entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+        except OSError:
+            continue
+        # 同一任务的时间线和性能分析文件一起保留或删除
+        groups = {}
+        for entry in entries:
+            group = groups.setdefault(entry.name.split('.', 1)[0], [0, []])
+            group[0] = max(group[0], entry.stat().st_mtime)
+            group[1].append(entry.path)
+        for _, paths in sorted(groups.values(), reverse=True)[keep:]:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass